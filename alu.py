@@ -0,0 +1,126 @@
+'''
+6-bit arithmetic helpers, plus lookup tables for the decoded engine.
+
+Every operand is 6 bits, so a binary op is a flat list of 64 * 64 results
+indexed by `(a << 6) | b`. Ops where the right operand is an immediate are
+stored as rows instead: `rows[ib]` is a 64-element list indexed by `a`.
+'''
+
+from ins import *
+
+
+def twos_comp(n, bits=6):
+    mask = (1 << bits) - 1
+    neg = n ^ mask
+    return (neg + 1) & mask
+
+
+def to_int(n, bits=6):
+    '''Turn a two's complement number into a Python int'''
+    if (n & (1 << (bits - 1))) != 0:
+        n = n - (1 << bits)
+    return n
+
+
+def bit_string(n, bits=6):
+    return format(n % (1 << bits), '0{}b'.format(bits))
+
+
+def from_int(n, bits=6):
+    '''Turn a Python int to a two''s complement number'''
+    return n & ((1 << bits) - 1)
+
+
+def sar(n, d, bits=6):
+    '''Arithmetic right shift'''
+    sign = n & (1 << (bits - 1))
+    if sign == 0:
+        return n >> d
+    else:
+        inv_s = max(bits - d, 0)
+        sign_mask = (1 << bits) - (1 << inv_s)
+        return (n >> d) | sign_mask
+
+
+def rol(n, d, bits=6):
+    '''Rotate bits left'''
+    mask = (1 << bits) - 1
+    n &= mask
+    d = d % bits
+    return ((n >> d) | (n << (bits - d))) & mask
+
+
+def table(f):
+    '''Results of `f(a, b)` for all 6-bit `a` and `b`'''
+    return [f(a, b) for a in range(64) for b in range(64)]
+
+
+def rows(t, n=64):
+    '''Split table `t` into rows with the right operand fixed'''
+    return [t[b::64] for b in range(n)]
+
+
+# Register-register ops. These match `Emu.op_*`, including the two's
+# complement of `rb` in SUB, XOR and AND.
+ADD = table(lambda a, b: (a + b) & 0o77)
+SUB = table(lambda a, b: (a + twos_comp(b)) & 0o77)
+OR = table(lambda a, b: a | b)
+XOR = table(lambda a, b: a ^ twos_comp(b))
+AND = table(lambda a, b: a & twos_comp(b))
+SHL = table(lambda a, b: (a << b) & 0o77)
+SHR = table(lambda a, b: a >> b)
+
+# Register-immediate ops
+ADDI = rows(ADD)
+ORI = rows(OR)
+XORI = rows(table(lambda a, b: a ^ b))
+ANDI = rows(table(lambda a, b: a & b))
+
+# Shift/rotate by immediate, keyed by `ShiType`. `ib` is only 3 bits.
+SHI = {
+    ShiType.SHLI: rows(SHL, 8),
+    ShiType.SHRI: rows(SHR, 8),
+    ShiType.SARI: rows(table(sar), 8),
+    ShiType.ROLI: rows(table(rol), 8),
+}
+
+# Comparisons of left and right sides, keyed by `Cm`
+CMP = {
+    Cm.TR: table(lambda left, right: True),
+    Cm.FA: table(lambda left, right: False),
+    Cm.EQ: table(lambda left, right: left == right),
+    Cm.NE: table(lambda left, right: left != right),
+    Cm.SL: table(lambda left, right: to_int(left) < to_int(right)),
+    Cm.SG: table(lambda left, right: to_int(left) > to_int(right)),
+    Cm.UL: table(lambda left, right: left < right),
+    Cm.UG: table(lambda left, right: left > right),
+}
+
+# Comparisons with an immediate right side (`CMP_RI[cm][ib][a]`) or left side
+# (`CMP_IR[cm][ia][b]`)
+CMP_RI = {cm: rows(t) for cm, t in CMP.items()}
+CMP_IR = {cm: [t[a << 6:(a + 1) << 6] for a in range(64)]
+          for cm, t in CMP.items()}
+
+fm_tables = {}
+
+
+def fm_table(fm_type, pr):
+    '''
+    Table of the 6-bit FM result for a `FmType` and precision, built the
+    first time it is needed since there are 32 of them.
+    '''
+    key = (fm_type, pr)
+    if key not in fm_tables:
+        def fm(a, b):
+            # 12 bit buffer
+            ans = (a * b) & 0o7777
+            if fm_type == FmType.U:
+                ans = ans >> pr
+            else:
+                ans = sar(ans, pr, bits=12)
+            return ans & 0o77
+
+        fm_tables[key] = table(fm)
+
+    return fm_tables[key]
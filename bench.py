@@ -0,0 +1,234 @@
+'''
+Benchmarks over the bundled ROMs.
+
+Each ROM runs headless on each engine for a fixed number of instructions,
+with scripted serial input and a `VirtualClock`, so that every run does the
+same work. Runs happen in their own process, which gives each one a fair
+peak RSS and startup time, and lets them use another Python, e.g. PyPy.
+
+Results are written as JSON, and compared against a saved baseline if given.
+The exit status is 1 if any run failed, or if any result got worse than the
+baseline by more than the tolerance or is missing.
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# Import time counts towards startup
+t_start = time.perf_counter()
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+roms_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'roms')
+
+# ROM -> (serial input, whether it uses the GPU)
+benchmarks = {
+    'mandelflag.rom': ('HELLO WORLD\n', False),
+    'nyan.rom': ('', True),
+    'win.rom': ('', True),
+    'talkative-client.rom': ('YMAS\nHELLO THERE\n', False),
+    'talkative-server-redacted.rom': ('YMAS\nHELLO THERE\n', False),
+}
+
+engines = ['ref', 'decoded', 'block', 'trace', 'aot']
+
+# Instructions per virtual centisecond
+ins_per_cs = 1000
+
+# Measurements where lower is better, and the ones compared to the baseline
+lower_is_better = {'startup', 'first_output', 'peak_rss_kb'}
+compared = ['ips', 'peak_rss_kb']
+
+
+class FirstOutput:
+    '''Serial output that notes when it was first written to'''
+
+    def __init__(self):
+        self.at = None
+        self.n = 0
+
+    def write(self, s):
+        if self.at is None:
+            self.at = time.perf_counter()
+        self.n += len(s)
+
+    def flush(self):
+        pass
+
+
+def get_input():
+    # Nothing more after the script
+    raise EOFError
+
+
+def run_one(rom, engine, steps):
+    '''Run a benchmark in this process, returning its results'''
+    from emu import Emu, VirtualClock
+    from gpu import HeadlessGpu
+    import transpile
+
+    (script, use_gpu) = benchmarks[rom]
+    filename = os.path.join(roms_dir, rom)
+    emu = Emu.from_filename(filename, clock=VirtualClock(ins_per_cs),
+                            gpu_backend=HeadlessGpu() if use_gpu else None)
+    emu.buffer = script
+    emu.get_input = get_input
+    emu.out = FirstOutput()
+
+    with tempfile.TemporaryDirectory() as d:
+        if engine == 'aot':
+            # Built ahead of time, so not part of the startup
+            t = time.perf_counter()
+            module = os.path.join(d, rom + '.py')
+            transpile.transpile_to_file(emu.tape, module, rom)
+            emu.filename = module[:-len('.py')]
+            build = time.perf_counter() - t
+        else:
+            build = 0.0
+
+        t_run = time.perf_counter()
+        try:
+            emu.run(engine=engine, max_steps=steps)
+            stop_reason = emu.stop_reason.name
+        except EOFError:
+            # Wanted more input than the script has
+            stop_reason = 'INPUT'
+        t_end = time.perf_counter()
+
+    import resource
+    elapsed = t_end - t_run
+    return {
+        'rom': rom,
+        'engine': engine,
+        'steps': emu.steps,
+        'stop_reason': stop_reason,
+        'seconds': elapsed,
+        'ips': emu.steps / elapsed if elapsed > 0 else 0.0,
+        'startup': t_run - t_start - build,
+        'first_output': None if emu.out.at is None else emu.out.at - t_run,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_all(python, roms, engines, steps):
+    '''
+    Run each benchmark in a new `python` process. Returns the results, and
+    messages for the runs that failed.
+    '''
+    impl = subprocess.run(
+        [python, '-c', 'import sys, platform; print(sys.implementation.name,'
+         ' platform.python_version())'],
+        check=True, capture_output=True, text=True).stdout.strip()
+
+    results = []
+    failures = []
+    for rom in roms:
+        for engine in engines:
+            p = subprocess.run(
+                [python, os.path.abspath(__file__), '--one', rom, engine,
+                 str(steps)],
+                capture_output=True, text=True)
+            if p.returncode != 0:
+                print('{} {} {} failed:\n{}'.format(
+                    impl, rom, engine, p.stderr), file=sys.stderr)
+                failures.append('{} {} {}: exit status {}'.format(
+                    impl, rom, engine, p.returncode))
+                continue
+
+            result = json.loads(p.stdout.splitlines()[-1])
+            result['python'] = impl
+            results.append(result)
+            print('{:<16} {:<30} {:<8} {:>12.0f} ins/s  startup {:.3f}s  '
+                  'first output {}  peak RSS {} KB'.format(
+                      impl, rom, engine, result['ips'], result['startup'],
+                      '-' if result['first_output'] is None
+                      else '{:.3f}s'.format(result['first_output']),
+                      result['peak_rss_kb']))
+    return (results, failures)
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Messages for the results that regressed from `baseline`, or that are in
+    `baseline` but not `results`
+    '''
+    key = lambda r: (r['python'], r['rom'], r['engine'])
+    old = {key(r): r for r in baseline}
+    new = {key(r) for r in results}
+    ans = ['{} {} {}: missing'.format(*k) for k in old if k not in new]
+    for r in results:
+        b = old.get(key(r))
+        # ROMs that halt early run too briefly to compare
+        if b is None or \
+                {r['stop_reason'], b['stop_reason']} != {'MAX_STEPS'}:
+            continue
+        for m in compared:
+            if m in lower_is_better:
+                worse = r[m] > b[m] * (1 + tolerance)
+            else:
+                worse = r[m] < b[m] * (1 - tolerance)
+            if worse:
+                ans.append('{} {} {}: {} {:.4g} -> {:.4g}'.format(
+                    *key(r), m, b[m], r[m]))
+    return ans
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--one', nargs=3, metavar=('ROM', 'ENGINE', 'STEPS'),
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--roms', nargs='+', default=list(benchmarks))
+    parser.add_argument('--engines', nargs='+', default=engines)
+    parser.add_argument('--steps', type=int, default=10 ** 6,
+                        help='Instructions per run')
+    parser.add_argument('--python', nargs='+', default=[sys.executable],
+                        help='Interpreters to run on, e.g. python3 pypy3')
+    parser.add_argument('--out', default='bench.json',
+                        help='Where to write the results')
+    parser.add_argument('--baseline', help='Results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Slowdown allowed against the baseline')
+    args = parser.parse_args()
+
+    if args.one:
+        (rom, engine, steps) = args.one
+        print(json.dumps(run_one(rom, engine, int(steps))))
+        return
+
+    # Before anything is written, since it can be `args.out` too
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            # Only what this run covers
+            baseline = [r for r in json.load(f)['results']
+                        if r['rom'] in args.roms and
+                        r['engine'] in args.engines]
+
+    results = []
+    failures = []
+    for python in args.python:
+        (r, f) = run_all(python, args.roms, args.engines, args.steps)
+        results += r
+        failures += f
+    with open(args.out, 'w') as f:
+        json.dump({'steps': args.steps, 'results': results}, f, indent=2)
+
+    for msg in failures:
+        print('FAILED', msg, file=sys.stderr)
+    regressions = []
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for msg in regressions:
+            print('REGRESSION', msg, file=sys.stderr)
+    if failures or regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+'''
+Breakpoints and watchpoints for the debugger.
+
+Each point only concerns some positions on the tape: a breakpoint stops
+before the instructions it's on, and a watchpoint is checked after the
+instructions that could change what it watches. `run` executes the decoded
+records with just those positions wrapped, so everything else runs as fast
+as `Emu.run_decoded`.
+
+Conditions are Python expressions, which can use `r` (registers), `mem`,
+`cf`, `pc` and `emu`.
+'''
+
+from emu import *
+from history import rd_ops, rd_io_devices, io_device
+
+# Devices that change `mem.addr`
+addr_io_devices = {
+    IoDevice.MEM_ADDR_HI,
+    IoDevice.MEM_ADDR_MID,
+    IoDevice.MEM_ADDR_LO,
+    IoDevice.MEM_READ,
+    IoDevice.MEM_WRITE,
+}
+
+
+class Stop(Exception):
+    '''Raised by the wrapped records when `point` fires'''
+
+    def __init__(self, point, msg):
+        super().__init__(msg)
+        self.point = point
+
+
+class Point:
+    def __init__(self, cond=None):
+        self.cond = cond
+        self.code = None if cond is None else compile(cond, cond, 'eval')
+
+    def check(self, emu):
+        '''Whether the condition holds'''
+        if self.code is None:
+            return True
+        env = {'r': emu.regs, 'mem': emu.mem, 'cf': emu.cf, 'pc': emu.pc,
+               'emu': emu}
+        return bool(eval(self.code, env))
+
+    def __str__(self):
+        if self.cond is None:
+            return self.desc()
+        return '{} if {}'.format(self.desc(), self.cond)
+
+
+class Breakpoint(Point):
+    # Whether the instruction has to be executed, i.e. its condition has to
+    # pass, for the breakpoint to fire
+    executed_only = False
+
+    def hit(self, emu):
+        '''Whether to stop before the instruction at the PC'''
+        if self.executed_only and not emu.should_execute(emu.tape[emu.pc]):
+            return False
+        return self.check(emu)
+
+
+class PcBreak(Breakpoint):
+    def __init__(self, pc, cond=None):
+        super().__init__(cond)
+        self.pc = pc
+
+    def pcs(self, tape):
+        return [self.pc]
+
+    def desc(self):
+        return 'break at {}'.format(self.pc)
+
+
+class LabelBreak(Breakpoint):
+    '''Stops at labels with `label_key`, however they were reached'''
+
+    def __init__(self, label_key, cond=None):
+        super().__init__(cond)
+        self.label_key = label_key
+
+    def pcs(self, tape):
+        return [i for i, ins in enumerate(tape.data)
+                if ins.op == Op.LBL and ins.label_key() == self.label_key]
+
+    def desc(self):
+        return 'break at label {}, {}'.format(*self.label_key)
+
+
+class IoBreak(Breakpoint):
+    '''Stops before IO with `device` that is going to execute'''
+
+    executed_only = True
+
+    def __init__(self, device, cond=None):
+        super().__init__(cond)
+        self.device = device
+
+    def pcs(self, tape):
+        return [i for i, ins in enumerate(tape.data)
+                if io_device(ins) == self.device]
+
+    def desc(self):
+        return 'break at IO {}'.format(self.device.name)
+
+
+class Watchpoint(Point):
+    '''Stops after an instruction changes `value`'''
+
+
+class RegWatch(Watchpoint):
+    def __init__(self, reg, cond=None):
+        super().__init__(cond)
+        self.reg = reg
+
+    def pcs(self, tape):
+        ans = []
+        for i, ins in enumerate(tape.data):
+            if ins.op in rd_ops and ins.a == self.reg:
+                ans.append(i)
+            elif ins.op == Op.ST:
+                # Could store to any register
+                ans.append(i)
+            elif io_device(ins) in rd_io_devices and ins.a == self.reg:
+                ans.append(i)
+        return ans
+
+    def value(self, emu):
+        return emu.regs[self.reg]
+
+    def desc(self):
+        return 'watch regs[{}]'.format(self.reg)
+
+
+class MemWatch(Watchpoint):
+    def __init__(self, addr, cond=None):
+        super().__init__(cond)
+        self.addr = addr
+
+    def pcs(self, tape):
+        return [i for i, ins in enumerate(tape.data)
+                if io_device(ins) == IoDevice.MEM_WRITE]
+
+    def value(self, emu):
+        return emu.mem[self.addr]
+
+    def desc(self):
+        return 'watch mem[{}]'.format(self.addr)
+
+
+class AddrWatch(Watchpoint):
+    def pcs(self, tape):
+        return [i for i, ins in enumerate(tape.data)
+                if io_device(ins) in addr_io_devices]
+
+    def value(self, emu):
+        return emu.mem.addr
+
+    def desc(self):
+        return 'watch mem.addr'
+
+
+# Wrapped records
+#
+# These replace decoded records at the positions points are on, and carry
+# the original record. They always have the `UN` condition, and check the
+# original one themselves.
+
+def break_handler(emu, points, rec, c_):
+    for point in points:
+        if point.hit(emu):
+            raise Stop(point, 'Hit {}'.format(point))
+
+    handler, cond, a, b, c = rec
+    if cond == 0 or (cond == 1) == emu.cf:
+        handler(emu, a, b, c)
+
+
+def watch_handler(emu, points, rec, n):
+    handler, cond, a, b, c = rec
+    if not (cond == 0 or (cond == 1) == emu.cf):
+        return
+
+    olds = [point.value(emu) for point in points]
+    handler(emu, a, b, c)
+    for point, old in zip(points, olds):
+        new = point.value(emu)
+        if new != old and point.check(emu):
+            # Stop after the instruction, which never jumps
+            emu.pc = (emu.pc + 1) % n
+            emu.steps += 1
+            raise Stop(point, '{}: {} -> {}'.format(point, old, new))
+
+
+def by_pc(tape, points):
+    '''Maps of PC -> breakpoints and PC -> watchpoints there'''
+    breaks = {}
+    watches = {}
+    for point in points:
+        d = watches if isinstance(point, Watchpoint) else breaks
+        for pc in point.pcs(tape):
+            d.setdefault(pc, []).append(point)
+    return (breaks, watches)
+
+
+def wrap(tape, points):
+    '''Decoded records of `tape` with `points` wrapped in'''
+    code = list(tape.decoded())
+    n = len(code)
+
+    (breaks, watches) = by_pc(tape, points)
+    for pc, ps in watches.items():
+        code[pc] = (watch_handler, 0, ps, code[pc], n)
+    for pc, ps in breaks.items():
+        code[pc] = (break_handler, 0, ps, code[pc], None)
+    return code
+
+
+def run(emu, points, history=None):
+    '''
+    Run `emu` until a point fires or it halts. Returns the `Stop`, or None.
+    Checkpoints are recorded to `history` along the way if given.
+    '''
+    code = wrap(emu.tape, points)
+    n = len(code)
+    limit = float('inf')
+
+    try:
+        while not emu.halted:
+            if history is not None:
+                history.record()
+                limit = history.checkpoints[-1].steps + history.interval
+
+            while not emu.halted and emu.steps < limit:
+                handler, cond, a, b, c = code[emu.pc]
+                if cond == 0 or (cond == 1) == emu.cf:
+                    handler(emu, a, b, c)
+                emu.pc = (emu.pc + 1) % n  # Tape is looped
+                emu.steps += 1
+    except Stop as e:
+        return e
+    return None
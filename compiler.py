@@ -0,0 +1,438 @@
+'''
+Basic block compiler.
+
+The tape is split into basic blocks, which start at position 0, at labels
+and after any instruction that leaves the block (JUP, JDN, IO and HLT). Once
+a block has been entered `threshold` times, it is turned into a Python
+function that keeps the registers it uses in locals, and compiled. Until
+then it is run from the decoded records.
+
+Blocks work on the same registers, PC, carry flag and step count as `Emu`,
+so a run can move between engines at any block boundary.
+'''
+
+from emu import *
+
+# Ops that only write `rd`, as expressions of `ra` and `rb` (or `ib`)
+rd_exprs = {
+    Op.ADD: '({a} + {b}) & 63',
+    Op.ADDI: '({a} + {b}) & 63',
+    Op.SUB: '({a} - {b}) & 63',
+    Op.OR: '{a} | {b}',
+    Op.ORI: '{a} | {b}',
+    Op.XOR: '{a} ^ (-{b} & 63)',
+    Op.XORI: '{a} ^ {b}',
+    Op.AND: '{a} & (-{b} & 63)',
+    Op.ANDI: '{a} & {b}',
+    Op.SHL: '({a} << {b}) & 63',
+    Op.SHR: '{a} >> {b}',
+}
+
+rd_imm_ops = {Op.ADDI, Op.ORI, Op.XORI, Op.ANDI}
+
+cm_exprs = {
+    Cm.TR: 'True',
+    Cm.FA: 'False',
+    Cm.EQ: '{l} == {r}',
+    Cm.NE: '{l} != {r}',
+    Cm.UL: '{l} < {r}',
+    Cm.UG: '{l} > {r}',
+}
+
+exit_ops = {Op.HLT, Op.JUP, Op.JDN, Op.IO}
+
+
+def no_label(key):
+    raise ValueError('Couldn''t find label: {}'.format(key))
+
+
+def jump_table(tape, pos, reverse):
+    '''
+    Targets of the jump at `pos` for every register value and carry flag,
+    indexed by `(value << 1) | cf`. Missing labels are -1.
+    '''
+    partial_key = tape[pos].partial_jump_key()
+    ans = []
+    for v in range(64):
+        for cf in [False, True]:
+            i = tape.find_label((partial_key, v), cf, pos, reverse)
+            ans.append(-1 if i is None else i)
+    return ans
+
+
+class BlockGen:
+    '''
+    Generates the body of the function for the block `tape[start:end]`.
+
+    Registers are read into locals `r0`..`r63` on first use and written back
+    to the register list `r` before anything that could look at it. The
+    carry flag is kept in the local `cf` the same way.
+
+    Anything that isn't plain Python (tables, jump targets) is hoisted into
+    `consts`, which maps an expression to the name it is bound to.
+    '''
+
+    def __init__(self, tape, start, end, consts):
+        self.tape = tape
+        self.start, self.end = start, end
+        self.consts = consts
+
+        self.lines = []
+        self.loaded = set()
+        self.dirty = set()
+        self.cf_loaded = False
+        self.cf_dirty = False
+
+    def emit(self, line, indent=1):
+        self.lines.append('    ' * indent + line)
+
+    def const(self, expr):
+        if expr not in self.consts:
+            self.consts[expr] = 'k{}'.format(len(self.consts))
+        return self.consts[expr]
+
+    def reg(self, i):
+        '''Expression for reading register `i`'''
+        if i == 0:
+            return '0'
+        if i not in self.loaded:
+            self.emit('r{0} = r[{0}]'.format(i))
+            self.loaded.add(i)
+        return 'r{}'.format(i)
+
+    def cf(self):
+        if not self.cf_loaded:
+            self.emit('cf = emu.cf')
+            self.cf_loaded = True
+        return 'cf'
+
+    def flush(self):
+        for i in sorted(self.dirty):
+            self.emit('r[{0}] = r{0}'.format(i))
+        self.dirty.clear()
+
+        if self.cf_dirty:
+            self.emit('emu.cf = cf')
+            self.cf_dirty = False
+
+    def guard(self, ins):
+        '''Open an `if` for conditional instructions. Returns the indent.'''
+        if ins.cond == Cond.UN:
+            return 1
+
+        cf = self.cf()
+        if ins.cond == Cond.TR:
+            self.emit('if {}:'.format(cf))
+        else:
+            self.emit('if not {}:'.format(cf))
+        return 2
+
+    def set_reg(self, ins, rd, expr):
+        if ins.cond != Cond.UN:
+            # The local needs a value even if the write is skipped
+            self.reg(rd)
+
+        indent = self.guard(ins)
+        self.emit('r{} = {}'.format(rd, expr), indent)
+        self.loaded.add(rd)
+        self.dirty.add(rd)
+
+    def set_cf(self, ins, expr):
+        indent = self.guard(ins)
+        self.emit('cf = {}'.format(expr), indent)
+        self.cf_loaded = True
+        self.cf_dirty = True
+
+    def steps(self, n):
+        if n != 0:
+            self.emit('emu.steps += {}'.format(n))
+
+    def gen_cmp(self, ins):
+        (cmp_type, cm, a, b) = ins.as_cmp()
+        if cmp_type == CmpType.RA_RB:
+            left, right = self.reg(a), self.reg(b)
+        elif cmp_type == CmpType.RB_RA:
+            left, right = self.reg(b), self.reg(a)
+        elif cmp_type == CmpType.RA_IB:
+            left, right = self.reg(a), str(b)
+        elif cmp_type == CmpType.IA_RB:
+            left, right = str(a), self.reg(b)
+
+        if cm in cm_exprs:
+            expr = cm_exprs[cm].format(l=left, r=right)
+        else:
+            t = self.const('CMP[{}]'.format(cm))
+            expr = '{}[({} << 6) | {}]'.format(t, left, right)
+
+        self.set_cf(ins, expr)
+
+    def gen_shi(self, ins):
+        (shi_type, rd, ra, ib) = ins.as_shi()
+        if rd == 0:
+            return
+
+        a = self.reg(ra)
+        if shi_type == ShiType.SHLI:
+            expr = '({} << {}) & 63'.format(a, ib)
+        elif shi_type == ShiType.SHRI:
+            expr = '{} >> {}'.format(a, ib)
+        else:
+            t = self.const('SHI[{}][{}]'.format(shi_type, ib))
+            expr = '{}[{}]'.format(t, a)
+
+        self.set_reg(ins, rd, expr)
+
+    def gen_fm(self, ins):
+        (fm_type, pr, rd, ra) = ins.as_fm()
+        if rd == 0:
+            return
+
+        t = self.const('fm_table({}, {})'.format(fm_type, pr))
+        expr = '{}[({} << 6) | {}]'.format(t, self.reg(rd), self.reg(ra))
+        self.set_reg(ins, rd, expr)
+
+    def gen_ld(self, ins):
+        rd, ra, ib = ins.a, ins.b, ins.c
+        if rd == 0:
+            return
+
+        # The source register isn't known until runtime, so the register list
+        # has to be up to date
+        a = self.reg(ra)
+        self.flush()
+        self.set_reg(ins, rd, 'r[({} + {}) & 63]'.format(a, ib))
+
+    def gen_st(self, ins):
+        rs, ra, ib = ins.a, ins.b, ins.c
+        s, a = self.reg(rs), self.reg(ra)
+        self.flush()
+
+        indent = self.guard(ins)
+        self.emit('i = ({} + {}) & 63'.format(a, ib), indent)
+        self.emit('if i:', indent)
+        self.emit('r[i] = {}'.format(s), indent + 1)
+
+        # Any register could have changed
+        self.loaded.clear()
+
+    def gen_ref(self, pos, ins):
+        '''Anything else goes through `Emu.execute`'''
+        t = self.const('Ins.from_values({}, {}, {}, {}, {})'.format(
+            ins.op, ins.cond, ins.a, ins.b, ins.c))
+        self.flush()
+        self.emit('emu.pc = {}'.format(pos))
+        self.emit('emu.execute({})'.format(t))
+        self.loaded.clear()
+        self.cf_loaded = False
+
+    def gen_jump(self, pos, ins, n, next_pc):
+        reverse = ins.op == Op.JDN
+        c = self.reg(ins.c)
+        self.cf()
+        self.flush()
+        self.steps(n)
+
+        table = jump_table(self.tape, pos, reverse)
+        t = self.const(repr(table))
+
+        indent = self.guard(ins)
+        self.emit('pc = {}[({} << 1) | cf]'.format(t, c), indent)
+        self.emit('if pc < 0:', indent)
+        self.emit('emu.pc = {}'.format(pos), indent + 1)
+        self.emit('no_label(({}, {}))'.format(ins.partial_jump_key(), c),
+                  indent + 1)
+        # Tables instead of label searches, so only the jump is counted
+        self.emit('emu.stats.jumps += 1', indent)
+        if pos in self.tape.busy_waits():
+            # The clock sees the steps before the jump, like `Emu.op_jup`
+            self.emit('emu.steps -= 1', indent)
+            self.emit('emu.clock_model.wait(emu)', indent)
+            self.emit('emu.steps += 1', indent)
+        self.emit('return pc', indent)
+        if ins.cond != Cond.UN:
+            self.emit('return {}'.format(next_pc))
+
+    def gen_io(self, pos, ins, n, next_pc):
+        (rd, ix, rs) = ins.as_io()
+        func = Emu.op_io_switch.get(ix, Emu.io_unknown)
+
+        if ins.cond != Cond.UN:
+            self.cf()
+        self.flush()
+        self.steps(n - 1)
+        self.emit('emu.pc = {}'.format(pos))
+
+        indent = self.guard(ins)
+        self.emit('emu.{}({}, {}, {})'.format(
+            func.__name__, rd, self.const(str(ix)), rs), indent)
+        self.steps(1)
+        self.emit('return {}'.format(next_pc))
+
+    def gen_hlt(self, ins, n, next_pc):
+        if ins.cond != Cond.UN:
+            self.cf()
+        self.flush()
+        self.steps(n)
+
+        indent = self.guard(ins)
+        self.emit('emu.halted = True', indent)
+        self.emit('return {}'.format(next_pc))
+
+    def gen(self):
+        '''Generate the body, returning the list of lines'''
+        n = self.end - self.start
+        next_pc = self.end % len(self.tape)
+
+        for pos in range(self.start, self.end):
+            ins = self.tape[pos]
+            op = ins.op
+
+            if op in rd_exprs:
+                if ins.a != 0:
+                    a = self.reg(ins.b)
+                    b = str(ins.c) if op in rd_imm_ops else self.reg(ins.c)
+                    self.set_reg(ins, ins.a, rd_exprs[op].format(a=a, b=b))
+            elif op == Op.LBL:
+                pass
+            elif op == Op.CMP and (ins.a >> 3) in {t.value for t in CmpType}:
+                self.gen_cmp(ins)
+            elif op == Op.SHI and (ins.c >> 3) in {t.value for t in ShiType}:
+                self.gen_shi(ins)
+            elif op == Op.FM and (ins.c >> 4) in {t.value for t in FmType}:
+                self.gen_fm(ins)
+            elif op == Op.LD:
+                self.gen_ld(ins)
+            elif op == Op.ST:
+                self.gen_st(ins)
+            elif op in {Op.JUP, Op.JDN}:
+                self.gen_jump(pos, ins, n, next_pc)
+                return self.lines
+            elif op == Op.IO and ins.b in {d.value for d in IoDevice}:
+                self.gen_io(pos, ins, n, next_pc)
+                return self.lines
+            elif op == Op.HLT:
+                self.gen_hlt(ins, n, next_pc)
+                return self.lines
+            else:
+                self.gen_ref(pos, ins)
+
+        self.flush()
+        self.steps(n)
+        self.emit('return {}'.format(next_pc))
+        return self.lines
+
+
+class Blocks:
+    '''Basic blocks of a tape, compiled as they get hot'''
+
+    def __init__(self, tape):
+        self.tape = tape
+        self.code = tape.decoded()
+
+        n = len(tape)
+        self.leaders = {0}
+        for i, ins in enumerate(tape.data):
+            if ins.op == Op.LBL:
+                self.leaders.add(i)
+            elif ins.op in exit_ops and i + 1 < n:
+                self.leaders.add(i + 1)
+
+        self.funcs = {}  # Block start -> compiled function
+        self.sources = {}  # Block start -> generated source
+        self.ends = {}  # Block start -> end when it was compiled
+        self.counts = {}  # Block start -> times entered before compiling
+
+        # Constants shared by the generated code of all blocks
+        self.consts = {}
+        self.ns = dict(globals())
+
+    def end(self, start):
+        '''End (exclusive) of the block starting at `start`'''
+        i = start
+        while True:
+            if self.tape[i].op in exit_ops:
+                return i + 1
+            i += 1
+            if i == len(self.tape) or i in self.leaders:
+                return i
+
+    def compile(self, start):
+        end = self.end(start)
+        n_consts = len(self.consts)
+        body = BlockGen(self.tape, start, end, self.consts).gen()
+
+        # Bind any new constants, in the order they were added
+        prelude = []
+        for expr, name in list(self.consts.items())[n_consts:]:
+            prelude.append('{} = {}'.format(name, expr))
+
+        name = 'block_{}'.format(start)
+        src = '\n'.join(
+            prelude + ['def {}(emu, r):'.format(name)] + body) + '\n'
+        exec(compile(src, '<{}>'.format(name), 'exec'), self.ns)
+
+        self.sources[start] = src
+        self.ends[start] = end
+        self.funcs[start] = self.ns[name]
+        return self.funcs[start]
+
+    def invalidate(self, start, end):
+        '''
+        Forget compiled blocks overlapping `tape[start:end]`, after it was
+        replaced by the same number of instructions with no labels.
+        '''
+        # An exit op at `end - 1` can start a block at `end`
+        for i in range(start, min(end + 1, len(self.tape))):
+            self.leaders.discard(i)
+            if i == 0 or self.tape[i].op == Op.LBL or \
+                    self.tape[i - 1].op in exit_ops:
+                self.leaders.add(i)
+
+        for s, e in list(self.ends.items()):
+            if s < end and e > start:
+                del self.funcs[s]
+                del self.sources[s]
+                del self.ends[s]
+
+    def interpret(self, emu, start):
+        '''Run the block at `start` from the decoded records'''
+        code = self.code
+        for pc in range(start, self.end(start)):
+            emu.pc = pc
+            handler, cond, a, b, c = code[pc]
+            if cond == 0 or (cond == 1) == emu.cf:
+                handler(emu, a, b, c)
+            emu.steps += 1
+
+        # A taken jump leaves the PC just before its target
+        return (emu.pc + 1) % len(code)
+
+    def cold(self, emu, threshold):
+        '''Run a block that isn't compiled yet, returning the next PC'''
+        start = emu.pc
+        count = self.counts.get(start, 0) + 1
+        self.counts[start] = count
+        if count < threshold:
+            return self.interpret(emu, start)
+
+        return self.compile(start)(emu, emu.regs.data)
+
+
+def run_blocks(emu, threshold=2):
+    '''
+    Run `emu` until halted, one basic block at a time. Blocks are compiled
+    once they have been entered `threshold` times.
+    '''
+    blocks = emu.tape.blocks()
+    funcs = blocks.funcs
+    r = emu.regs.data
+
+    while not emu.halted:
+        func = funcs.get(emu.pc)
+        if func is None:
+            emu.pc = blocks.cold(emu, threshold)
+        else:
+            emu.pc = func(emu, r)
+
+        if emu.steps >= emu.check_at:
+            emu.check_in()
@@ -0,0 +1,317 @@
+'''
+Differential checker between engines.
+
+Two machines run the same tape with the same serial input and a
+`VirtualClock`, each on its own engine, and are brought to the same `steps`
+at every sync point. There their states are compared as digests: PC, carry
+flag, registers, `mem.addr`, the memory pages written so far, serial output
+and the GPU framebuffer. With `sync=1` and two engines that stop exactly
+(`ref` and `decoded`) this is a lockstep check, except that a pair of
+instructions fused by `Tape.fused` is only checked as a whole.
+
+Engines that compile blocks or loops only stop at the end of one, so the
+machines are synced where both can stop. On a mismatch, both machines go back
+to the last sync point that matched and are bisected down to the smallest
+window the engines allow, which is disassembled for the report.
+'''
+
+import argparse
+import collections
+import hashlib
+import io
+import os
+import sys
+import tempfile
+
+from emu import *
+from gpu import HeadlessGpu
+import transpile
+
+# Instructions per virtual centisecond
+ins_per_cs = 1000
+
+# Most instructions shown in a report, from the end of the window
+window_size = 32
+
+
+class Machine:
+    '''One side of the check: a machine, its engine and where it can restart'''
+
+    def __init__(self, tape, engine, script, use_gpu, module_filename):
+        self.tape = tape
+        self.engine = engine
+        self.script = script
+        self.use_gpu = use_gpu
+        self.module_filename = module_filename
+        self.emu = self.new_emu()
+
+    def new_emu(self):
+        emu = Emu(clock=VirtualClock(ins_per_cs),
+                  gpu_backend=HeadlessGpu() if self.use_gpu else None)
+        emu.tape = self.tape
+        emu.filename = self.module_filename
+        emu.buffer = self.script
+        emu.get_input = get_input
+        emu.out = io.StringIO()
+        return emu
+
+    def restart(self, snapshot, out):
+        '''Go back to `snapshot`, with `out` written so far'''
+        self.emu = self.new_emu()
+        self.emu.restore(snapshot)
+        self.emu.out.write(out)
+
+    def run_to(self, steps):
+        '''Run until at least `steps`, or halted'''
+        emu = self.emu
+        while not emu.halted and emu.steps < steps:
+            emu.run(engine=self.engine, max_steps=steps - emu.steps)
+
+
+def get_input():
+    # Nothing more after the script
+    raise EOFError
+
+
+def digest(emu):
+    '''Hash of the machine state that the engines must agree on'''
+    h = hashlib.blake2b(digest_size=16)
+    h.update(bytes(emu.regs.data))
+    h.update('{} {} {} {}'.format(
+        emu.pc, emu.cf, emu.halted, emu.mem.addr).encode())
+    for n in sorted(emu.mem.pages):
+        page = emu.mem.pages[n]
+        # Pages that were only written with zeros read the same as none
+        if any(page):
+            h.update(n.to_bytes(2, 'little'))
+            h.update(page)
+    h.update(emu.out.getvalue().encode())
+    if emu.use_gpu:
+        (x, y, pixels) = emu.gpu.snapshot()
+        h.update(bytes([x, y]))
+        h.update(pixels)
+    return h.digest()
+
+
+def differences(a, b):
+    '''List of `(what, value in a, value in b)` where `a` and `b` differ'''
+    ans = []
+    for name in ['pc', 'cf', 'halted', 'steps']:
+        if getattr(a, name) != getattr(b, name):
+            ans.append((name, getattr(a, name), getattr(b, name)))
+    for i in range(64):
+        if a.regs[i] != b.regs[i]:
+            ans.append(('r{}'.format(i), a.regs[i], b.regs[i]))
+    if a.mem.addr != b.mem.addr:
+        ans.append(('mem.addr', a.mem.addr, b.mem.addr))
+    for n in sorted(set(a.mem.pages) | set(b.mem.pages)):
+        base = n << Mem.page_bits
+        pa = a.mem[base:base + Mem.page_size]
+        pb = b.mem[base:base + Mem.page_size]
+        if pa != pb:
+            i = next(i for i in range(Mem.page_size) if pa[i] != pb[i])
+            ans.append(('mem[{}]'.format(base + i), pa[i], pb[i]))
+    (out_a, out_b) = (a.out.getvalue(), b.out.getvalue())
+    if out_a != out_b:
+        ans.append(('out', out_a[-16:], out_b[-16:]))
+    if a.use_gpu and a.gpu.snapshot() != b.gpu.snapshot():
+        ans.append(('gpu', 'framebuffer', 'framebuffer'))
+    return ans
+
+
+class Mismatch:
+    '''
+    Where two engines disagreed: their states matched at `good` steps and
+    didn't at `bad`.
+    '''
+
+    def __init__(self, engines, good, bad, diffs, window):
+        self.engines = engines
+        self.good = good
+        self.bad = bad
+        self.diffs = diffs  # From `differences`, at `bad`
+        # `(steps, pc)` for what the reference interpreter ran up to `bad`,
+        # ending with the window and what led up to it
+        self.window = window
+
+    def report(self, tape):
+        lines = ['{} and {} differ after {} steps, matched after {}'.format(
+            *self.engines, self.bad, self.good)]
+        for (what, a, b) in self.diffs:
+            lines.append('  {}: {!r} != {!r}'.format(what, a, b))
+        for (steps, pc) in self.window:
+            lines.append('{} {:>10} {:0>4}: {}'.format(
+                '>' if steps >= self.good else ' ', steps, pc,
+                Disasm.disasm(tape[pc])))
+        return '\n'.join(lines)
+
+
+class Checker:
+    '''
+    Runs `engines` (two names for `Emu.run`) side by side on `tape`. See
+    `check`.
+    '''
+
+    def __init__(self, tape, engines=('ref', 'decoded'), script='',
+                 use_gpu=False, module_filename=None):
+        self.tape = tape
+        self.engines = tuple(engines)
+        self.machines = [
+            Machine(tape, engine, script, use_gpu, module_filename)
+            for engine in engines
+        ]
+        self.input_ran_out = False
+
+    def sync(self, steps):
+        '''
+        Run both machines to the first point after `steps` where they can
+        both stop. Returns whether they got there; they might halt first.
+        '''
+        (a, b) = self.machines
+        a.run_to(steps)
+        b.run_to(steps)
+        while a.emu.steps != b.emu.steps:
+            (behind, ahead) = sorted(self.machines, key=lambda m: m.emu.steps)
+            if behind.emu.halted:
+                return False
+            behind.run_to(ahead.emu.steps)
+        return True
+
+    def checkpoint(self):
+        return [(m.emu.snapshot(), m.emu.out.getvalue())
+                for m in self.machines]
+
+    def restart(self, checkpoint):
+        for (m, (snapshot, out)) in zip(self.machines, checkpoint):
+            m.restart(snapshot, out)
+
+    def matches(self):
+        (a, b) = self.machines
+        return a.emu.steps == b.emu.steps and \
+            digest(a.emu) == digest(b.emu)
+
+    def check(self, max_steps, sync=10000):
+        '''
+        Run for `max_steps`, comparing every `sync` steps or at the next point
+        after where both engines can stop. Returns a `Mismatch`, or None if
+        they agreed until then or until both halted.
+        '''
+        good = self.checkpoint()
+        good_steps = 0
+        try:
+            while True:
+                steps = min(good_steps + sync, max_steps)
+                synced = self.sync(steps)
+                if not synced or not self.matches():
+                    return self.locate(good, good_steps)
+
+                good = self.checkpoint()
+                good_steps = self.machines[0].emu.steps
+                if self.machines[0].emu.halted or good_steps >= max_steps:
+                    return None
+        except EOFError:
+            # Runs past the end of the input can't be compared
+            self.input_ran_out = True
+            return None
+
+    def locate(self, good, good_steps):
+        '''
+        Bisect between `good`, a checkpoint at `good_steps` where the machines
+        matched, and where they are now, which they didn't
+        '''
+        bad_steps = max(m.emu.steps for m in self.machines)
+        diffs = differences(*(m.emu for m in self.machines))
+
+        lo = good_steps
+        hi = bad_steps
+        while hi - lo > 1:
+            self.restart(good)
+            mid = (lo + hi) // 2
+            synced = self.sync(mid)
+            steps = max(m.emu.steps for m in self.machines)
+            if synced and self.matches():
+                if steps <= lo:
+                    break
+                lo = steps
+            else:
+                if steps >= hi:
+                    break
+                hi = steps
+                diffs = differences(*(m.emu for m in self.machines))
+
+        # The decoded engine runs a fused pair as one, except for the last
+        # step before it stops, so a pair that starts just before `lo` hasn't
+        # been checked on its own
+        if 'decoded' in self.engines:
+            lo = max(good_steps, lo - 1)
+
+        # What the reference interpreter runs in the window
+        emu = Emu(clock=VirtualClock(ins_per_cs))
+        emu.tape = self.tape
+        emu.get_input = get_input
+        emu.out = io.StringIO()
+        emu.restore(good[0][0])
+        window = collections.deque(maxlen=window_size)
+        try:
+            while not emu.halted and emu.steps < hi:
+                window.append((emu.steps, emu.pc))
+                emu.step()
+        except EOFError:
+            pass
+
+        return Mismatch(self.engines, lo, hi, diffs, list(window))
+
+
+def check(tape, engines=('ref', 'decoded'), max_steps=10**6, sync=10000,
+          script='', use_gpu=False, module_filename=None):
+    '''
+    Run `tape` on both `engines` and return the first `Mismatch`, or None.
+    `module_filename` is the module from `transpile.py` for the `aot` engine,
+    without the `.py`; one is built if needed.
+    '''
+    if 'aot' in engines and module_filename is None:
+        with tempfile.TemporaryDirectory() as d:
+            module_filename = os.path.join(d, 'tape')
+            transpile.transpile_to_file(tape, module_filename + '.py')
+            return Checker(tape, engines, script, use_gpu,
+                           module_filename).check(max_steps, sync)
+
+    return Checker(tape, engines, script, use_gpu,
+                   module_filename).check(max_steps, sync)
+
+
+def main():
+    from bench import benchmarks, roms_dir
+
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('roms', nargs='*', default=list(benchmarks))
+    parser.add_argument('--engines', nargs='+',
+                        default=['decoded', 'block', 'trace', 'aot'],
+                        help='Engines to check against the reference')
+    parser.add_argument('--against', default='ref',
+                        help='Engine to check them against')
+    parser.add_argument('--steps', type=int, default=10 ** 6)
+    parser.add_argument('--sync', type=int, default=10000,
+                        help='Steps between comparisons')
+    args = parser.parse_args()
+
+    failed = False
+    for rom in args.roms:
+        (script, use_gpu) = benchmarks.get(os.path.basename(rom), ('', False))
+        filename = rom if os.path.exists(rom) else os.path.join(roms_dir, rom)
+        tape = Emu.from_filename(filename).tape
+        for engine in args.engines:
+            mismatch = check(tape, (args.against, engine), args.steps,
+                             args.sync, script, use_gpu)
+            if mismatch is None:
+                print('{} {}: ok'.format(rom, engine))
+            else:
+                failed = True
+                print('{} {}: {}'.format(rom, engine, mismatch.report(tape)))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
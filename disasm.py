@@ -149,18 +149,25 @@ class Disasm:
         return disasm_func(ins)
 
     @staticmethod
-    def disasm_tape(tape, out=sys.stdout, raw=False):
+    def disasm_tape(tape, out=sys.stdout, raw=False, profile=None):
+        '''With `profile`, each line is annotated with its counts'''
+        if profile is not None:
+            notes = profile.annotations()
+
         for i in range(len(tape)):
             ins = tape[i]
             if raw:
                 out.write(str(ins) + '\n')
+            elif profile is not None:
+                out.write('{:0>4}: {} {}\n'.format(
+                    i, notes[i], Disasm.disasm(ins)))
             else:
                 out.write('{:0>4}: {}\n'.format(i, Disasm.disasm(ins)))
 
     @staticmethod
-    def disasm_tape_to_file(tape, filename, raw=False):
+    def disasm_tape_to_file(tape, filename, raw=False, profile=None):
         with open(filename, 'w') as f:
-            Disasm.disasm_tape(tape, f, raw)
+            Disasm.disasm_tape(tape, f, raw, profile)
 
 
 if __name__ == '__main__':
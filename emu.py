@@ -1,20 +1,47 @@
 import base64
+import bisect
+import collections
+import hashlib
+import io
+import json
 import logging
+import os
+import random
+import struct
 import sys
+import threading
 from string import digits, ascii_uppercase
 import traceback
 import time
 
 from ins import *
+from alu import *
 from disasm import *
 import gpu
 
 
+# Longest loop that `Tape.is_busy_wait` looks for
+max_busy_wait_len = 16
+
+
 class Tape:
     '''
     Tape is just a looped array of instructions.
     '''
 
+    def __init__(self):
+        self.data = []
+
+        # Derived from `self.data` on demand. See `Tape.decoded`,
+        # `Tape.fused`, `Tape.labels`, `Tape.busy_waits`, `Tape.blocks` and
+        # `Tape.traces`.
+        self._decoded = None
+        self._fused = None
+        self._labels = None
+        self._busy_waits = None
+        self._blocks = None
+        self._traces = None
+
     @classmethod
     def from_inss(cls, inss):
         '''Create tape from instructions'''
@@ -37,6 +64,249 @@ class Tape:
         ans = [ins.to_bytes() for ins in self.data]
         return b''.join(ans)
 
+    def sha256(self):
+        return hashlib.sha256(self.to_bytes()).hexdigest()
+
+    def decoded(self):
+        '''Per-PC records from `Emu.decode`, built once per tape'''
+        if self._decoded is None:
+            self._decoded = [self.decode_at(i) for i in range(len(self.data))]
+        return self._decoded
+
+    def decode_at(self, i):
+        rec = Emu.decode(self.data[i])
+        if i in self.busy_waits():
+            rec = (Emu.dop_jup_wait,) + rec[1:]
+        return rec
+
+    def fused(self):
+        '''
+        Same as `decoded`, except that the first of each pair of instructions
+        that `Emu.fuse` recognizes runs both. The second keeps its own record
+        for when it's jumped to. Used by `Emu.run_decoded`.
+        '''
+        if self._fused is None:
+            code = self.decoded()
+            self._fused = list(code)
+            for i in range(len(code) - 1):
+                rec = Emu.fuse(code[i], code[i + 1])
+                if rec is not None:
+                    self._fused[i] = rec
+        return self._fused
+
+    def labels(self):
+        '''
+        Label index: maps `(label_key, cf)` to the sorted positions of the
+        labels with that key which execute when the carry flag is `cf`.
+        '''
+        if self._labels is None:
+            self._labels = {}
+            for i, ins in enumerate(self.data):
+                for k in Tape.label_index_keys(ins):
+                    self._labels.setdefault(k, []).append(i)
+
+        return self._labels
+
+    def busy_waits(self):
+        '''Positions of the JUPs closing busy-wait loops, see `is_busy_wait`'''
+        if self._busy_waits is None:
+            self._busy_waits = {
+                i for i in range(len(self.data)) if self.is_busy_wait(i)
+            }
+        return self._busy_waits
+
+    def is_busy_wait(self, i):
+        '''
+        Whether the instruction at `i` is a JUP back to a loop of at most
+        `max_busy_wait_len` instructions, which reads the clock and only
+        computes registers and the carry flag from it. Each time around, such
+        a loop does the same thing until the clock changes.
+        '''
+        ins = self.data[i]
+        if ins.op != Op.JUP or ins.c != 0:
+            return False
+
+        # Where it jumps to can't depend on the carry flag either
+        key = (ins.partial_jump_key(), 0)
+        cfs = {Cond.UN: [False, True], Cond.TR: [True], Cond.FA: [False]}
+        targets = {self.find_label(key, cf, i) for cf in cfs[ins.cond]}
+        if len(targets) != 1:
+            return False
+        (target,) = targets
+        if target is None or not i - max_busy_wait_len <= target < i:
+            return False
+
+        reads_clock = False
+        written = set()
+        live_in = set()  # Registers read before being written in the loop
+        for ins in self.data[target + 1:i]:
+            if ins.op == Op.LBL:
+                continue
+            if ins.cond != Cond.UN:
+                return False
+
+            if ins.op == Op.IO:
+                if ins.b not in {IoDevice.CLOCK_LO_CS.value,
+                                 IoDevice.CLOCK_HI_CS.value} or ins.c != 0:
+                    return False
+                reads_clock = True
+                reads = set()
+            elif ins.op == Op.CMP and \
+                    (ins.a >> 3) in {t.value for t in CmpType}:
+                (cmp_type, cm_, a, b) = ins.as_cmp()
+                reads = {
+                    CmpType.RA_RB: {a, b},
+                    CmpType.RB_RA: {a, b},
+                    CmpType.RA_IB: {a},
+                    CmpType.IA_RB: {b},
+                }[cmp_type]
+            elif ins.op in Emu.dop_rrr_switch:
+                reads = {ins.b, ins.c}
+            elif ins.op in Emu.dop_rri_rows or (
+                    ins.op == Op.SHI and
+                    (ins.c >> 3) in {t.value for t in ShiType}):
+                reads = {ins.b}
+            else:
+                return False
+
+            live_in |= reads - written
+            if ins.op != Op.CMP:
+                written.add(ins.a)
+
+        written.discard(0)
+        return reads_clock and not (live_in & written)
+
+    @staticmethod
+    def label_index_keys(ins):
+        '''Keys of `Tape.labels` that `ins` is listed under'''
+        if ins.op != Op.LBL:
+            return []
+
+        key = ins.label_key()
+        return [
+            (key, cf) for cf in [False, True]
+            if (ins.cond == Cond.UN) or
+            (ins.cond == Cond.TR and cf) or
+            (ins.cond == Cond.FA and not cf)
+        ]
+
+    def find_label(self, key, cf, start, reverse=False):
+        '''
+        Position of the nearest label matching `key` under carry flag `cf`,
+        searching upwards from `start` (or downwards if `reverse`) and
+        wrapping around. None if there is no such label.
+        '''
+        ps = self.labels().get((key, cf), [])
+        if reverse:
+            i = bisect.bisect_right(ps, start)
+            if i < len(ps):
+                return ps[i]
+            elif ps and ps[0] != start:
+                # Wrap around to the top
+                return ps[0]
+        else:
+            i = bisect.bisect_left(ps, start) - 1
+            if i >= 0:
+                return ps[i]
+            elif ps and ps[-1] != start:
+                # Wrap around to the bottom
+                return ps[-1]
+
+        return None
+
+    def blocks(self):
+        '''Basic blocks and their compiled code, see `compiler.Blocks`'''
+        if self._blocks is None:
+            import compiler
+            self._blocks = compiler.Blocks(self)
+        return self._blocks
+
+    def traces(self):
+        '''Hot loop traces and their compiled code, see `jit.Traces`'''
+        if self._traces is None:
+            import jit
+            self._traces = jit.Traces(self)
+        return self._traces
+
+    # Patching
+    #
+    # These change the tape in place, e.g. while an `Emu` running it is
+    # paused. The derived data is updated for the changed range only, except
+    # that compiled blocks and traces are all dropped when positions shift or
+    # labels change, since jump targets are compiled into them. The PC of a
+    # paused `Emu` isn't adjusted.
+
+    def replace(self, i, inss):
+        '''Overwrite the instructions from `i` with `inss`'''
+        self.patch(i, i + len(inss), inss)
+
+    def insert(self, i, inss):
+        '''Insert `inss` before position `i`'''
+        self.patch(i, i, inss)
+
+    def delete(self, i, n=1):
+        '''Delete `n` instructions from `i`'''
+        self.patch(i, i + n, [])
+
+    def patch(self, start, end, inss):
+        '''Replace `self.data[start:end]` with `inss`'''
+        old = self.data[start:end]
+        self.data[start:end] = inss
+        new_end = start + len(inss)
+        delta = new_end - end
+        n = len(self.data)
+
+        labels_changed = any(ins.op == Op.LBL for ins in old + inss)
+        if self._labels is not None and (labels_changed or delta != 0):
+            for k, ps in self._labels.items():
+                lo = bisect.bisect_left(ps, start)
+                hi = bisect.bisect_left(ps, end)
+                ps[lo:] = [p + delta for p in ps[hi:]]
+            for i in range(start, new_end):
+                for k in Tape.label_index_keys(self.data[i]):
+                    bisect.insort(self._labels.setdefault(k, []), i)
+            self._labels = {k: ps for k, ps in self._labels.items() if ps}
+
+        # Busy waits are short, so only the ones near the range can change
+        lo = max(start - max_busy_wait_len, 0)
+        hi = min(new_end + max_busy_wait_len, n)
+        changed_waits = set()
+        if self._busy_waits is not None:
+            waits = {
+                p if p < start else p + delta
+                for p in self._busy_waits if not start <= p < end
+            }
+            for i in range(lo, hi):
+                if (i in waits) != self.is_busy_wait(i):
+                    waits ^= {i}
+                    changed_waits.add(i)
+            self._busy_waits = waits
+
+        if self._decoded is not None:
+            self._decoded[start:end] = [None] * len(inss)
+            for i in range(lo, hi):
+                self._decoded[i] = self.decode_at(i)
+
+        if self._fused is not None:
+            # The pairs starting just before the range up to its last
+            # instruction could have changed
+            self._fused[start:end] = [None] * len(inss)
+            for i in range(max(lo - 1, 0), hi):
+                rec = None
+                if i + 1 < n:
+                    rec = Emu.fuse(self._decoded[i], self._decoded[i + 1])
+                self._fused[i] = self._decoded[i] if rec is None else rec
+
+        if labels_changed or delta != 0:
+            self._blocks = None
+            self._traces = None
+        else:
+            for (i, j) in [(start, end)] + [(p, p + 1) for p in changed_waits]:
+                if self._blocks is not None:
+                    self._blocks.invalidate(i, j)
+                if self._traces is not None:
+                    self._traces.invalidate(i, j)
+
     def __getitem__(self, i):
         return self.data[i]
 
@@ -50,20 +320,22 @@ class Tape:
 class Regs:
     '''
     64 registers that are 6-bit elements each.
+
+    Backed by a bytearray. Reads aren't checked to be 6-bit, see
+    `CheckedRegs`. Slicing returns a bytearray copy of the registers.
     '''
 
     def __init__(self):
-        self.data = [0] * 64
+        self.data = bytearray(64)
 
     def dump(self):
         n = 8
         for i in range(0, len(self.data), n):
-            xs = self.data[i:i + n]
+            xs = self[i:i + n]
             xs = [str(x).rjust(2) for x in xs]
             print(' '.join(xs))
 
     def __getitem__(self, i):
-        assert 0 <= self.data[i] < 64
         return self.data[i]
 
     def __setitem__(self, i, v):
@@ -76,71 +348,88 @@ class Regs:
 
 class Mem:
     '''
-    2**18 16-bit words.
+    2**18 6-bit words.
+
+    Stored sparsely in pages of `page_size` words, which are allocated on the
+    first write to them. Untouched words read as 0. Reads aren't checked to
+    be 6-bit, see `CheckedMem`. Slicing returns a bytearray copy of the
+    words.
     '''
 
+    page_bits = 12
+    page_size = 1 << page_bits
+    size = 2**18
+
     def __init__(self):
-        self.data = [0] * (2**18)
-        self.addr = 0  # 18-bit index for `self.data`
+        self.pages = {}  # Page number -> bytearray of `page_size` words
+        self.addr = 0  # 18-bit word index
+
+    def page(self, n):
+        '''Page number `n`, allocating it if needed'''
+        page = self.pages.get(n)
+        if page is None:
+            page = self.pages[n] = bytearray(self.page_size)
+        return page
+
+    def to_bytes(self):
+        '''All of memory, one byte per word'''
+        return bytes(self[0:self.size])
 
     def dump(self):
         # Warning: very big
         n = 8
-        for i in range(0, len(self.data), n):
-            xs = self.data[i:i + n]
+        for i in range(0, self.size, n):
+            xs = self[i:i + n]
             xs = [str(x).rjust(2) for x in xs]
             print(' '.join(xs))
 
     def __getitem__(self, i):
-        assert 0 <= self.data[i] < 64
-        return self.data[i]
+        if isinstance(i, slice):
+            start, stop, stride = i.indices(self.size)
+            assert stride == 1
+            ans = bytearray(max(stop - start, 0))
+            for n, page in self.pages.items():
+                # Copy the part of the page in the slice
+                lo = max(n << self.page_bits, start)
+                hi = min((n + 1) << self.page_bits, stop)
+                if lo < hi:
+                    off = n << self.page_bits
+                    ans[lo - start:hi - start] = page[lo - off:hi - off]
+            return ans
+
+        page = self.pages.get(i >> self.page_bits)
+        if page is None:
+            return 0
+        return page[i & (self.page_size - 1)]
 
     def __setitem__(self, i, v):
-        self.data[i] = v & 0o77
+        page = self.page(i >> self.page_bits)
+        page[i & (self.page_size - 1)] = v & 0o77
 
     def __len__(self):
-        return len(self.data)
-
-
-def twos_comp(n, bits=6):
-    mask = (1 << bits) - 1
-    neg = n ^ mask
-    return (neg + 1) & mask
-
+        return self.size
 
-def to_int(n, bits=6):
-    '''Turn a two's complement number into a Python int'''
-    if (n & (1 << (bits - 1))) != 0:
-        n = n - (1 << bits)
-    return n
 
+def check_6bit(v):
+    if isinstance(v, int):
+        assert 0 <= v < 64
+    else:
+        assert all(x < 64 for x in v)
+    return v
 
-def bit_string(n, bits=6):
-    return format(n % (1 << bits), '0{}b'.format(bits))
 
+class CheckedRegs(Regs):
+    '''`Regs` that asserts every value read is 6-bit'''
 
-def from_int(n, bits=6):
-    '''Turn a Python int to a two''s complement number'''
-    return int(bit_string(n), 2)
+    def __getitem__(self, i):
+        return check_6bit(self.data[i])
 
 
-def sar(n, d, bits=6):
-    '''Arithmetic right shift'''
-    sign = n & (1 << (bits - 1))
-    if sign == 0:
-        return n >> d
-    else:
-        inv_s = max(bits - d, 0)
-        sign_mask = (1 << bits) - (1 << inv_s)
-        return (n >> d) | sign_mask
+class CheckedMem(Mem):
+    '''`Mem` that asserts every value read is 6-bit'''
 
-
-def rol(n, d, bits=6):
-    '''Rotate bits left'''
-    s = bit_string(n)
-    d = d % bits
-    s = s[-d:] + s[:-d]
-    return int(s, 2)
+    def __getitem__(self, i):
+        return check_6bit(Mem.__getitem__(self, i))
 
 
 # `x` is a placeholder for an invalid character
@@ -163,32 +452,744 @@ def serial_from_str(s):
     return bytearray([serial_from_chr(c) for c in s])
 
 
+class RealClock:
+    '''
+    Wall clock in centiseconds since the last reset.
+
+    By default the time is only looked up when the program reads the clock.
+    With `every` set, it is looked up at most once per `every` executed
+    instructions, and reads in between see the previous value.
+    '''
+
+    def __init__(self, every=None):
+        self.every = every
+        self.start = time.time()
+        self.sampled_at = None  # `Emu.steps` at the last lookup
+        self.value = 0
+
+    def reset(self, emu):
+        self.start = time.time()
+        self.sampled_at = None
+        self.value = 0
+
+    def read(self, emu):
+        if self.every is None or self.sampled_at is None or \
+                emu.steps - self.sampled_at >= self.every:
+            elapsed = time.time() - self.start
+            elapsed = round(elapsed, 2)
+            elapsed = int(elapsed * 100)
+
+            # Clock does not wrap
+            self.value = min(elapsed, 0o7777)
+            self.sampled_at = emu.steps
+
+        return self.value
+
+    def wait(self, emu):
+        '''Sleep until the clock reads a different value'''
+        elapsed = time.time() - self.start
+        time.sleep(max((int(elapsed * 100) + 1) / 100 - elapsed, 0))
+        self.sampled_at = None
+
+    def save(self, emu):
+        '''Centiseconds since the last reset, for `restore`'''
+        return int((time.time() - self.start) * 100)
+
+    def restore(self, emu, state):
+        self.start = time.time() - state / 100
+        self.sampled_at = None
+
+
+class VirtualClock:
+    '''
+    Deterministic clock where every `ins_per_cs` executed instructions take
+    one centisecond.
+
+    With `turbo`, a busy wait for the clock makes it skip ahead to the next
+    centisecond instead of running the loop until then.
+    '''
+
+    def __init__(self, ins_per_cs=1, turbo=False):
+        self.ins_per_cs = ins_per_cs
+        self.turbo = turbo
+        self.start = 0  # `Emu.steps` at the last reset
+
+    def reset(self, emu):
+        self.start = emu.steps
+
+    def read(self, emu):
+        elapsed = (emu.steps - self.start) // self.ins_per_cs
+
+        # Clock does not wrap
+        return min(elapsed, 0o7777)
+
+    def wait(self, emu):
+        if self.turbo:
+            # Move the last reset back to make the next centisecond start now
+            self.start -= self.ins_per_cs - \
+                (emu.steps - self.start) % self.ins_per_cs
+
+    def save(self, emu):
+        '''Instructions since the last reset, for `restore`'''
+        return emu.steps - self.start
+
+    def restore(self, emu, state):
+        self.start = emu.steps - state
+
+
+class StopReason(Enum):
+    '''Why `Emu.run` returned, see `Emu.stop_reason`'''
+    HALTED = 0
+    MAX_STEPS = 1
+    MAX_TIME = 2
+    CYCLE = 3
+    HOOK = 4  # A hook called `Emu.stop`, see `Hooks`
+
+
+class Watchdog:
+    '''
+    Limits on how long `Emu.run` can go for. The engines only compare
+    `Emu.steps` against `Emu.check_at` and call `Emu.check_in` once it's
+    reached, so the wall time is looked at every `every` instructions.
+    '''
+
+    every = 10000
+
+    def __init__(self, emu, max_steps=None, max_time=None):
+        self.end = None if max_steps is None else emu.steps + max_steps
+        self.deadline = None if max_time is None else time.time() + max_time
+
+    def next_check(self, emu):
+        '''Value for `Emu.check_at`'''
+        ans = float('inf')
+        if self.end is not None:
+            ans = self.end
+        if self.deadline is not None:
+            ans = min(ans, emu.steps + self.every)
+        return ans
+
+    def check(self, emu):
+        '''The limit that was reached, or None'''
+        if self.end is not None and emu.steps >= self.end:
+            return StopReason.MAX_STEPS
+        if self.deadline is not None and time.time() >= self.deadline:
+            return StopReason.MAX_TIME
+        return None
+
+
+class Stats:
+    '''
+    Live performance counters of an `Emu`, see `Emu.stats`. Everything can be
+    read from another thread while it runs.
+
+    IO instructions per device, and so serial bytes, memory reads and writes
+    and GPU draws, are counted exactly by the IO handlers, which every engine
+    calls. Jumps taken and the steps of the label searches they do are
+    counted by `Emu.find_label`, and by the compiled code for the jumps it
+    resolves with tables instead, which don't search. GPU presents are
+    counted by `Emu.reset_clock`.
+
+    Counting every instruction would slow the engines down, so `estimates` of
+    instructions per op come from sampling instead: every `interval` or so
+    instructions `Emu.check_in` attributes the instructions since the last
+    sample to the one at the PC. Engines that only check in between blocks or
+    loop iterations attribute them to the whole block or loop trace starting
+    there. They're only good for proportions over long runs, and are reported
+    apart from the counters.
+    '''
+
+    interval = 10000
+    window = 10  # Seconds of samples that `ips` averages over
+
+    def __init__(self):
+        # IO instructions executed per device. Plain attributes, since they're
+        # counted on every one.
+        self.serial_incoming = 0
+        self.serial_in = 0
+        self.serial_out = 0
+        self.clock_lo = 0
+        self.clock_hi = 0
+        self.mem_addr_lo = 0
+        self.mem_addr_mid = 0
+        self.mem_addr_hi = 0
+        self.mem_reads = 0
+        self.mem_writes = 0
+        self.gpu_x = 0
+        self.gpu_y = 0
+        self.draws = 0
+        self.unknown_io = 0
+
+        self.presents = 0
+        self.jumps = 0  # Jumps taken
+        self.label_search_steps = 0  # Steps of the `Tape.find_label` bisects
+
+        # Estimates from samples, of instructions reached whether or not their
+        # condition passed
+        self.ops = {}  # Op name -> instructions
+
+        self.by_block = False
+        self.aot_blocks = None  # `blocks` of the module the aot engine runs
+        self.by_record = False  # Fused records, see `Tape.fused`
+        self.sampled_steps = 0
+        self.samples = collections.deque()  # `(time, steps)`, oldest first
+        self.rng = random.Random(0)
+
+        self.export_thread = None
+        self.export_stop = threading.Event()
+
+    def start(self, emu, engine):
+        '''Called by `Emu.run` before it runs `engine`'''
+        self.by_block = engine in {'block', 'trace', 'aot'}
+        self.by_record = engine == 'decoded'
+        self.aot_blocks = None
+        self.sampled_steps = emu.steps
+        self.samples.append((time.time(), emu.steps))
+
+    def next_check(self, emu):
+        '''Value for `Emu.check_at`'''
+        # Jittered so that samples don't line up with loops
+        return emu.steps + self.rng.randint(self.interval // 2,
+                                            self.interval * 3 // 2)
+
+    def sample(self, emu):
+        now = time.time()
+        self.samples.append((now, emu.steps))
+        while len(self.samples) > 2 and self.samples[1][0] < now - self.window:
+            self.samples.popleft()
+
+        weight = emu.steps - self.sampled_steps
+        self.sampled_steps = emu.steps
+        if weight <= 0 or len(emu.tape) == 0:
+            return
+
+        n = len(emu.tape)
+        pc = emu.pc % n
+        # Only uses what the engine already built, never building the blocks
+        # or traces of a tape just for this
+        traces = emu.tape._traces
+        blocks = emu.tape._blocks
+        if self.by_record and emu.tape.fused()[pc] is not \
+                emu.tape.decoded()[pc]:
+            # Never stops between the two instructions
+            pcs = [pc, (pc + 1) % n]
+        elif not self.by_block:
+            pcs = [pc]
+        elif traces is not None and pc in traces.pcs:
+            pcs = traces.pcs[pc]
+        elif blocks is not None:
+            pcs = range(pc, blocks.end(pc))
+        elif self.aot_blocks is not None:
+            end = pc + 1
+            while end < n and self.aot_blocks[end] is None:
+                end += 1
+            pcs = range(pc, end)
+        else:
+            pcs = [pc]
+        for i in pcs:
+            name = emu.tape[i].op.name
+            self.ops[name] = self.ops.get(name, 0) + weight / len(pcs)
+
+    def io(self):
+        '''
+        Map of `IoDevice` name, or UNKNOWN for the rest, -> IO instructions
+        executed
+        '''
+        return {
+            'SERIAL_INCOMING': self.serial_incoming,
+            'SERIAL_READ': self.serial_in,
+            'SERIAL_WRITE': self.serial_out,
+            'CLOCK_LO_CS': self.clock_lo,
+            'CLOCK_HI_CS': self.clock_hi,
+            'MEM_ADDR_LO': self.mem_addr_lo,
+            'MEM_ADDR_MID': self.mem_addr_mid,
+            'MEM_ADDR_HI': self.mem_addr_hi,
+            'MEM_READ': self.mem_reads,
+            'MEM_WRITE': self.mem_writes,
+            'GPU_X': self.gpu_x,
+            'GPU_Y': self.gpu_y,
+            'GPU_DRAW': self.draws,
+            'UNKNOWN': self.unknown_io,
+        }
+
+    def ips(self, emu):
+        '''Instructions per second over the last `window` seconds'''
+        samples = list(self.samples)
+        if not samples:
+            return 0.0
+        (t, steps) = samples[0]
+        dt = time.time() - t
+        return (emu.steps - steps) / dt if dt > 0 else 0.0
+
+    def to_dict(self, emu):
+        ops = self.ops.copy()
+        return {
+            'instructions': emu.steps,
+            'ips': self.ips(emu),
+            'io': self.io(),
+            'jumps': self.jumps,
+            'label_search_steps': self.label_search_steps,
+            'serial_in': self.serial_in,
+            'serial_out': self.serial_out,
+            'mem_reads': self.mem_reads,
+            'mem_writes': self.mem_writes,
+            'gpu_draws': self.draws,
+            'gpu_presents': self.presents,
+            'estimates': {
+                'ops': {k: round(v) for k, v in ops.items()},
+            },
+        }
+
+    def to_json(self, emu):
+        return json.dumps(self.to_dict(emu))
+
+    def to_prometheus(self, emu):
+        '''Prometheus text exposition format'''
+        d = self.to_dict(emu)
+        lines = []
+
+        def metric(name, kind, values):
+            lines.append('# TYPE emu_{} {}'.format(name, kind))
+            for labels, value in values:
+                lines.append('emu_{}{} {}'.format(name, labels, value))
+
+        metric('instructions_total', 'counter', [('', d['instructions'])])
+        metric('instructions_per_second', 'gauge', [('', d['ips'])])
+        metric('io_instructions_total', 'counter', [
+            ('{{device="{}"}}'.format(k), v)
+            for k, v in sorted(d['io'].items())
+        ])
+        for name in ['jumps', 'label_search_steps', 'serial_in',
+                     'serial_out', 'mem_reads', 'mem_writes', 'gpu_draws',
+                     'gpu_presents']:
+            metric(name + '_total', 'counter', [('', d[name])])
+
+        # Sampled, so they aren't counters and can go down
+        metric('estimated_op_instructions', 'gauge', [
+            ('{{op="{}"}}'.format(k), v)
+            for k, v in sorted(d['estimates']['ops'].items())
+        ])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, emu, filename, fmt='json'):
+        '''Write to `filename` in `fmt`, `json` or `prometheus`, atomically'''
+        text = self.to_json(emu) if fmt == 'json' else self.to_prometheus(emu)
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, filename)
+
+    def export_every(self, emu, filename, period=10, fmt='json'):
+        '''Keep writing to `filename` every `period` seconds from a thread'''
+        self.stop_export()
+
+        def loop():
+            while not self.export_stop.wait(period):
+                self.write(emu, filename, fmt)
+
+        self.export_stop.clear()
+        self.export_thread = threading.Thread(target=loop, daemon=True)
+        self.export_thread.start()
+
+    def stop_export(self):
+        if self.export_thread is not None:
+            self.export_stop.set()
+            self.export_thread.join()
+            self.export_thread = None
+
+
+class CycleDetector:
+    '''
+    Stops a machine that provably runs forever. Every taken backward jump
+    records `(pc, cf, regs, mem.addr)`, and the records are dropped on any IO.
+    Memory only changes through IO, so reaching a recorded state again means
+    the same instructions will keep running with the same results.
+
+    Used by the `ref` and `decoded` engines.
+    '''
+
+    # States kept at once. Past this they are dropped, which only misses
+    # cycles longer than that.
+    max_states = 2 ** 16
+
+    def __init__(self):
+        self.states = set()
+
+    def jumped(self, emu, pc):
+        '''After the jump at `pc` was taken'''
+        if emu.pc >= pc:
+            return
+
+        state = (emu.pc, emu.cf, bytes(emu.regs.data), emu.mem.addr)
+        if state in self.states:
+            emu.stop(StopReason.CYCLE)
+            return
+
+        if len(self.states) >= self.max_states:
+            self.states.clear()
+        self.states.add(state)
+
+    def after(self, emu, ins, pc):
+        '''After `Emu.run_ref` executed `ins` at `pc`'''
+        if ins.op == Op.IO:
+            self.states.clear()
+        elif ins.op in {Op.JUP, Op.JDN} and emu.should_execute(ins):
+            self.jumped(emu, pc)
+
+    # Wrapped records for `wrap`. Like the originals they only run if their
+    # condition passes.
+
+    def io_handler(self, emu, rec, b_, c_):
+        handler, cond, a, b, c = rec
+        self.states.clear()
+        handler(emu, a, b, c)
+
+    def jump_handler(self, emu, rec, b_, c_):
+        handler, cond, a, b, c = rec
+        pc = emu.pc
+        handler(emu, a, b, c)
+        self.jumped(emu, pc)
+
+    def wrap(self, tape):
+        '''Decoded records of `tape` that report to this detector'''
+        code = list(tape.decoded())
+        for i, ins in enumerate(tape.data):
+            handler, cond, a, b, c = code[i]
+            if ins.op == Op.IO:
+                code[i] = (self.io_handler, cond, code[i], None, None)
+            elif ins.op in {Op.JUP, Op.JDN}:
+                code[i] = (self.jump_handler, cond, code[i], None, None)
+        return code
+
+
+class Hooks:
+    '''
+    Functions that `Emu.run` calls around the instructions it executes, see
+    `Emu.add_hook`. They're called as `func(emu, pc)`, before the
+    instruction at `pc`, or after it with `after`, when `emu.pc` may have
+    moved for a jump. Only instructions whose condition passes count.
+
+    A hook can end the run with `emu.stop(StopReason.HOOK)`. If it does so
+    before the instruction, the instruction is left to run when the machine
+    is run again.
+
+    Like breakpoints, hooks are wrapped into the decoded records at just the
+    positions they concern, so other instructions don't pay for them, and
+    `Emu.run` doesn't look at them at all when there are none.
+    '''
+
+    def __init__(self):
+        self.hooks = []  # `(func, op, device, label_key, after)`
+
+    def __bool__(self):
+        return bool(self.hooks)
+
+    def add(self, func, op=None, device=None, label_key=None, after=False):
+        hook = (func, op, device, label_key, after)
+        self.hooks.append(hook)
+        return hook
+
+    def remove(self, hook):
+        self.hooks.remove(hook)
+
+    @staticmethod
+    def matches(hook, ins):
+        (func_, op, device, label_key, after_) = hook
+        if op is not None and ins.op != op:
+            return False
+        if device is not None and \
+                (ins.op != Op.IO or ins.b != device.value):
+            return False
+        if label_key is not None and \
+                (ins.op != Op.LBL or ins.label_key() != label_key):
+            return False
+        return True
+
+    @staticmethod
+    def handler(emu, rec, pre, post):
+        handler, cond, a, b, c = rec
+        pc = emu.pc
+        for func in pre:
+            func(emu, pc)
+        if emu.halted:
+            # Not run yet, so come back to it
+            emu.pc -= 1
+            emu.steps -= 1
+            return
+
+        handler(emu, a, b, c)
+        for func in post:
+            func(emu, pc)
+
+    def wrap(self, tape, code=None):
+        '''
+        Decoded records of `tape` that call the hooks, or `code` with them
+        wrapped in
+        '''
+        code = list(tape.decoded() if code is None else code)
+        for i, ins in enumerate(tape.data):
+            hooks = [h for h in self.hooks if Hooks.matches(h, ins)]
+            if hooks:
+                pre = [h[0] for h in hooks if not h[4]]
+                post = [h[0] for h in hooks if h[4]]
+                code[i] = (Hooks.handler, code[i][1], code[i], pre, post)
+        return code
+
+
+class Snapshot:
+    '''
+    Machine state from `Emu.snapshot`, made of plain bytes so that it's cheap
+    to take and can be pickled. The tape, the clock model and the serial
+    output aren't included.
+
+    `to_bytes` gives the on-disk format: a header, the registers, the
+    allocated memory pages, the serial input buffer, and the GPU coordinates
+    and framebuffer if there is a GPU.
+    '''
+
+    magic = b'EMUS'
+    version = 1
+
+    # magic, version, pc, cf, halted, steps, clock, clock_state, mem.addr,
+    # number of pages, buffer length, has GPU
+    header = struct.Struct('<4sBI??QHQIII?')
+    page_header = struct.Struct('<H')
+    gpu_header = struct.Struct('<BB')
+
+    def __init__(self, regs, pages, addr, pc, cf, halted, steps, clock,
+                 clock_state, buffer, gpu=None):
+        self.regs = regs  # 64 bytes
+        self.pages = pages  # Page number -> bytes, see `Mem`
+        self.addr = addr
+        self.pc = pc
+        self.cf = cf
+        self.halted = halted
+        self.steps = steps
+        self.clock = clock
+        self.clock_state = clock_state  # From the clock model's `save`
+        self.buffer = buffer
+        self.gpu = gpu  # From `Gpu.snapshot`, if there is a GPU
+
+    def to_bytes(self):
+        buffer = self.buffer.encode()
+        ans = [self.header.pack(
+            self.magic, self.version, self.pc, self.cf, self.halted,
+            self.steps, self.clock, self.clock_state, self.addr,
+            len(self.pages), len(buffer), self.gpu is not None
+        )]
+        ans.append(self.regs)
+        for n in sorted(self.pages):
+            ans.append(self.page_header.pack(n))
+            ans.append(self.pages[n])
+        ans.append(buffer)
+        if self.gpu is not None:
+            (x, y, pixels) = self.gpu
+            ans.append(self.gpu_header.pack(x, y))
+            ans.append(pixels)
+        return b''.join(ans)
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = memoryview(data)
+        (magic, version, pc, cf, halted, steps, clock, clock_state, addr,
+         n_pages, buffer_len, has_gpu) = cls.header.unpack_from(data)
+        if magic != cls.magic or version != cls.version:
+            raise ValueError('Not a version {} snapshot'.format(cls.version))
+        i = cls.header.size
+
+        def take(n):
+            nonlocal i
+            if i + n > len(data):
+                raise ValueError('Truncated snapshot')
+            i += n
+            return bytes(data[i - n:i])
+
+        regs = take(64)
+
+        pages = {}
+        for _ in range(n_pages):
+            (n,) = cls.page_header.unpack(take(cls.page_header.size))
+            pages[n] = take(Mem.page_size)
+
+        buffer = str(take(buffer_len), 'utf-8')
+
+        gpu = None
+        if has_gpu:
+            (x, y) = cls.gpu_header.unpack(take(cls.gpu_header.size))
+            gpu = (x, y, take(64 * 64 * 3))
+
+        return cls(regs, pages, addr, pc, cf, halted, steps, clock,
+                   clock_state, buffer, gpu)
+
+    def to_file(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def from_filename(cls, filename):
+        with open(filename, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+
+# Where `Emu.warm_start` caches snapshots
+warm_start_dir = os.path.join(os.path.expanduser('~'), '.cache', 'emu')
+
+
 class Emu:
-    def __init__(self, use_gpu=False):
-        self.regs = Regs()
-        self.mem = Mem()
+    def __init__(self, use_gpu=False, clock=None, checked=False,
+                 gpu_backend=None):
+        # Checked registers and memory assert that every value read is 6-bit,
+        # which is slower. Only the ref engine reads through them; the others
+        # use `regs.data` and the memory pages directly.
+        self.checked = checked
+        if checked:
+            self.regs = CheckedRegs()
+            self.mem = CheckedMem()
+        else:
+            self.regs = Regs()
+            self.mem = Mem()
 
-        self.use_gpu = use_gpu
-        if use_gpu:
-            self.gpu = gpu.Gpu()
+        # The GPU draws to a pygame window unless given another backend, e.g.
+        # `gpu.HeadlessGpu`
+        self.use_gpu = use_gpu or gpu_backend is not None
+        if self.use_gpu:
+            self.gpu = gpu.Gpu() if gpu_backend is None else gpu_backend
             self.gpu.start()
 
         self.pc = 0
         self.halted = False
         self.cf = False
+
+        # Number of instructions executed by `run` and friends
+        self.steps = 0
+
+        # Engines call `check_in` once `steps` reaches `check_at`, to sample
+        # `stats` and apply the limits for `run`, see `Watchdog`
+        self.stats = Stats()
+        self.hooks = Hooks()
+        self.watchdog = None
+        self.check_at = float('inf')
+        self.stop_reason = None
+
+        # Where CLOCK_LO_CS and CLOCK_HI_CS get the time from. `self.clock` is
+        # the last value that was read.
+        self.clock_model = RealClock() if clock is None else clock
         self.clock = 0
 
         self.buffer = ''
         self.out = sys.stdout
 
+        # ROM the tape was loaded from, if any
+        self.filename = None
+
     @classmethod
-    def from_filename(cls, filename, use_gpu=False):
-        ans = cls(use_gpu)
+    def from_filename(cls, filename, use_gpu=False, clock=None,
+                      checked=False, warm_start=False, gpu_backend=None):
+        ans = cls(use_gpu, clock, checked, gpu_backend)
+        ans.filename = filename
         s = open(filename).read().strip()
         s = base64.b64decode(s)
         ans.tape = Tape.from_bytes(s)
+        if warm_start:
+            ans.warm_start()
         return ans
 
+    def warm_start(self, cache_dir=None):
+        '''
+        Skip ahead to where the program first depends on the outside world.
+        The state there is cached in `cache_dir` per ROM and clock model,
+        whose saved states differ, and is computed with `warm_up` if it isn't
+        cached yet. Serial output from before that point is written out
+        again.
+        '''
+        if cache_dir is None:
+            cache_dir = warm_start_dir
+        name = '{}-{}{}'.format(self.tape.sha256(),
+                                type(self.clock_model).__name__.lower(),
+                                '-gpu' if self.use_gpu else '')
+        path = os.path.join(cache_dir, name)
+
+        try:
+            snapshot = Snapshot.from_filename(path + '.snap')
+            with open(path + '.out') as f:
+                out = f.read()
+        except (FileNotFoundError, ValueError, struct.error):
+            # Not cached, or unreadable
+            out = self.warm_up()
+            os.makedirs(cache_dir, exist_ok=True)
+
+            # Written atomically, the snapshot last, so that other processes
+            # warm starting at the same time never see half a cache entry
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write(out)
+            os.replace(tmp, path + '.out')
+            self.snapshot().to_file(tmp)
+            os.replace(tmp, path + '.snap')
+        else:
+            self.restore(snapshot)
+
+        self.out.write(out)
+
+    def warm_up(self, max_steps=10**6):
+        '''
+        Run from the start until the program is about to use an input device
+        (see `input_io_funcs`), or halts, or `max_steps` instructions have
+        run. Up to there the program always does the same thing. Returns the
+        serial output instead of writing it.
+        '''
+        self.clock_model.reset(self)
+        code = self.tape.decoded()
+        n = len(code)
+
+        out = self.out
+        self.out = io.StringIO()
+        try:
+            while not self.halted and self.steps < max_steps:
+                handler, cond, a, b, c = code[self.pc]
+                if cond == 0 or (cond == 1) == self.cf:
+                    if handler in Emu.input_io_funcs:
+                        break
+                    handler(self, a, b, c)
+                self.pc = (self.pc + 1) % n  # Tape is looped
+                self.steps += 1
+
+            return self.out.getvalue()
+        finally:
+            self.out = out
+
+    def snapshot(self):
+        '''Copy of the machine state, see `Snapshot`'''
+        return Snapshot(
+            regs=bytes(self.regs.data),
+            pages={n: bytes(page) for n, page in self.mem.pages.items()},
+            addr=self.mem.addr,
+            pc=self.pc,
+            cf=self.cf,
+            halted=self.halted,
+            steps=self.steps,
+            clock=self.clock,
+            clock_state=self.clock_model.save(self),
+            buffer=self.buffer,
+            gpu=self.gpu.snapshot() if self.use_gpu else None,
+        )
+
+    def restore(self, snapshot):
+        '''Go back to the machine state from `snapshot`'''
+        self.regs.data[:] = snapshot.regs
+        self.mem.pages = {
+            n: bytearray(page) for n, page in snapshot.pages.items()
+        }
+        self.mem.addr = snapshot.addr
+        self.pc = snapshot.pc
+        self.cf = snapshot.cf
+        self.halted = snapshot.halted
+        self.steps = snapshot.steps
+        self.clock = snapshot.clock
+        self.clock_model.restore(self, snapshot.clock_state)
+        self.buffer = snapshot.buffer
+        if self.use_gpu and snapshot.gpu is not None:
+            self.gpu.restore(snapshot.gpu)
+
     # Ops
 
     def op_hlt(self, ins):
@@ -320,29 +1321,36 @@ class Emu:
         # Do nothing
         pass
 
+    def find_label(self, key, reverse=False):
+        '''
+        Position of the nearest label matching `key`, searching upwards from
+        the PC (or downwards if `reverse`) and wrapping around the tape.
+        Every jump taken does one, so `stats` counts it as one.
+        '''
+        # A bisect through n labels takes n.bit_length() steps
+        self.stats.jumps += 1
+        self.stats.label_search_steps += len(
+            self.tape.labels().get((key, self.cf), ())).bit_length()
+
+        i = self.tape.find_label(key, self.cf, self.pc, reverse)
+        if i is None:
+            raise ValueError('Couldn''t find label: {}'.format(key))
+        return i
+
     def op_jup(self, ins, reverse=False):
         key = (ins.partial_jump_key(), self.regs[ins.c])
 
         # Search for the label matching key
-        start = self.pc
-        i = start
-        while True:
-            if reverse:
-                i = (i + 1) % len(self.tape)
-            else:
-                i = (i - 1) % len(self.tape)
-
-            if i == start:
-                raise ValueError('Couldn''t find label: {}'.format(key))
-
-            ch_ins = self.tape[i]  # Check instruction
-            if ch_ins.op == Op.LBL and \
-                    self.should_execute(ch_ins) and \
-                    ch_ins.label_key() == key:
-                # We always increment the PC after executing an instruction.
-                # To offset that, we subtract 1 here.
-                self.pc = i - 1
-                return
+        i = self.find_label(key, reverse)
+
+        # Going around a busy wait again only makes sense once the clock
+        # changes
+        if not reverse and self.pc in self.tape.busy_waits():
+            self.clock_model.wait(self)
+
+        # We always increment the PC after executing an instruction.
+        # To offset that, we subtract 1 here.
+        self.pc = i - 1
 
     def op_jdn(self, ins):
         self.op_jup(ins, reverse=True)
@@ -351,19 +1359,21 @@ class Emu:
         s = input('> ')
         self.buffer += s
 
-    def op_io_serial_incoming(self, ins):
-        (rd, ix_, rs_) = ins.as_io()
+    # IO devices
+    #
+    # These take the fields of the IO instruction, so that both `op_io` and
+    # the decoded engine can use them.
 
+    def io_serial_incoming(self, rd, ix_, rs_):
         # Optionally read more input if we don't have any in the buffer
         if len(self.buffer) == 0:
             self.get_input()
 
         # Send the length of buffer
         self.regs[rd] = from_int(len(self.buffer))
+        self.stats.serial_incoming += 1
 
-    def op_io_serial_read(self, ins):
-        (rd, ix_, rs_) = ins.as_io()
-
+    def io_serial_read(self, rd, ix_, rs_):
         # Optionally read more input if we don't have any in the buffer
         if len(self.buffer) == 0:
             self.get_input()
@@ -371,103 +1381,120 @@ class Emu:
         # Pop the first char and send it
         c = self.buffer[0]
         self.buffer = self.buffer[1:]
+        self.stats.serial_in += 1
         self.regs[rd] = from_int(serial_from_chr(c))
 
-    def op_io_serial_write(self, ins):
-        (rd_, ix_, rs) = ins.as_io()
+    def io_serial_write(self, rd_, ix_, rs):
         c = chr_from_serial(self.regs[rs])
         self.out.write(c)
         self.out.flush()
+        self.stats.serial_out += 1
+
+    def read_clock(self):
+        self.clock = self.clock_model.read(self)
+        return self.clock
 
     def reset_clock(self):
-        self.start = time.time()
-        self.clock == 0
+        self.clock_model.reset(self)
+        self.clock = 0
         if self.use_gpu:
+            self.stats.presents += 1
             should_halt = self.gpu.update()
             if should_halt:
                 self.halted = True
 
-    def op_io_clock_lo_cs(self, ins):
-        (rd, ix_, rs) = ins.as_io()
+    def io_clock_lo_cs(self, rd, ix_, rs):
+        self.stats.clock_lo += 1
         if rs == 0:
             # Get lower 6 bits of clock
-            self.regs[rd] = self.clock & 0o77
+            self.regs[rd] = self.read_clock() & 0o77
         else:
             self.reset_clock()
 
-    def op_io_clock_hi_cs(self, ins):
-        (rd, ix_, rs) = ins.as_io()
+    def io_clock_hi_cs(self, rd, ix_, rs):
+        self.stats.clock_hi += 1
         if rs == 0:
             # Get upper 6 bits of clock
-            self.regs[rd] = (self.clock & 0o7700) >> 6
+            self.regs[rd] = (self.read_clock() & 0o7700) >> 6
         else:
             self.reset_clock()
 
-    def op_io_mem_addr_lo(self, ins):
-        (rd_, ix_, rs) = ins.as_io()
+    def io_mem_addr_lo(self, rd_, ix_, rs):
         # Clear lower bits without clearing upper bits
         mask = (0o77 << 6) + (0o77 << (6 * 2))
         self.mem.addr &= mask
         self.mem.addr |= self.regs[rs]
+        self.stats.mem_addr_lo += 1
 
-    def op_io_mem_addr_mid(self, ins):
-        (rd_, ix_, rs) = ins.as_io()
+    def io_mem_addr_mid(self, rd_, ix_, rs):
         mask = 0o77 + (0o77 << (6 * 2))
         self.mem.addr &= mask
         self.mem.addr |= (self.regs[rs] << 6)
+        self.stats.mem_addr_mid += 1
 
-    def op_io_mem_addr_hi(self, ins):
-        (rd_, ix_, rs) = ins.as_io()
+    def io_mem_addr_hi(self, rd_, ix_, rs):
         mask = 0o77 + (0o77 << 6)
         self.mem.addr &= mask
         self.mem.addr |= (self.regs[rs] << (6 * 2))
+        self.stats.mem_addr_hi += 1
 
-    def op_io_mem_read(self, ins):
-        (rd, ix_, rs_) = ins.as_io()
+    def io_mem_read(self, rd, ix_, rs_):
         self.regs[rd] = self.mem[self.mem.addr]
         self.mem.addr = (self.mem.addr + 1) % len(self.mem)
+        self.stats.mem_reads += 1
 
-    def op_io_mem_write(self, ins):
-        (rd_, ix_, rs) = ins.as_io()
+    def io_mem_write(self, rd_, ix_, rs):
         self.mem[self.mem.addr] = self.regs[rs]
         self.mem.addr = (self.mem.addr + 1) % len(self.mem)
+        self.stats.mem_writes += 1
 
-    def op_gpu_x(self, ins):
-        (rd_, ix_, rs) = ins.as_io()
+    def io_gpu_x(self, rd_, ix_, rs):
         self.gpu.set_x(self.regs[rs])
+        self.stats.gpu_x += 1
 
-    def op_gpu_y(self, ins):
-        (rd_, ix_, rs) = ins.as_io()
+    def io_gpu_y(self, rd_, ix_, rs):
         self.gpu.set_y(self.regs[rs])
+        self.stats.gpu_y += 1
 
-    def op_gpu_draw(self, ins):
-        (rd_, ix, rs) = ins.as_io()
+    def io_gpu_draw(self, rd_, ix_, rs):
         self.gpu.draw(self.regs[rs])
+        self.stats.draws += 1
 
     op_io_switch = {
-        IoDevice.SERIAL_INCOMING: op_io_serial_incoming,
-        IoDevice.SERIAL_READ: op_io_serial_read,
-        IoDevice.SERIAL_WRITE: op_io_serial_write,
-        IoDevice.CLOCK_LO_CS: op_io_clock_lo_cs,
-        IoDevice.CLOCK_HI_CS: op_io_clock_hi_cs,
-        IoDevice.MEM_ADDR_HI: op_io_mem_addr_hi,
-        IoDevice.MEM_ADDR_MID: op_io_mem_addr_mid,
-        IoDevice.MEM_ADDR_LO: op_io_mem_addr_lo,
-        IoDevice.MEM_READ: op_io_mem_read,
-        IoDevice.MEM_WRITE: op_io_mem_write,
-        IoDevice.GPU_X: op_gpu_x,
-        IoDevice.GPU_Y: op_gpu_y,
-        IoDevice.GPU_DRAW: op_gpu_draw,
+        IoDevice.SERIAL_INCOMING: io_serial_incoming,
+        IoDevice.SERIAL_READ: io_serial_read,
+        IoDevice.SERIAL_WRITE: io_serial_write,
+        IoDevice.CLOCK_LO_CS: io_clock_lo_cs,
+        IoDevice.CLOCK_HI_CS: io_clock_hi_cs,
+        IoDevice.MEM_ADDR_HI: io_mem_addr_hi,
+        IoDevice.MEM_ADDR_MID: io_mem_addr_mid,
+        IoDevice.MEM_ADDR_LO: io_mem_addr_lo,
+        IoDevice.MEM_READ: io_mem_read,
+        IoDevice.MEM_WRITE: io_mem_write,
+        IoDevice.GPU_X: io_gpu_x,
+        IoDevice.GPU_Y: io_gpu_y,
+        IoDevice.GPU_DRAW: io_gpu_draw,
+    }
+
+    def io_unknown(self, rd_, ix_, rs_):
+        logging.warning('Unknown IO device')
+        self.stats.unknown_io += 1
+        self.halted = True
+
+    # Devices whose results depend on the outside world. Resetting the clock
+    # also presents the GPU frame, which can pick up a request to quit.
+    input_io_funcs = {
+        io_serial_incoming,
+        io_serial_read,
+        io_clock_lo_cs,
+        io_clock_hi_cs,
+        io_unknown,
     }
 
     def op_io(self, ins):
-        (rd_, ix, rs_) = ins.as_io()
-        if ix in Emu.op_io_switch:
-            op_io_func = Emu.op_io_switch[ix]
-            op_io_func(self, ins)
-        else:
-            logging.warning('Unknown IO device')
-            self.halted = True
+        (rd, ix, rs) = ins.as_io()
+        op_io_func = Emu.op_io_switch.get(ix, Emu.io_unknown)
+        op_io_func(self, rd, ix, rs)
 
     op_switch = {
         Op.HLT: op_hlt,
@@ -507,14 +1534,253 @@ class Emu:
             else:
                 raise ValueError('Unhandled op: {}'.format(ins.op))
 
-    def run(self, log_inss=False):
+    # Decoded ops
+    #
+    # Handlers for `run_decoded`. `Emu.decode` splits each instruction into
+    # the operands below ahead of time, so these work on the register list
+    # directly and never construct enums. Results come from the lookup tables
+    # in `alu`. The condition is checked by the caller.
+
+    def dop_nop(self, a_, b_, c_):
+        pass
+
+    def dop_ref(self, ins, b_, c_):
+        # Fall back to the reference implementation
+        Emu.op_switch[ins.op](self, ins)
+
+    def dop_hlt(self, a_, b_, c_):
+        self.halted = True
+
+    def dop_add(self, rd, ra, rb):
+        r = self.regs.data
+        r[rd] = ADD[(r[ra] << 6) | r[rb]]
+
+    def dop_sub(self, rd, ra, rb):
+        r = self.regs.data
+        r[rd] = SUB[(r[ra] << 6) | r[rb]]
+
+    def dop_or(self, rd, ra, rb):
+        r = self.regs.data
+        r[rd] = OR[(r[ra] << 6) | r[rb]]
+
+    def dop_xor(self, rd, ra, rb):
+        r = self.regs.data
+        r[rd] = XOR[(r[ra] << 6) | r[rb]]
+
+    def dop_and(self, rd, ra, rb):
+        r = self.regs.data
+        r[rd] = AND[(r[ra] << 6) | r[rb]]
+
+    def dop_shl(self, rd, ra, rb):
+        r = self.regs.data
+        r[rd] = SHL[(r[ra] << 6) | r[rb]]
+
+    def dop_shr(self, rd, ra, rb):
+        r = self.regs.data
+        r[rd] = SHR[(r[ra] << 6) | r[rb]]
+
+    def dop_imm(self, row, rd, ra):
+        # Any op with an immediate right operand, already applied in `row`
+        r = self.regs.data
+        r[rd] = row[r[ra]]
+
+    def dop_cmp_rr(self, t, ra, rb):
+        r = self.regs.data
+        self.cf = t[(r[ra] << 6) | r[rb]]
+
+    def dop_cmp_row(self, row, ra, b_):
+        # Comparison with one side immediate, already applied in `row`
+        self.cf = row[self.regs.data[ra]]
+
+    def dop_ld(self, rd, ra, ib):
+        r = self.regs.data
+        rs = (r[ra] + ib) & 0o77
+        if rd != 0:
+            r[rd] = r[rs]
+
+    def dop_st(self, rs, ra, ib):
+        r = self.regs.data
+        rd = (r[ra] + ib) & 0o77
+        if rd != 0:
+            r[rd] = r[rs]
+
+    def dop_fm(self, t, rd, ra):
+        r = self.regs.data
+        r[rd] = t[(r[rd] << 6) | r[ra]]
+
+    def dop_jup(self, partial_key, rc, c_):
+        key = (partial_key, self.regs.data[rc])
+        self.pc = self.find_label(key) - 1
+
+    def dop_jdn(self, partial_key, rc, c_):
+        key = (partial_key, self.regs.data[rc])
+        self.pc = self.find_label(key, reverse=True) - 1
+
+    def dop_jup_wait(self, partial_key, rc, c_):
+        # JUP closing a busy wait, see `Tape.is_busy_wait`
+        Emu.dop_jup(self, partial_key, rc, c_)
+        self.clock_model.wait(self)
+
+    # Fused ops
+    #
+    # Records from `Emu.fuse`, which run an unconditional instruction and the
+    # one after it. The first one moves `pc` and `steps` onto the second, so
+    # that it sees the same state as if run on its own, and its condition is
+    # checked here.
+
+    def dop_cmp_rr_jump(self, t, ra_rb, jump):
+        (ra, rb) = ra_rb
+        r = self.regs.data
+        self.cf = cf = t[(r[ra] << 6) | r[rb]]
+        self.pc += 1
+        self.steps += 1
+
+        (cond, partial_key, rc, reverse) = jump
+        if cond == 0 or (cond == 1) == cf:
+            key = (partial_key, r[rc])
+            self.pc = self.find_label(key, reverse) - 1
+
+    def dop_cmp_row_jump(self, row, ra, jump):
+        r = self.regs.data
+        self.cf = cf = row[r[ra]]
+        self.pc += 1
+        self.steps += 1
+
+        (cond, partial_key, rc, reverse) = jump
+        if cond == 0 or (cond == 1) == cf:
+            key = (partial_key, r[rc])
+            self.pc = self.find_label(key, reverse) - 1
+
+    def dop_imm_io(self, imm, io, c_):
+        (row, rd, ra) = imm
+        r = self.regs.data
+        r[rd] = row[r[ra]]
+        self.pc += 1
+        self.steps += 1
+
+        (cond, io_func, rd, ix, rs) = io
+        if cond == 0 or (cond == 1) == self.cf:
+            io_func(self, rd, ix, rs)
+
+    @staticmethod
+    def fuse(first, second):
+        '''
+        Fused record running decoded records `first` and `second` in order,
+        or None if the pair isn't one of:
+        - CMP followed by JUP or JDN
+        - An op with an immediate (ADDI etc.) followed by SERIAL_WRITE or
+          MEM_WRITE
+        '''
+        handler, cond, a, b, c = first
+        handler2, cond2, a2, b2, c2 = second
+        if cond != 0:
+            return None
+
+        if handler2 in {Emu.dop_jup, Emu.dop_jdn}:
+            jump = (cond2, a2, b2, handler2 == Emu.dop_jdn)
+            if handler == Emu.dop_cmp_rr:
+                return (Emu.dop_cmp_rr_jump, 0, a, (b, c), jump)
+            elif handler == Emu.dop_cmp_row:
+                return (Emu.dop_cmp_row_jump, 0, a, b, jump)
+        elif handler == Emu.dop_imm and \
+                handler2 in {Emu.io_serial_write, Emu.io_mem_write}:
+            io = (cond2, handler2, a2, b2, c2)
+            return (Emu.dop_imm_io, 0, (a, b, c), io, None)
+
+        return None
+
+    # Ops whose only effect is writing `rd`. Writes to r0 are dropped, so these
+    # decode to `dop_nop` when `rd` is 0.
+    dop_rrr_switch = {
+        Op.ADD: dop_add,
+        Op.SUB: dop_sub,
+        Op.OR: dop_or,
+        Op.XOR: dop_xor,
+        Op.AND: dop_and,
+        Op.SHL: dop_shl,
+        Op.SHR: dop_shr,
+    }
+
+    dop_rri_rows = {
+        Op.ADDI: ADDI,
+        Op.ORI: ORI,
+        Op.XORI: XORI,
+        Op.ANDI: ANDI,
+    }
+
+    @staticmethod
+    def decode(ins):
+        '''
+        Decode an instruction into a `(handler, cond, a, b, c)` record, where
+        `cond` is the `Cond` value and executing the instruction is
+        `handler(emu, a, b, c)`.
+        '''
+        op, cond, a, b, c = ins.as_values()
+        cond = cond.value
+
+        if op in Emu.dop_rrr_switch:
+            if a == 0:
+                return (Emu.dop_nop, cond, a, b, c)
+            return (Emu.dop_rrr_switch[op], cond, a, b, c)
+        elif op in Emu.dop_rri_rows:
+            if a == 0:
+                return (Emu.dop_nop, cond, a, b, c)
+            return (Emu.dop_imm, cond, Emu.dop_rri_rows[op][c], a, b)
+        elif op == Op.HLT:
+            return (Emu.dop_hlt, cond, a, b, c)
+        elif op == Op.LBL:
+            return (Emu.dop_nop, cond, a, b, c)
+        elif op == Op.CMP and (a >> 3) in {t.value for t in CmpType}:
+            (cmp_type, cm, a, b) = ins.as_cmp()
+            if cmp_type == CmpType.RA_RB:
+                return (Emu.dop_cmp_rr, cond, CMP[cm], a, b)
+            elif cmp_type == CmpType.RB_RA:
+                return (Emu.dop_cmp_rr, cond, CMP[cm], b, a)
+            elif cmp_type == CmpType.RA_IB:
+                return (Emu.dop_cmp_row, cond, CMP_RI[cm][b], a, None)
+            elif cmp_type == CmpType.IA_RB:
+                return (Emu.dop_cmp_row, cond, CMP_IR[cm][a], b, None)
+        elif op == Op.SHI and (c >> 3) in {t.value for t in ShiType}:
+            (shi_type, rd, ra, ib) = ins.as_shi()
+            if rd == 0:
+                return (Emu.dop_nop, cond, rd, ra, ib)
+            return (Emu.dop_imm, cond, SHI[shi_type][ib], rd, ra)
+        elif op == Op.LD:
+            return (Emu.dop_ld, cond, a, b, c)
+        elif op == Op.ST:
+            return (Emu.dop_st, cond, a, b, c)
+        elif op == Op.FM and (c >> 4) in {t.value for t in FmType}:
+            (fm_type, pr, rd, ra) = ins.as_fm()
+            if rd == 0:
+                return (Emu.dop_nop, cond, rd, ra, pr)
+            return (Emu.dop_fm, cond, fm_table(fm_type, pr), rd, ra)
+        elif op == Op.JUP:
+            return (Emu.dop_jup, cond, ins.partial_jump_key(), c, None)
+        elif op == Op.JDN:
+            return (Emu.dop_jdn, cond, ins.partial_jump_key(), c, None)
+        elif op == Op.IO and b in {d.value for d in IoDevice}:
+            (rd, ix, rs) = ins.as_io()
+            op_io_func = Emu.op_io_switch.get(ix, Emu.io_unknown)
+            return (op_io_func, cond, rd, ix, rs)
+
+        # Anything malformed errors out the same way as `execute` would, but
+        # only if it is actually executed
+        return (Emu.dop_ref, cond, ins, None, None)
+
+    def step(self):
+        '''Execute one instruction with the reference interpreter'''
+        self.execute(self.tape[self.pc])
+        self.pc = (self.pc + 1) % len(self.tape)  # Tape is looped
+        self.steps += 1
+
+    def run_ref(self, log_inss=False, cycles=None):
+        '''
+        Reference interpreter loop, see `run`. `cycles` is a `CycleDetector`.
+        '''
         if log_inss:
             # Keep a log of instructions executed
             inss_log = []
 
-        self.start = time.time()
-        self.clock = 0
-
         while not self.halted:
             ins = self.tape[self.pc]
 
@@ -522,25 +1788,209 @@ class Emu:
                 inss_log.append(self.pc)
 
             # 19483
+            pc = self.pc
             self.execute(ins)
+            if cycles is not None:
+                cycles.after(self, ins, pc)
             self.pc = (self.pc + 1) % len(self.tape)  # Tape is looped
+            self.steps += 1
 
-            now = time.time()
-            elapsed = now - self.start
-            elapsed = round(elapsed, 2)
-            elapsed = int(elapsed * 100)
-
-            # Clock does not wrap
-            self.clock = min(elapsed, 0o7777)
-
-        if self.use_gpu:
-            self.gpu.quit()
+            if self.steps >= self.check_at:
+                self.check_in()
 
         if log_inss:
             return inss_log
 
+    def run_decoded(self, code=None):
+        '''
+        Executes the records from `Tape.fused`, or `code` if given, see `run`
+        '''
+        if code is None:
+            fused = self.tape.fused()
+            plain = self.tape.decoded()
+        else:
+            fused = plain = code
+        n = len(fused)
+
+        # A fused record runs two steps, so the step before a check in runs
+        # the plain record instead, to stop exactly at `check_at`
+        limit = self.check_at - 1
+        code = fused if self.steps < limit else plain
+        while not self.halted:
+            handler, cond, a, b, c = code[self.pc]
+
+            # Same as `should_execute`, with `cond` as an int
+            if cond == 0 or (cond == 1) == self.cf:
+                handler(self, a, b, c)
+            self.pc = (self.pc + 1) % n  # Tape is looped
+            self.steps += 1
+
+            if self.steps >= limit:
+                if self.steps >= self.check_at:
+                    self.check_in()
+                    limit = self.check_at - 1
+                    code = fused if self.steps < limit else plain
+                else:
+                    code = plain
+
+    def add_hook(self, func, op=None, device=None, label_key=None,
+                 after=False):
+        '''
+        Have `run` call `func(emu, pc)` before every instruction, or after it
+        with `after`. Limited to instructions with `op`, IO with `device` or
+        labels with `label_key` if given. Returns the hook for `remove_hook`.
+        See `Hooks`.
+        '''
+        return self.hooks.add(func, op, device, label_key, after)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def stop(self, reason):
+        '''Make the engine return early, with `stop_reason` set to `reason`'''
+        self.stop_reason = reason
+        self.halted = True
+
+    def check_in(self):
+        '''Called by the engines once `steps` reaches `check_at`'''
+        self.stats.sample(self)
+        if self.halted:
+            # Halted on the same step, which mustn't look like a limit
+            return
+        if self.watchdog is not None:
+            reason = self.watchdog.check(self)
+            if reason is not None:
+                self.stop(reason)
+                return
+
+        self.check_at = self.stats.next_check(self)
+        if self.watchdog is not None:
+            self.check_at = min(self.check_at, self.watchdog.next_check(self))
+
+    def run(self, log_inss=False, engine='ref', max_steps=None, max_time=None,
+            detect_cycles=False, profile=None, trace=None, timeline=None):
+        '''
+        Run until halted. `engine` is one of:
+        - `ref`: Reference interpreter, `run_ref`
+        - `decoded`: Predecoded records, `run_decoded`
+        - `block`: Compiled basic blocks, `compiler.run_blocks`
+        - `trace`: Decoded records with hot loops compiled, `jit.run_traces`
+        - `aot`: Prebuilt module from `transpile.py`, `transpile.run`
+
+        It also returns after `max_steps` more instructions, after `max_time`
+        seconds, or with `detect_cycles` once the program provably loops
+        forever (see `CycleDetector`, `ref` and `decoded` engines only).
+        `stop_reason` says which, and the machine can be run again from where
+        it stopped. The `ref` and `decoded` engines stop at exactly
+        `max_steps`, the others at the next block or loop iteration after.
+
+        With `profile`, a `profiler.Profile`, the `decoded` engine counts the
+        instructions it runs into it. With `trace`, a `tracefile.TraceWriter`,
+        it streams them to a file instead. With `timeline`, a
+        `timeline.Timeline`, it records IO and frames to it.
+
+        Hooks from `add_hook` are only supported by the `decoded` engine, and
+        a `checked` machine only by the `ref` engine.
+        '''
+        if log_inss and engine != 'ref':
+            raise ValueError('log_inss is only supported by the ref engine')
+        if profile is not None and engine != 'decoded':
+            raise ValueError('profile is only supported by the decoded engine')
+        if trace is not None and engine != 'decoded':
+            raise ValueError('trace is only supported by the decoded engine')
+        if self.hooks and engine != 'decoded':
+            raise ValueError('hooks are only supported by the decoded engine')
+        if timeline is not None and engine != 'decoded':
+            raise ValueError(
+                'timeline is only supported by the decoded engine')
+        if self.checked and engine != 'ref':
+            raise ValueError('checked is only supported by the ref engine')
+        if profile is not None and trace is not None:
+            raise ValueError('profile and trace can\'t be used together')
+        if detect_cycles and engine not in {'ref', 'decoded'}:
+            raise ValueError(
+                'detect_cycles is only supported by the ref and decoded '
+                'engines')
+
+        # A machine that already ran, e.g. from a snapshot, keeps its clock
+        if self.steps == 0:
+            self.clock_model.reset(self)
+            self.clock = 0
+
+        self.stop_reason = None
+        if max_steps is None and max_time is None:
+            self.watchdog = None
+            self.check_at = self.stats.next_check(self)
+        else:
+            self.watchdog = Watchdog(self, max_steps, max_time)
+            self.check_at = min(self.stats.next_check(self),
+                                self.watchdog.next_check(self))
+        self.stats.start(self, engine)
+        cycles = CycleDetector() if detect_cycles else None
+
+        # The engines only check after running an instruction, so a limit
+        # that's already reached, e.g. `max_steps=0`, stops them here
+        if self.watchdog is not None and not self.halted:
+            reason = self.watchdog.check(self)
+            if reason is not None:
+                self.stop(reason)
+
+        ans = None
+        try:
+            if engine == 'ref':
+                ans = self.run_ref(log_inss, cycles)
+            elif engine == 'decoded':
+                code = None if cycles is None else cycles.wrap(self.tape)
+                if self.hooks:
+                    code = self.hooks.wrap(self.tape, code)
+                if timeline is not None:
+                    code = timeline.wrap(self.tape, code)
+                    timeline.begin_frame(self)
+
+                if profile is not None:
+                    import profiler
+                    profiler.run(self, profile, code)
+                elif trace is not None:
+                    import tracefile
+                    tracefile.run(self, trace, code)
+                else:
+                    self.run_decoded(code)
+            elif engine == 'block':
+                import compiler
+                compiler.run_blocks(self)
+            elif engine == 'trace':
+                import jit
+                jit.run_traces(self)
+            elif engine == 'aot':
+                import transpile
+                transpile.run(self)
+            else:
+                raise ValueError('Unknown engine: {}'.format(engine))
+        finally:
+            self.stats.sample(self)
+            self.watchdog = None
+            self.check_at = float('inf')
+            if timeline is not None:
+                timeline.end_frame(self)
+
+        if self.stop_reason is None:
+            self.stop_reason = StopReason.HALTED
+            if self.use_gpu:
+                self.gpu.quit()
+        else:
+            # Stopped early, not halted
+            self.halted = False
+
+        return ans
+
     def execute_dbg_cmd(self, cmd):
         '''Return value: whether to go to the next instruction or not'''
+        import breakpoints
+
+        # Breakpoints and watchpoints can have a condition
+        (cmd, _, cond) = cmd.partition(' if ')
+        cond = cond.strip() or None
+
         cmd = cmd.split()
         if len(cmd) == 0:
             print('No cmd')
@@ -563,6 +2013,42 @@ class Emu:
                 print(disasm)
             elif cmd[0] in {'n', 's'}:
                 return True
+            elif cmd[0] == 'rs':
+                # Reverse step
+                self.history.travel(self.steps - 1)
+                self.print_dbg_ins()
+            elif cmd[0] == 'rc':
+                # Reverse continue, back to the last breakpoint hit
+                (breaks, _) = breakpoints.by_pc(self.tape, self.points)
+                if not self.history.run_back(lambda emu: any(
+                        p.hit(emu) for p in breaks.get(emu.pc, []))):
+                    print('No breakpoint hit in history')
+                self.print_dbg_ins()
+            elif cmd[0] == 'b':
+                self.points.append(breakpoints.PcBreak(int(cmd[1]), cond))
+            elif cmd[0] == 'bl':
+                key = (int(cmd[1]), int(cmd[2]))
+                self.points.append(breakpoints.LabelBreak(key, cond))
+            elif cmd[0] == 'bio':
+                device = IoDevice[cmd[1].upper()]
+                self.points.append(breakpoints.IoBreak(device, cond))
+            elif cmd[0] == 'wr':
+                self.points.append(breakpoints.RegWatch(int(cmd[1]), cond))
+            elif cmd[0] == 'wm':
+                self.points.append(breakpoints.MemWatch(int(cmd[1]), cond))
+            elif cmd[0] == 'wa':
+                self.points.append(breakpoints.AddrWatch(cond))
+            elif cmd[0] == 'info':
+                for i, point in enumerate(self.points):
+                    print('{}: {}'.format(i, point))
+            elif cmd[0] == 'd':
+                del self.points[int(cmd[1])]
+            elif cmd[0] == 'rw':
+                # Back to the last write to a register
+                i = int(cmd[1])
+                if not self.history.last_write(i):
+                    print('No write to regs[{}] in history'.format(i))
+                self.print_dbg_ins()
             elif cmd[0] == 'q':
                 self.halted = True
                 return True
@@ -572,35 +2058,58 @@ class Emu:
             else:
                 print('Unknown cmd')
                 return False
-        except ValueError:
+        except (ValueError, KeyError, IndexError, SyntaxError):
             print('Error processing cmd')
             return False
 
-    def run_dbg(self):
+    def print_dbg_ins(self):
+        ins = self.tape[self.pc]
+        print('{}: {}'.format(self.pc, Disasm.disasm(ins)))
+
+    def run_dbg(self, interval=10000, max_checkpoints=100):
+        '''
+        Interactive debugger. Checkpoints are taken every `interval`
+        instructions for going backwards, see `history.History`.
+        '''
+        import breakpoints
+        import history
+
+        # Use fake clock where each instruction takes one centisecond
+        self.clock_model = VirtualClock()
+        self.clock_model.reset(self)
         self.clock = 0
         self.stepping = True
+        self.history = history.History(self, interval, max_checkpoints)
+        self.points = []  # See `breakpoints`
         prev_cmd = None
 
         while not self.halted:
+            self.history.record()
+
+            if not self.stepping:
+                # Continue at full speed until something fires
+                stop = breakpoints.run(self, self.points, self.history)
+                if stop is not None:
+                    print(stop)
+                self.stepping = True
+                continue
+
+            self.print_dbg_ins()
+            while True:
+                cmd = input('edb> ')
+                if cmd == '' and prev_cmd:
+                    cmd = prev_cmd
+
+                go_next = self.execute_dbg_cmd(cmd)
+                prev_cmd = cmd
+                if go_next:
+                    break
+
+            # Going backwards moves the PC
             ins = self.tape[self.pc]
-            print('{}: {}'.format(self.pc, Disasm.disasm(ins)))
-
-            if self.stepping:
-                while True:
-                    cmd = input('edb> ')
-                    if cmd == '' and prev_cmd:
-                        cmd = prev_cmd
-
-                    go_next = self.execute_dbg_cmd(cmd)
-                    prev_cmd = cmd
-                    if go_next:
-                        break
-
             self.execute(ins)
             self.pc = (self.pc + 1) % len(self.tape)  # Tape is looped
-
-            # Use fake clock where each instruction takes one centisecond
-            self.clock = min(self.clock + 1, 0o7777)
+            self.steps += 1
 
     def save_tape(self, filename):
         with open(filename, 'w') as f:
@@ -612,11 +2121,15 @@ class Emu:
 if __name__ == '__main__':
     assert len(sys.argv) >= 2
     filename = sys.argv[1]
+    engine = sys.argv[2] if len(sys.argv) >= 3 else 'ref'
 
-    emu = Emu.from_filename(filename, use_gpu=True)
+    # Without pygame there's no window, but the GPU still works
+    emu = Emu.from_filename(
+        filename, use_gpu=True,
+        gpu_backend=gpu.HeadlessGpu() if gpu.pygame is None else None)
 
     try:
-        emu.run()
+        emu.run(engine=engine)
     except KeyboardInterrupt:
         traceback.print_exc(file=sys.stdout)
         # Print the PC before we quit
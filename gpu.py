@@ -1,9 +1,39 @@
+'''
+GPU backends. `Emu` talks to its GPU through these methods:
+
+- `start()` and `quit()`
+- `set_x(i)`, `set_y(i)` and `draw(color)`, for the GPU IO devices
+- `update()`: Present the frame, returning whether to quit
+- `snapshot()` and `restore(state)`: Coordinates and RGB framebuffer
+
+`Gpu` draws to a pygame window. `HeadlessGpu` keeps the framebuffer in a
+NumPy array instead, for machines without a display. pygame and NumPy are
+each only needed by the backend that uses them.
+'''
+
 import sys
-import pygame
-from pygame import gfxdraw
+
+try:
+    import pygame
+    from pygame import gfxdraw
+except ImportError:
+    pygame = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Color channel, 2 bits -> 8 bits
+levels = [0x00, 0x55, 0xaa, 0xff]
+
 
 class Gpu:
     def start(self):
+        if pygame is None:
+            raise ImportError(
+                'pygame is needed for the window, see HeadlessGpu')
+
         self.base_size = (64, 64)
         self.scale = 8
         self.size = (
@@ -26,7 +56,9 @@ class Gpu:
         pygame.display.quit()
 
     def update(self):
-        '''Return value: whether the window got a signal to quit (e.g. Alt+F4)'''
+        '''
+        Return value: whether the window got a signal to quit (e.g. Alt+F4)
+        '''
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 return True
@@ -37,6 +69,15 @@ class Gpu:
         pygame.display.flip()
         return False
 
+    def snapshot(self):
+        '''Coordinates and RGB framebuffer, for `restore`'''
+        return (self.x, self.y, pygame.image.tobytes(self.buf, 'RGB'))
+
+    def restore(self, state):
+        (self.x, self.y, pixels) = state
+        buf = pygame.image.frombytes(pixels, self.base_size, 'RGB')
+        self.buf.blit(buf, (0, 0))
+
     def set_x(self, i):
         self.x = i
 
@@ -55,17 +96,9 @@ class Gpu:
         color = color >> 2
         r = color & mask
 
-        def scale(x):
-            return {
-                0b00: 0x00,
-                0b01: 0x55,
-                0b10: 0xaa,
-                0b11: 0xff,
-            }[x]
-
-        b = scale(b)
-        g = scale(g)
-        r = scale(r)
+        b = levels[b]
+        g = levels[g]
+        r = levels[r]
 
         gfxdraw.pixel(
             self.buf,
@@ -74,6 +107,69 @@ class Gpu:
         )
 
 
+class HeadlessGpu:
+    '''
+    GPU without a window. The framebuffer is a 64x64 array of the 6-bit
+    colors as drawn, indexed `[y, x]`, and is only converted to RGB when a
+    frame is asked for.
+    '''
+
+    base_size = (64, 64)
+
+    def start(self):
+        if np is None:
+            raise ImportError('NumPy is needed for HeadlessGpu')
+
+        # RRGGBB -> RGB
+        self.palette = np.array(
+            [(levels[(c >> 4) & 0b11], levels[(c >> 2) & 0b11],
+              levels[c & 0b11]) for c in range(64)],
+            dtype=np.uint8)
+
+        self.buf = np.zeros(self.base_size[::-1], dtype=np.uint8)
+        self.presented = self.buf.copy()  # As of the last `update`
+        self.frames = 0
+
+        self.x, self.y = 0, 0
+
+    def quit(self):
+        pass
+
+    def update(self):
+        self.presented[:] = self.buf
+        self.frames += 1
+        return False
+
+    def frame(self, presented=True):
+        '''
+        64x64x3 RGB array of the last frame presented, or of the framebuffer
+        as it is now without `presented`
+        '''
+        return self.palette[self.presented if presented else self.buf]
+
+    def snapshot(self):
+        '''Coordinates and RGB framebuffer, like `Gpu.snapshot`'''
+        return (self.x, self.y, self.frame(presented=False).tobytes())
+
+    def restore(self, state):
+        (self.x, self.y, pixels) = state
+        rgb = np.frombuffer(pixels, dtype=np.uint8).reshape(
+            self.base_size[::-1] + (3,)) // 0x55
+        self.buf[:] = (rgb[..., 0] << 4) | (rgb[..., 1] << 2) | rgb[..., 2]
+
+        # Snapshots don't keep the last frame, so the restored one stands in
+        self.presented[:] = self.buf
+
+    def set_x(self, i):
+        self.x = i
+
+    def set_y(self, i):
+        self.y = i
+
+    def draw(self, color):
+        self.buf[self.y, self.x] = color
+
+
 if __name__ == '__main__':
     gpu = Gpu()
     gpu.start()
@@ -0,0 +1,150 @@
+'''
+Execution history for running backwards in the debugger.
+
+Instead of logging every change to the machine, a `History` keeps a snapshot
+every `interval` instructions and the serial input typed so far. Any earlier
+point is reached by restoring the nearest snapshot before it and running
+forward again, feeding back the same input. This needs a deterministic clock,
+which `Emu.run_dbg` uses.
+'''
+
+import io
+
+from emu import *
+
+# Ops that write register `a`
+rd_ops = {
+    Op.ADD, Op.SUB, Op.OR, Op.XOR, Op.AND, Op.SHL, Op.SHR,
+    Op.ADDI, Op.ORI, Op.XORI, Op.ANDI, Op.SHI, Op.FM, Op.LD,
+}
+
+# Devices that write `rd`. The clock ones only do when `rs` is 0.
+rd_io_devices = {
+    IoDevice.SERIAL_INCOMING,
+    IoDevice.SERIAL_READ,
+    IoDevice.CLOCK_LO_CS,
+    IoDevice.CLOCK_HI_CS,
+    IoDevice.MEM_READ,
+}
+
+
+def io_device(ins):
+    '''Device of an IO instruction, or None'''
+    if ins.op == Op.IO and ins.b in {d.value for d in IoDevice}:
+        return IoDevice(ins.b)
+    return None
+
+
+def written_reg(emu, ins):
+    '''Register that `ins` writes if executed now, or None'''
+    if not emu.should_execute(ins):
+        return None
+
+    if ins.op in rd_ops:
+        return ins.a
+    elif ins.op == Op.ST:
+        return (emu.regs[ins.b] + ins.c) & 0o77
+
+    ix = io_device(ins)
+    if ix in rd_io_devices:
+        if ix in {IoDevice.CLOCK_LO_CS, IoDevice.CLOCK_HI_CS} and ins.c != 0:
+            return None
+        return ins.a
+    return None
+
+
+class History:
+    '''
+    Checkpoints of `emu`, taken by calling `record` before each instruction.
+
+    At most `max_checkpoints` are kept. When there would be more, every other
+    one is dropped and `interval` doubles, so the whole run stays reachable
+    at the cost of longer replays.
+    '''
+
+    def __init__(self, emu, interval=10000, max_checkpoints=100):
+        self.emu = emu
+        self.interval = interval
+        self.max_checkpoints = max_checkpoints
+        self.checkpoints = []  # Snapshots, oldest first
+
+        # `Emu.steps` -> input added to the buffer by `get_input` at that step.
+        # Input that was typed once is fed back on every later replay.
+        self.inputs = {}
+        self.read_input = emu.get_input
+        emu.get_input = self.get_input
+
+    def get_input(self):
+        emu = self.emu
+        if emu.steps in self.inputs:
+            emu.buffer += self.inputs[emu.steps]
+        else:
+            n = len(emu.buffer)
+            self.read_input()
+            self.inputs[emu.steps] = emu.buffer[n:]
+
+    def record(self):
+        '''Take a checkpoint if the last one is `interval` or more steps ago'''
+        if self.checkpoints and \
+                self.emu.steps - self.checkpoints[-1].steps < self.interval:
+            return
+
+        self.checkpoints.append(self.emu.snapshot())
+        if len(self.checkpoints) > self.max_checkpoints:
+            self.checkpoints = self.checkpoints[::2]
+            self.interval *= 2
+
+    def start(self):
+        '''Earliest step that can be gone back to'''
+        return self.checkpoints[0].steps
+
+    def replay(self, snapshot, end, pred=None):
+        '''
+        Restore `snapshot` and run up to step `end`. Returns the last step
+        before which `pred(emu)` was true, if given.
+        '''
+        emu = self.emu
+        emu.restore(snapshot)
+
+        # Output was already shown the first time around
+        out = emu.out
+        emu.out = io.StringIO()
+        found = None
+        try:
+            while emu.steps < end and not emu.halted:
+                if pred is not None and pred(emu):
+                    found = emu.steps
+                emu.step()
+        finally:
+            emu.out = out
+        return found
+
+    def travel(self, steps):
+        '''Go back to just before step `steps`'''
+        steps = max(steps, self.start())
+        snapshot = [s for s in self.checkpoints if s.steps <= steps][-1]
+        self.replay(snapshot, steps)
+
+    def run_back(self, pred):
+        '''
+        Go back to the last step before the current one where `pred(emu)` is
+        true. If there's none, go back as far as possible. Returns whether
+        one was found.
+        '''
+        end = self.emu.steps
+        snapshots = [s for s in self.checkpoints if s.steps < end]
+        for i in reversed(range(len(snapshots))):
+            seg_end = end if i == len(snapshots) - 1 \
+                else snapshots[i + 1].steps
+            found = self.replay(snapshots[i], seg_end, pred)
+            if found is not None:
+                self.travel(found)
+                return True
+
+        self.travel(self.start())
+        return False
+
+    def last_write(self, reg):
+        '''Go back to the last instruction that wrote register `reg`'''
+        return self.run_back(
+            lambda emu: written_reg(emu, emu.tape[emu.pc]) == reg)
@@ -0,0 +1,346 @@
+'''
+Trace JIT.
+
+Runs the decoded records, counting taken backward jumps per target. Once a
+target has been jumped to `threshold` times, one iteration of the loop
+starting there is recorded and compiled into a Python `while` loop,
+specialized on the path that iteration took. Jumps on the path become
+guards, and the compiled loop runs until one of them fails. It then hands
+back to the interpreter at that jump.
+'''
+
+from emu import *
+from compiler import rd_exprs, rd_imm_ops, cm_exprs
+
+# Longest loop iteration that gets compiled
+max_trace_len = 1000
+
+
+class TraceGen:
+    '''
+    Generates the function for a recorded trace. `entries` is a list of
+    `(pc, executed, cf, value)`, where `cf` is the carry flag before the
+    instruction ran and `value` is the jump register for jumps. Jumps are
+    guarded to take the same path as recorded, while other conditional
+    instructions become `if` statements.
+
+    Every register the trace touches is kept in a local for the whole run
+    and written back to the register list `r` before anything that could
+    look at it.
+    '''
+
+    def __init__(self, tape, entries, name):
+        self.tape = tape
+        self.entries = entries
+        self.name = name
+        self.consts = {}
+        self.lines = []
+
+        self.used = set()
+        self.written = set()
+        for (pc, executed, cf_, value_) in entries:
+            ins = tape[pc]
+            if ins.op in rd_exprs or ins.op in {Op.SHI, Op.FM, Op.LD}:
+                self.written.add(ins.a)
+            elif ins.op == Op.IO:
+                self.written.add(ins.a)
+            self.used |= {ins.a, ins.b, ins.c}
+        self.used.discard(0)
+        self.written.discard(0)
+
+        # Steps already added to `emu.steps` in this iteration
+        self.accounted = 0
+
+    def emit(self, line, indent=2):
+        self.lines.append('    ' * indent + line)
+
+    def const(self, expr):
+        if expr not in self.consts:
+            self.consts[expr] = '{}_k{}'.format(self.name, len(self.consts))
+        return self.consts[expr]
+
+    def reg(self, i):
+        return '0' if i == 0 else 'r{}'.format(i)
+
+    def load(self, regs, indent=2):
+        for i in sorted(regs):
+            self.emit('r{0} = r[{0}]'.format(i), indent)
+
+    def flush(self, indent=2):
+        for i in sorted(self.written):
+            self.emit('r[{0}] = r{0}'.format(i), indent)
+        self.emit('emu.cf = cf', indent)
+
+    def steps(self, i, indent=2):
+        if i != self.accounted:
+            self.emit('emu.steps += {}'.format(i - self.accounted), indent)
+
+        # The jumps taken since, which the trace doesn't search labels for
+        jumps = sum(
+            1 for (pc, executed, cf_, value_) in self.entries[self.accounted:i]
+            if executed and self.tape[pc].op in {Op.JUP, Op.JDN})
+        if jumps:
+            self.emit('emu.stats.jumps += {}'.format(jumps), indent)
+
+    def side_exit(self, i, pc):
+        '''Leave the trace before entry `i`, which is at `pc`'''
+        self.flush(3)
+        self.steps(i, 3)
+        self.emit('return {}'.format(pc), 3)
+
+    def guard_cf(self, i, pc, cf):
+        self.emit('if {}cf:'.format('' if not cf else 'not '))
+        self.side_exit(i, pc)
+
+    def gen_ins(self, i, pc, ins, indent):
+        '''Code for executing the instruction at entry `i`'''
+        op = ins.op
+        n = len(self.tape)
+
+        if op in rd_exprs:
+            if ins.a != 0:
+                b = str(ins.c) if op in rd_imm_ops else self.reg(ins.c)
+                expr = rd_exprs[op].format(a=self.reg(ins.b), b=b)
+                self.emit('r{} = {}'.format(ins.a, expr), indent)
+        elif op == Op.CMP:
+            (cmp_type, cm, a, b) = ins.as_cmp()
+            if cmp_type == CmpType.RA_RB:
+                left, right = self.reg(a), self.reg(b)
+            elif cmp_type == CmpType.RB_RA:
+                left, right = self.reg(b), self.reg(a)
+            elif cmp_type == CmpType.RA_IB:
+                left, right = self.reg(a), str(b)
+            elif cmp_type == CmpType.IA_RB:
+                left, right = str(a), self.reg(b)
+
+            if cm in cm_exprs:
+                expr = cm_exprs[cm].format(l=left, r=right)
+            else:
+                t = self.const('CMP[{}]'.format(cm))
+                expr = '{}[({} << 6) | {}]'.format(t, left, right)
+            self.emit('cf = {}'.format(expr), indent)
+        elif op == Op.SHI:
+            (shi_type, rd, ra, ib) = ins.as_shi()
+            if rd != 0:
+                t = self.const('SHI[{}][{}]'.format(shi_type, ib))
+                self.emit('r{} = {}[{}]'.format(rd, t, self.reg(ra)), indent)
+        elif op == Op.FM:
+            (fm_type, pr, rd, ra) = ins.as_fm()
+            if rd != 0:
+                t = self.const('fm_table({}, {})'.format(fm_type, pr))
+                self.emit('r{0} = {1}[(r{0} << 6) | {2}]'.format(
+                    rd, t, self.reg(ra)), indent)
+        elif op == Op.LD:
+            rd, ra, ib = ins.a, ins.b, ins.c
+            if rd != 0:
+                self.flush(indent)
+                self.emit('r{} = r[({} + {}) & 63]'.format(
+                    rd, self.reg(ra), ib), indent)
+        elif op == Op.ST:
+            rs, ra, ib = ins.a, ins.b, ins.c
+            self.flush(indent)
+            self.emit('i = ({} + {}) & 63'.format(self.reg(ra), ib), indent)
+            self.emit('if i:', indent)
+            self.emit('r[i] = {}'.format(self.reg(rs)), indent + 1)
+
+            # Any register could have changed
+            self.load(self.used, indent)
+        elif op == Op.IO:
+            # Registers are already written back, see `gen`
+            (rd, ix, rs) = ins.as_io()
+            func = Emu.op_io_switch.get(ix, Emu.io_unknown)
+            self.emit('emu.pc = {}'.format(pc), indent)
+            self.emit('emu.{}({}, {}, {})'.format(
+                func.__name__, rd, self.const(str(ix)), rs), indent)
+            if rd in self.used:
+                self.load({rd}, indent)
+            self.emit('if emu.halted:', indent)
+            self.steps(i + 1, indent + 1)
+            self.emit('return {}'.format((pc + 1) % n), indent + 1)
+
+    def gen_jump(self, i, pc, ins, value):
+        '''Guards for a jump that was taken at entry `i`'''
+        # The target only depends on the jump register and the carry flag, so
+        # pin those to what was recorded
+        if ins.c != 0:
+            self.emit('if r{} != {}:'.format(ins.c, value))
+            self.side_exit(i, pc)
+
+        key = (ins.partial_jump_key(), value)
+        reverse = ins.op == Op.JDN
+        if self.tape.find_label(key, False, pc, reverse) != \
+                self.tape.find_label(key, True, pc, reverse):
+            self.guard_cf(i, pc, self.entries[i][2])
+
+    def gen(self):
+        '''Generate the source of the function'''
+        self.emit('def {}(emu, r):'.format(self.name), 0)
+        self.load(self.used, 1)
+        self.emit('cf = emu.cf', 1)
+        self.emit('while True:', 1)
+
+        for i, (pc, executed, cf, value) in enumerate(self.entries):
+            ins = self.tape[pc]
+
+            # Labels do nothing whether or not they execute
+            if ins.op == Op.LBL:
+                continue
+
+            if ins.op in {Op.JUP, Op.JDN}:
+                # Only the path is specialized, so only jumps get guards
+                if ins.cond != Cond.UN:
+                    self.guard_cf(i, pc, cf)
+                if executed:
+                    self.gen_jump(i, pc, ins, value)
+                    if pc in self.tape.busy_waits():
+                        self.steps(i)
+                        self.accounted = i
+                        self.emit('emu.clock_model.wait(emu)')
+                continue
+
+            if ins.op == Op.IO:
+                self.flush()
+                self.steps(i)
+                self.accounted = i
+
+            # Other conditional instructions stay conditional
+            if ins.cond == Cond.UN:
+                self.gen_ins(i, pc, ins, 2)
+            else:
+                self.emit('if {}cf:'.format(
+                    '' if ins.cond == Cond.TR else 'not '))
+                self.gen_ins(i, pc, ins, 3)
+                # Writes to r0 generate nothing, which would leave the `if`
+                # without a body
+                if self.lines[-1].startswith('    ' * 2 + 'if '):
+                    self.lines.pop()
+
+        self.steps(len(self.entries))
+        self.accounted = 0
+
+        # Back at the start, so the interpreter can pick up from there
+        self.emit('if emu.steps >= emu.check_at:')
+        self.flush(3)
+        self.emit('return {}'.format(self.entries[0][0]), 3)
+
+        prelude = ['{} = {}'.format(k, expr)
+                   for expr, k in self.consts.items()]
+        return '\n'.join(prelude + self.lines) + '\n'
+
+
+class Traces:
+    '''Loop traces of a tape, and the decoded records that start them'''
+
+    def __init__(self, tape, threshold=50):
+        self.tape = tape
+        self.threshold = threshold
+
+        # Same as the decoded records, except jumps go through `self.jump`
+        self.code = [self.wrap(rec) for rec in tape.decoded()]
+
+        self.funcs = {}  # Loop start -> compiled trace
+        self.sources = {}  # Loop start -> generated source
+        self.pcs = {}  # Loop start -> positions on the trace
+        self.counts = {}  # Loop start -> backward jumps taken to it
+        self.ns = dict(globals())
+
+    def wrap(self, rec):
+        handler, cond, a, b, c = rec
+        if handler in {Emu.dop_jup, Emu.dop_jup_wait}:
+            return (self.jup, cond, a, b, c)
+        elif handler == Emu.dop_jdn:
+            return (self.jdn, cond, a, b, c)
+        return rec
+
+    def invalidate(self, start, end):
+        '''
+        Forget traces through `tape[start:end]`, after it was replaced by the
+        same number of instructions with no labels.
+        '''
+        decoded = self.tape.decoded()
+        for i in range(start, end):
+            self.code[i] = self.wrap(decoded[i])
+
+        for s, pcs in list(self.pcs.items()):
+            if any(start <= pc < end for pc in pcs):
+                del self.funcs[s]
+                del self.sources[s]
+                del self.pcs[s]
+                self.counts.pop(s, None)
+
+    def jup(self, emu, partial_key, rc, c_):
+        self.jump(emu, partial_key, rc, False)
+
+    def jdn(self, emu, partial_key, rc, c_):
+        self.jump(emu, partial_key, rc, True)
+
+    def jump(self, emu, partial_key, rc, reverse):
+        pc = emu.pc
+        key = (partial_key, emu.regs.data[rc])
+        target = emu.find_label(key, reverse)
+        if pc in self.tape.busy_waits():
+            emu.clock_model.wait(emu)
+        emu.pc = target - 1
+        if target > pc:
+            return
+
+        func = self.funcs.get(target)
+        if func is None:
+            count = self.counts.get(target, 0) + 1
+            self.counts[target] = count
+            if count != self.threshold:
+                return
+
+        # The interpreter counts this jump once we return, but whatever runs
+        # from here on has to see it counted already
+        emu.steps += 1
+        emu.pc = target
+        if func is None:
+            self.record(emu, target)
+        else:
+            emu.pc = func(emu, emu.regs.data)
+        emu.steps -= 1
+
+        emu.pc -= 1
+
+    def record(self, emu, start):
+        '''
+        Run one iteration of the loop at `start` on the interpreter, and
+        compile it if it gets back to `start`.
+        '''
+        code = emu.tape.decoded()
+        jumps = {Emu.dop_jup, Emu.dop_jdn, Emu.dop_jup_wait}
+        entries = []
+        while len(entries) < max_trace_len:
+            pc = emu.pc
+            handler, cond, a, b, c = code[pc]
+            if handler in {Emu.dop_hlt, Emu.dop_ref}:
+                break
+
+            cf = emu.cf
+            value = emu.regs.data[b] if handler in jumps else None
+            executed = cond == 0 or (cond == 1) == cf
+            if executed:
+                handler(emu, a, b, c)
+            entries.append((pc, executed, cf, value))
+
+            emu.pc = (emu.pc + 1) % len(code)
+            emu.steps += 1
+            if emu.halted:
+                return
+            if emu.pc == start:
+                self.compile(start, entries)
+                return
+
+    def compile(self, start, entries):
+        name = 'trace_{}'.format(start)
+        src = TraceGen(self.tape, entries, name).gen()
+        exec(compile(src, '<{}>'.format(name), 'exec'), self.ns)
+        self.sources[start] = src
+        self.pcs[start] = {pc for (pc, executed_, cf_, value_) in entries}
+        self.funcs[start] = self.ns[name]
+
+
+def run_traces(emu):
+    '''Run `emu` until halted, compiling hot loops'''
+    emu.run_decoded(emu.tape.traces().code)
@@ -0,0 +1,129 @@
+'''
+Per-PC execution profile.
+
+A `Profile` has one counter per tape position for how many times it was
+reached, and one for how many times its condition passed and it executed.
+Counts per op and per IO device are added up from those afterwards, since
+each position always holds the same instruction. Memory doesn't grow with
+the length of the run, unlike `Emu.run(log_inss=True)`.
+
+`Disasm.disasm_tape` takes a profile to annotate the listing with.
+'''
+
+import sys
+
+from emu import *
+from history import io_device
+
+
+class Profile:
+    def __init__(self, tape):
+        self.tape = tape
+        self.hits = [0] * len(tape)  # Times each position was reached
+        self.executed = [0] * len(tape)  # Times its condition passed
+
+    def total(self):
+        '''Instructions reached'''
+        return sum(self.hits)
+
+    def by_op(self):
+        '''Map of `Op` -> instructions executed'''
+        ans = {}
+        for ins, n in zip(self.tape.data, self.executed):
+            if n:
+                ans[ins.op] = ans.get(ins.op, 0) + n
+        return ans
+
+    def by_io_device(self):
+        '''Map of `IoDevice` -> IO instructions executed'''
+        ans = {}
+        for ins, n in zip(self.tape.data, self.executed):
+            ix = io_device(ins)
+            if n and ix is not None:
+                ans[ix] = ans.get(ix, 0) + n
+        return ans
+
+    def branches(self):
+        '''Map of PC -> `(executed, skipped)` for conditional instructions'''
+        return {
+            i: (self.executed[i], self.hits[i] - self.executed[i])
+            for i, ins in enumerate(self.tape.data)
+            if ins.cond != Cond.UN and self.hits[i]
+        }
+
+    def annotations(self):
+        '''Column for each position in the annotated listing'''
+        total = self.total()
+        ans = []
+        for ins, hits, executed in zip(self.tape.data, self.hits,
+                                       self.executed):
+            if hits == 0:
+                ans.append(' ' * 30)
+                continue
+
+            note = '{:>12} {:>6.2f}%'.format(hits, 100 * hits / total)
+            if ins.cond != Cond.UN:
+                note += ' {:>9}'.format(
+                    '{:.0f}% ex'.format(100 * executed / hits))
+            else:
+                note += ' ' * 10
+            ans.append(note)
+        return ans
+
+    def summary(self, out=sys.stdout):
+        '''Write the per-op and per-device counts'''
+        total = self.total()
+        out.write('{} instructions\n'.format(total))
+        for title, counts in [('Op', self.by_op()),
+                              ('IO device', self.by_io_device())]:
+            out.write('\n{}:\n'.format(title))
+            for k, n in sorted(counts.items(), key=lambda kv: -kv[1]):
+                out.write('  {:<16} {:>12} {:>6.2f}%\n'.format(
+                    k.name, n, 100 * n / total))
+
+
+def run(emu, profile, code=None):
+    '''
+    Run `emu` like `Emu.run_decoded` on the decoded records, or `code` if
+    given, counting into `profile`
+    '''
+    if len(profile.hits) != len(emu.tape):
+        raise ValueError('Profile is for a different tape')
+
+    if code is None:
+        code = emu.tape.decoded()
+    n = len(code)
+    hits = profile.hits
+    executed = profile.executed
+
+    limit = emu.check_at
+    while not emu.halted:
+        pc = emu.pc
+        handler, cond, a, b, c = code[pc]
+        hits[pc] += 1
+        if cond == 0 or (cond == 1) == emu.cf:
+            executed[pc] += 1
+            handler(emu, a, b, c)
+        emu.pc = (emu.pc + 1) % n  # Tape is looped
+        emu.steps += 1
+
+        if emu.steps >= limit:
+            emu.check_in()
+            limit = emu.check_at
+
+
+if __name__ == '__main__':
+    assert len(sys.argv) >= 2
+    filename = sys.argv[1]
+    max_steps = int(sys.argv[2]) if len(sys.argv) >= 3 else None
+
+    emu = Emu.from_filename(filename)
+    profile = Profile(emu.tape)
+    try:
+        emu.run(engine='decoded', max_steps=max_steps, profile=profile)
+    except KeyboardInterrupt:
+        pass
+
+    Disasm.disasm_tape_to_file(emu.tape, filename + '.prof.asm',
+                               profile=profile)
+    profile.summary()
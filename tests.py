@@ -2,6 +2,22 @@ import unittest
 from ins import *
 from emu import *
 import io
+import json
+import random
+import bench
+import breakpoints
+import compiler
+import diffcheck
+import gpu
+import history
+import jit
+import profiler
+import timeline
+import tracefile
+import transpile
+import os
+import pickle
+import tempfile
 
 
 class TestIns(unittest.TestCase):
@@ -378,6 +394,79 @@ class TestEmu(unittest.TestCase):
         ins = Ins.from_io(Cond.UN, 1, IoDevice.CLOCK_HI_CS, 0)
         emu.execute(ins)
 
+    def test_checked(self):
+        emu = Emu()
+        emu.mem.page(0)[5] = 64
+        self.assertEqual(emu.mem[5], 64)
+        self.assertEqual(list(emu.mem[4:7]), [0, 64, 0])
+
+        emu = Emu(checked=True)
+        emu.regs[1] = 0o77 + 3
+        self.assertEqual(emu.regs[1], 2)
+        emu.mem.page(0)[5] = 64
+        with self.assertRaises(AssertionError):
+            emu.mem[5]
+        with self.assertRaises(AssertionError):
+            emu.mem[4:7]
+
+        # Other engines don't read through the checks
+        emu.tape = Tape.from_inss([Ins.halt()])
+        for engine in ['decoded', 'block', 'trace', 'aot']:
+            with self.assertRaises(ValueError):
+                emu.run(engine=engine)
+        emu.run(engine='ref')
+        self.assertTrue(emu.halted)
+
+    def test_mem_pages(self):
+        emu = Emu()
+        self.assertEqual(emu.mem.pages, {})
+        self.assertEqual(emu.mem[12345], 0)
+
+        # Writing the last word wraps around to the first
+        emu.mem.addr = 2**18 - 1
+        emu.regs[1] = 7
+        emu.execute(Ins.from_io(Cond.UN, 0, IoDevice.MEM_WRITE, 1))
+        emu.execute(Ins.from_io(Cond.UN, 0, IoDevice.MEM_WRITE, 1))
+        self.assertEqual(emu.mem.addr, 1)
+        self.assertEqual(len(emu.mem.pages), 2)
+
+        emu.mem.addr = 2**18 - 2
+        emu.execute(Ins.from_io(Cond.UN, 2, IoDevice.MEM_READ, 0))
+        emu.execute(Ins.from_io(Cond.UN, 3, IoDevice.MEM_READ, 0))
+        self.assertEqual((emu.regs[2], emu.regs[3]), (0, 7))
+        self.assertEqual(list(emu.mem[2**18 - 2:2**18]), [0, 7])
+        self.assertEqual(list(emu.mem[:2]), [7, 0])
+
+    def test_io_clock_virtual(self):
+        emu = Emu(clock=VirtualClock(ins_per_cs=2))
+        emu.tape = Tape.from_inss([
+            Ins.from_values(Op.ADD, Cond.UN, 0, 0, 0),
+            Ins.from_values(Op.ADD, Cond.UN, 0, 0, 0),
+            Ins.from_values(Op.ADD, Cond.UN, 0, 0, 0),
+            Ins.from_values(Op.ADD, Cond.UN, 0, 0, 0),
+            Ins.from_io(Cond.UN, 1, IoDevice.CLOCK_LO_CS, 0),
+            Ins.from_io(Cond.UN, 0, IoDevice.CLOCK_LO_CS, 1),
+            Ins.from_io(Cond.UN, 2, IoDevice.CLOCK_LO_CS, 0),
+            Ins.halt(),
+        ])
+        emu.run(engine='decoded')
+        self.assertEqual(emu.regs[1], 2)
+        self.assertEqual(emu.regs[2], 0)
+
+    def test_io_clock_sampled(self):
+        emu = Emu(clock=RealClock(every=100))
+        ins = Ins.from_io(Cond.UN, 1, IoDevice.CLOCK_LO_CS, 0)
+        emu.execute(ins)
+        emu.clock_model.start -= 1
+
+        # Not sampled again until 100 instructions later
+        emu.steps += 99
+        emu.execute(ins)
+        self.assertEqual(emu.clock, 0)
+        emu.steps += 1
+        emu.execute(ins)
+        self.assertAlmostEqual(emu.clock, 100, delta=2)
+
     def test_mem_addr(self):
         emu = Emu()
         emu.mem.addr = 12345
@@ -427,5 +516,1084 @@ class TestEmu(unittest.TestCase):
         self.assertEqual(emu.mem.addr, (3 << 6) + 1)
 
 
+class EngineTestCase(unittest.TestCase):
+    '''Helpers for comparing engines against the reference interpreter'''
+
+    def loop_inss(self):
+        return [
+            Ins.from_values(Op.ADDI, Cond.UN, 1, 0, 7),
+            Ins.from_values(Op.ADDI, Cond.UN, 2, 0, 0),
+            Ins.from_values(Op.LBL, Cond.UN, 0, 1, 0),
+            Ins.from_values(Op.ADD, Cond.UN, 2, 2, 1),
+            Ins.from_values(Op.SUB, Cond.UN, 3, 0, 2),
+            Ins.from_values(Op.XOR, Cond.UN, 4, 3, 1),
+            Ins.from_shi(Cond.UN, 5, 3, ShiType.ROLI, 5),
+            Ins.from_shi(Cond.UN, 6, 3, ShiType.SARI, 2),
+            Ins.from_fm(Cond.UN, 4, 3, FmType.S, 3),
+            Ins.from_values(Op.ST, Cond.UN, 4, 1, 3),
+            Ins.from_cmp(Cond.UN, CmpType.RA_IB, Cm.UL, 1, 4),
+            Ins.from_values(Op.LD, Cond.TR, 9, 1, 8),
+            Ins.from_values(Op.ADD, Cond.FA, 10, 10, 1),
+            Ins.from_io(Cond.UN, 0, IoDevice.MEM_WRITE, 5),
+            Ins.from_values(Op.ADDI, Cond.UN, 1, 1, 63),
+            Ins.from_cmp(Cond.UN, CmpType.IA_RB, Cm.SL, 0, 1),
+            Ins.from_values(Op.JUP, Cond.TR, 0, 1, 0),
+            Ins.from_values(Op.ADDI, Cond.FA, 7, 0, 1),
+            Ins.from_values(Op.ADDI, Cond.TR, 8, 0, 1),
+            Ins.halt(),
+        ]
+
+    def assert_same_state(self, emu, ref):
+        self.assertEqual(emu.regs.data, ref.regs.data)
+        self.assertEqual(emu.mem.to_bytes(), ref.mem.to_bytes())
+        self.assertEqual(emu.mem.addr, ref.mem.addr)
+        self.assertEqual((emu.pc, emu.cf), (ref.pc, ref.cf))
+        self.assertEqual(emu.steps, ref.steps)
+
+
+class TestEngines(EngineTestCase):
+    engines = ['decoded', 'block', 'trace']
+
+    def test_matches_ref(self):
+        ref = Emu()
+        ref.tape = Tape.from_inss(self.loop_inss())
+        ref.run()
+        self.assertEqual(ref.mem.addr, 7)
+
+        for engine in self.engines:
+            emu = Emu()
+            emu.tape = Tape.from_inss(self.loop_inss())
+            emu.run(engine=engine)
+            self.assert_same_state(emu, ref)
+
+    def test_switch_mid_run(self):
+        ref = Emu()
+        ref.tape = Tape.from_inss(self.loop_inss())
+        ref.run()
+
+        # Start on the reference interpreter and finish on compiled blocks
+        emu = Emu()
+        emu.tape = Tape.from_inss(self.loop_inss())
+        for i in range(40):
+            emu.step()
+        compiler.run_blocks(emu, threshold=1)
+        self.assert_same_state(emu, ref)
+
+    def test_malformed(self):
+        # FM and CMP with unknown variants only fail once executed
+        for ins in [Ins.from_values(Op.FM, Cond.UN, 1, 2, 0o20),
+                    Ins.from_values(Op.CMP, Cond.UN, 0o40, 2, 3)]:
+            for engine in self.engines:
+                emu = Emu()
+                emu.tape = Tape.from_inss([
+                    Ins.from_values(Op.JUP, Cond.TR, 0, 0, 0),
+                    ins,
+                ])
+                emu.tape.decoded()
+                with self.assertRaises(ValueError):
+                    emu.run(engine=engine)
+
+                # Skipped, they don't fail at all
+                emu = Emu()
+                emu.tape = Tape.from_inss([
+                    Ins.from_cmp(Cond.UN, CmpType.RA_RB, Cm.FA, 0, 0),
+                    Ins.from_values(ins.op, Cond.TR, ins.a, ins.b, ins.c),
+                    Ins.halt(),
+                ])
+                emu.run(engine=engine)
+                self.assertTrue(emu.halted)
+
+    def test_block_source(self):
+        emu = Emu()
+        emu.tape = Tape.from_inss(self.loop_inss())
+        blocks = emu.tape.blocks()
+        self.assertEqual(blocks.end(2), 14)
+        self.assertEqual(blocks.end(14), 17)
+
+        blocks.compile(2)
+        self.assertIn('def block_2(emu, r):', blocks.sources[2])
+
+    def test_fused(self):
+        inss = [
+            Ins.from_values(Op.ADDI, Cond.UN, 1, 0, 3),
+            Ins.from_values(Op.LBL, Cond.UN, 0, 1, 0),
+            Ins.from_values(Op.ADDI, Cond.UN, 2, 1, 10),
+            Ins.from_io(Cond.UN, 0, IoDevice.SERIAL_WRITE, 2),
+            Ins.from_values(Op.ADDI, Cond.UN, 2, 1, 20),
+            Ins.from_io(Cond.FA, 0, IoDevice.MEM_WRITE, 2),
+            Ins.from_values(Op.ADDI, Cond.UN, 1, 1, 63),
+            Ins.from_cmp(Cond.UN, CmpType.RA_IB, Cm.EQ, 1, 0),
+            Ins.from_values(Op.JUP, Cond.FA, 0, 1, 0),
+            Ins.from_cmp(Cond.UN, CmpType.RA_RB, Cm.EQ, 1, 2),
+            Ins.from_values(Op.JDN, Cond.FA, 0, 2, 0),
+            Ins.halt(),
+            Ins.from_values(Op.LBL, Cond.UN, 0, 2, 0),
+            Ins.halt(),
+        ]
+        ref = Emu()
+        ref.out = io.StringIO()
+        ref.tape = Tape.from_inss(inss)
+        ref.run()
+
+        emu = Emu()
+        emu.out = io.StringIO()
+        emu.tape = Tape.from_inss(inss)
+        fused = [i for i, (a, b) in
+                 enumerate(zip(emu.tape.fused(), emu.tape.decoded()))
+                 if a is not b]
+        self.assertEqual(fused, [2, 4, 7, 9])
+
+        emu.run(engine='decoded')
+        self.assert_same_state(emu, ref)
+        self.assertEqual(emu.out.getvalue(), ref.out.getvalue())
+        self.assertEqual(emu.pc, 0)
+
+    def test_trace(self):
+        ref = Emu()
+        ref.tape = Tape.from_inss(self.loop_inss())
+        ref.run()
+
+        emu = Emu()
+        emu.tape = Tape.from_inss(self.loop_inss())
+        emu.tape._traces = jit.Traces(emu.tape, threshold=2)
+        emu.run(engine='trace')
+        self.assert_same_state(emu, ref)
+        self.assertEqual(list(emu.tape.traces().funcs), [2])
+
+        # Conditional writes to r0 in the loop
+        inss = [
+            Ins.from_values(Op.LBL, Cond.UN, 0, 1, 0),
+            Ins.from_values(Op.ADDI, Cond.TR, 0, 1, 1),
+            Ins.from_values(Op.ADDI, Cond.UN, 1, 1, 1),
+            Ins.from_cmp(Cond.UN, CmpType.RA_IB, Cm.NE, 1, 0),
+            Ins.from_values(Op.JUP, Cond.TR, 0, 1, 0),
+            Ins.halt(),
+        ]
+        ref = Emu()
+        ref.tape = Tape.from_inss(inss)
+        ref.run()
+
+        emu = Emu()
+        emu.tape = Tape.from_inss(inss)
+        emu.tape._traces = jit.Traces(emu.tape, threshold=2)
+        emu.run(engine='trace')
+        self.assert_same_state(emu, ref)
+        self.assertEqual(list(emu.tape.traces().funcs), [0])
+
+
+class TestTranspile(EngineTestCase):
+    def test_matches_ref(self):
+        inss = self.loop_inss()
+        ref = Emu()
+        ref.tape = Tape.from_inss(inss)
+        ref.run()
+
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, 'loop.rom.py')
+            transpile.transpile_to_file(Tape.from_inss(inss), filename)
+            module = transpile.load(filename)
+
+        emu = Emu()
+        emu.tape = Tape.from_inss(inss)
+        transpile.run(emu, module)
+        self.assert_same_state(emu, ref)
+
+        # Refuses to run a different ROM
+        emu = Emu()
+        emu.tape = Tape.from_inss(inss[1:])
+        with self.assertRaises(ValueError):
+            transpile.run(emu, module)
+
+        # Picks up in the middle of a block
+        for steps in range(1, 12):
+            emu = Emu()
+            emu.tape = Tape.from_inss(inss)
+            emu.run(max_steps=steps)
+            transpile.run(emu, module)
+            self.assert_same_state(emu, ref)
+
+
+class TestSnapshot(EngineTestCase):
+    def test_restore(self):
+        ref = Emu(clock=VirtualClock())
+        ref.tape = Tape.from_inss(self.loop_inss())
+        ref.run()
+
+        emu = Emu(clock=VirtualClock())
+        emu.tape = Tape.from_inss(self.loop_inss())
+        emu.buffer = 'HI'
+        for i in range(40):
+            emu.step()
+        snapshot = emu.snapshot()
+        emu.run()
+        self.assert_same_state(emu, ref)
+
+        # Round trip through the on-disk format and pickling
+        data = snapshot.to_bytes()
+        snapshot = Snapshot.from_bytes(data)
+        self.assertEqual(snapshot.to_bytes(), data)
+        snapshot = pickle.loads(pickle.dumps(snapshot))
+
+        emu = Emu(clock=VirtualClock())
+        emu.tape = Tape.from_inss(self.loop_inss())
+        emu.restore(snapshot)
+        self.assertEqual((emu.steps, emu.buffer), (40, 'HI'))
+        emu.run(engine='decoded')
+        self.assert_same_state(emu, ref)
+
+    def test_warm_start(self):
+        inss = [
+            Ins.from_values(Op.ADDI, Cond.UN, 1, 0, 17),
+            Ins.from_io(Cond.UN, 0, IoDevice.SERIAL_WRITE, 1),
+            Ins.from_values(Op.ADDI, Cond.UN, 2, 0, 5),
+            Ins.from_io(Cond.UN, 0, IoDevice.MEM_WRITE, 2),
+            Ins.from_io(Cond.UN, 3, IoDevice.SERIAL_INCOMING, 0),
+            Ins.from_io(Cond.UN, 4, IoDevice.CLOCK_LO_CS, 0),
+            Ins.halt(),
+        ]
+
+        def make():
+            emu = Emu(clock=VirtualClock())
+            emu.out = io.StringIO()
+            emu.tape = Tape.from_inss(inss)
+            return emu
+
+        ref = make()
+        ref.buffer = 'AB'
+        ref.run()
+
+        with tempfile.TemporaryDirectory() as d:
+            # The first run fills the cache, the second one uses it
+            for i in range(2):
+                emu = make()
+                emu.warm_start(d)
+                self.assertEqual(emu.pc, 4)
+                self.assertEqual(len(os.listdir(d)), 2)
+
+                emu.buffer = 'AB'
+                emu.run()
+                self.assert_same_state(emu, ref)
+                self.assertEqual(emu.out.getvalue(), ref.out.getvalue())
+
+            # A half written snapshot is a miss, and gets replaced
+            (snap,) = [f for f in os.listdir(d) if f.endswith('.snap')]
+            snap = os.path.join(d, snap)
+            with open(snap, 'rb') as f:
+                data = f.read()
+            with self.assertRaises(ValueError):
+                Snapshot.from_bytes(data[:-1])
+            with open(snap, 'wb') as f:
+                f.write(data[:-1])
+
+            emu = make()
+            emu.warm_start(d)
+            self.assertEqual(emu.pc, 4)
+            self.assertEqual(len(os.listdir(d)), 2)
+            with open(snap, 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+            # Cached apart from the entry for `VirtualClock`, whose clock
+            # state is in instructions instead of centiseconds
+            emu = Emu(clock=RealClock())
+            emu.tape = Tape.from_inss(inss)
+            emu.out = io.StringIO()
+            emu.warm_start(d)
+            self.assertEqual(len(os.listdir(d)), 4)
+            self.assertLess(emu.read_clock(), 100)
+
+    def test_bad_magic(self):
+        data = Emu().snapshot().to_bytes()
+        with self.assertRaises(ValueError):
+            Snapshot.from_bytes(b'X' + data[1:])
+
+
+class TestHistory(EngineTestCase):
+    def run_recorded(self, inss, n, **kwargs):
+        emu = Emu(clock=VirtualClock())
+        emu.out = io.StringIO()
+        emu.tape = Tape.from_inss(inss)
+        emu.history = history.History(emu, **kwargs)
+        states = []
+        while not emu.halted and emu.steps < n:
+            emu.history.record()
+            states.append(emu.snapshot())
+            emu.step()
+        return emu, states
+
+    def assert_at(self, emu, snapshot):
+        self.assertEqual(emu.snapshot().to_bytes(), snapshot.to_bytes())
+
+    def test_travel(self):
+        emu, states = self.run_recorded(
+            self.loop_inss(), 1000, interval=4, max_checkpoints=5)
+
+        # Checkpoints got thinned out
+        self.assertLessEqual(len(emu.history.checkpoints), 5)
+        self.assertGreater(emu.history.interval, 4)
+
+        for steps in [len(states) - 1, 30, 3, 0]:
+            emu.history.travel(steps)
+            self.assert_at(emu, states[steps])
+
+        # Can run forward again from the past
+        emu.run()
+        self.assertEqual(emu.mem.addr, 7)
+
+    def test_last_write(self):
+        emu, states = self.run_recorded(self.loop_inss(), 1000, interval=8)
+
+        # The last write to r9 is the LD on the last iteration
+        self.assertTrue(emu.history.last_write(9))
+        self.assertEqual(emu.tape[emu.pc].op, Op.LD)
+        self.assert_at(emu, states[emu.steps])
+        self.assertTrue(emu.history.last_write(9))
+        self.assertEqual(emu.tape[emu.pc].op, Op.LD)
+
+        # r11 is never written
+        self.assertFalse(emu.history.last_write(11))
+        self.assertEqual(emu.steps, 0)
+
+    def test_input_replay(self):
+        inss = [
+            Ins.from_io(Cond.UN, 1, IoDevice.SERIAL_READ, 0),
+            Ins.from_io(Cond.UN, 0, IoDevice.SERIAL_WRITE, 1),
+            Ins.from_io(Cond.UN, 2, IoDevice.SERIAL_READ, 0),
+            Ins.halt(),
+        ]
+        typed = iter('AB')
+
+        emu = Emu(clock=VirtualClock())
+        emu.out = io.StringIO()
+        emu.tape = Tape.from_inss(inss)
+        emu.get_input = lambda: setattr(emu, 'buffer', next(typed))
+        emu.history = history.History(emu)
+        while not emu.halted:
+            emu.history.record()
+            emu.step()
+
+        # Going back doesn't ask for input or print again
+        emu.history.travel(3)
+        self.assertEqual((emu.regs[1], emu.regs[2]), (10, 11))
+        self.assertEqual(emu.out.getvalue(), 'A')
+
+
+class TestBreakpoints(EngineTestCase):
+    def stops(self, points):
+        '''(steps, PC) at each stop until halted'''
+        emu = Emu()
+        emu.tape = Tape.from_inss(self.loop_inss())
+        ans = []
+        while True:
+            stop = breakpoints.run(emu, points)
+            if stop is None:
+                break
+            ans.append((emu.steps, emu.pc))
+
+            # Get past the breakpoint
+            emu.step()
+        return ans
+
+    def test_breakpoints(self):
+        self.assertEqual(
+            self.stops([breakpoints.PcBreak(11, 'r[1] < 3')]),
+            [(86, 11), (101, 11)])
+
+        # Labels stop however they are reached
+        label = breakpoints.LabelBreak((1, 0))
+        self.assertEqual(len(self.stops([label])), 7)
+
+        # Only when the IO executes
+        device = breakpoints.IoBreak(IoDevice.MEM_WRITE, 'mem.addr > 4')
+        self.assertEqual(
+            [pc for (steps, pc) in self.stops([device])], [13, 13])
+
+    def test_watchpoints(self):
+        # Stops after the write, including ST to r7
+        self.assertEqual(
+            self.stops([breakpoints.RegWatch(7)]), [(55, 10), (108, 18)])
+        self.assertEqual(
+            len(self.stops([breakpoints.RegWatch(1, 'r[1] % 2 == 0')])), 4)
+        self.assertEqual(
+            self.stops([breakpoints.MemWatch(3)]), [(59, 14)])
+        self.assertEqual(len(self.stops([breakpoints.AddrWatch()])), 7)
+
+    def test_same_state(self):
+        ref = Emu()
+        ref.tape = Tape.from_inss(self.loop_inss())
+        ref.run()
+
+        emu = Emu()
+        emu.tape = Tape.from_inss(self.loop_inss())
+        emu.run()
+        self.assertIsNone(breakpoints.run(emu, [breakpoints.PcBreak(5)]))
+
+        emu = Emu()
+        emu.tape = Tape.from_inss(self.loop_inss())
+        points = [breakpoints.PcBreak(5), breakpoints.RegWatch(4)]
+        while breakpoints.run(emu, points) is not None:
+            emu.step()
+        self.assert_same_state(emu, ref)
+
+
+class TestLabels(unittest.TestCase):
+    def linear_find_label(self, emu, key, reverse):
+        n = len(emu.tape)
+        for d in range(1, n):
+            i = (emu.pc + d) % n if reverse else (emu.pc - d) % n
+            ins = emu.tape[i]
+            if ins.op == Op.LBL and emu.should_execute(ins) and \
+                    ins.label_key() == key:
+                return i
+        return None
+
+    def test_matches_linear_search(self):
+        rng = random.Random(1)
+        conds = [Cond.UN, Cond.TR, Cond.FA]
+        inss = []
+        for i in range(200):
+            if rng.random() < 0.5:
+                inss.append(Ins.from_values(
+                    Op.LBL, rng.choice(conds), 0, rng.randrange(3),
+                    rng.randrange(2)))
+            else:
+                inss.append(Ins.from_values(Op.ADD, Cond.UN, 0, 0, 0))
+
+        emu = Emu()
+        emu.tape = Tape.from_inss(inss)
+        for pc in range(len(inss)):
+            for cf in [False, True]:
+                for key in [(b, c) for b in range(4) for c in range(2)]:
+                    for reverse in [False, True]:
+                        emu.pc, emu.cf = pc, cf
+                        exp = self.linear_find_label(emu, key, reverse)
+                        if exp is None:
+                            with self.assertRaises(ValueError):
+                                emu.find_label(key, reverse)
+                        else:
+                            self.assertEqual(emu.find_label(key, reverse), exp)
+
+
+class TestPatch(EngineTestCase):
+    def random_ins(self, rng):
+        choices = [
+            Ins.from_values(Op.LBL, rng.choice([Cond.UN, Cond.FA]), 0,
+                            rng.randrange(3), rng.randrange(2)),
+            Ins.from_values(Op.ADDI, Cond.UN, 1, 1, rng.randrange(64)),
+            Ins.from_io(Cond.UN, 0, IoDevice.MEM_WRITE, 1),
+            Ins.from_cmp(Cond.UN, CmpType.RA_IB, Cm.EQ, 1, 0),
+            Ins.from_values(Op.JUP, Cond.FA, 0, rng.randrange(3), 0),
+        ]
+        return rng.choice(choices)
+
+    def test_derived(self):
+        rng = random.Random(2)
+        tape = Tape.from_inss([self.random_ins(rng) for i in range(100)])
+        for i in range(50):
+            tape.decoded()
+            tape.fused()
+            tape.labels()
+
+            start = rng.randrange(len(tape))
+            inss = [self.random_ins(rng) for j in range(rng.randrange(4))]
+            rng.choice([
+                lambda: tape.replace(start, inss[:len(tape) - start]),
+                lambda: tape.insert(start, inss),
+                lambda: tape.delete(start, rng.randrange(3)),
+            ])()
+
+            fresh = Tape.from_inss(list(tape.data))
+            self.assertEqual(tape.decoded(), fresh.decoded())
+            self.assertEqual(tape.fused(), fresh.fused())
+            self.assertEqual(tape.labels(), fresh.labels())
+
+    def test_patch_and_continue(self):
+        tape = Tape.from_inss(self.loop_inss())
+        emu = Emu()
+        emu.tape = tape
+        emu.run(engine='block')
+        tape.traces().threshold = 2
+        emu = Emu()
+        emu.tape = tape
+        emu.run(engine='trace')
+        self.assertIn(2, tape.blocks().funcs)
+        self.assertIn(2, tape.traces().funcs)
+
+        # XOR becomes OR, in the middle of the loop
+        ins = Ins.from_values(Op.OR, Cond.UN, 4, 3, 1)
+        tape.replace(5, [ins])
+        self.assertNotIn(2, tape.blocks().funcs)
+        self.assertNotIn(2, tape.traces().funcs)
+
+        inss = self.loop_inss()
+        inss[5] = ins
+        ref = Emu()
+        ref.tape = Tape.from_inss(inss)
+        ref.run()
+        for engine in ['decoded', 'block', 'trace']:
+            emu = Emu()
+            emu.tape = tape
+            emu.run(engine=engine)
+            self.assert_same_state(emu, ref)
+
+
+class TestBusyWait(EngineTestCase):
+    def wait_inss(self, body=[]):
+        # Wait for 8 centiseconds, like nyan.rom's frame delay
+        return [
+            Ins.from_values(Op.ADDI, Cond.UN, 5, 0, 1),
+            Ins.from_io(Cond.UN, 0, IoDevice.CLOCK_LO_CS, 5),
+            Ins.from_values(Op.LBL, Cond.UN, 0, 3, 0),
+            Ins.from_io(Cond.UN, 5, IoDevice.CLOCK_LO_CS, 0),
+        ] + body + [
+            Ins.from_cmp(Cond.UN, CmpType.RA_IB, Cm.UL, 5, 8),
+            Ins.from_values(Op.JUP, Cond.TR, 0, 3, 0),
+            Ins.halt(),
+        ]
+
+    def test_detect(self):
+        self.assertEqual(Tape.from_inss(self.wait_inss()).busy_waits(), {5})
+
+        # Computing from the clock is fine, but not carrying values around
+        # the loop or having other side effects
+        body = [Ins.from_values(Op.ADD, Cond.UN, 6, 5, 5)]
+        self.assertEqual(
+            Tape.from_inss(self.wait_inss(body)).busy_waits(), {6})
+        for body in [
+            [Ins.from_values(Op.ADDI, Cond.UN, 6, 6, 1)],
+            [Ins.from_io(Cond.UN, 0, IoDevice.MEM_WRITE, 5)],
+            [Ins.from_values(Op.ADDI, Cond.TR, 6, 5, 1)],
+        ]:
+            self.assertEqual(
+                Tape.from_inss(self.wait_inss(body)).busy_waits(), set())
+
+        # Patching the loop body updates the jump
+        tape = Tape.from_inss(self.wait_inss(body))
+        self.assertEqual(tape.decoded()[6][0], Emu.dop_jup)
+        tape.delete(4)
+        self.assertEqual(tape.busy_waits(), {5})
+        self.assertEqual(tape.decoded()[5][0], Emu.dop_jup_wait)
+
+    def test_turbo(self):
+        steps = {}
+        for turbo in [False, True]:
+            for engine in ['ref', 'decoded', 'block', 'trace']:
+                emu = Emu(clock=VirtualClock(100, turbo))
+                emu.tape = Tape.from_inss(self.wait_inss())
+                emu.run(engine=engine)
+                steps.setdefault(turbo, set()).add(emu.steps)
+
+        self.assertEqual(steps[False], {807})
+        self.assertEqual(steps[True], {39})
+
+
+class TestWatchdog(EngineTestCase):
+    engines = ['ref', 'decoded', 'block', 'trace']
+
+    def forever_inss(self, body=[]):
+        # Counts r1 up forever, wrapping around every 64 times
+        return [
+            Ins.from_values(Op.LBL, Cond.UN, 0, 3, 0),
+            Ins.from_values(Op.ADDI, Cond.UN, 1, 1, 1),
+        ] + body + [
+            Ins.from_values(Op.JUP, Cond.UN, 0, 3, 0),
+        ]
+
+    def make(self, inss):
+        emu = Emu(clock=VirtualClock())
+        emu.tape = Tape.from_inss(inss)
+        emu.out = io.StringIO()
+        return emu
+
+    def test_max_steps(self):
+        for engine in self.engines:
+            emu = self.make(self.forever_inss())
+            emu.run(engine=engine, max_steps=1000)
+            self.assertEqual(emu.stop_reason, StopReason.MAX_STEPS)
+            self.assertFalse(emu.halted)
+            if engine in {'ref', 'decoded'}:
+                self.assertEqual(emu.steps, 1000)
+            else:
+                self.assertTrue(1000 <= emu.steps < 1010)
+
+            # Carries on from there
+            steps = emu.steps
+            emu.run(engine=engine, max_steps=500)
+            self.assertTrue(steps + 500 <= emu.steps < steps + 510)
+
+            # Nothing at all with no steps left
+            steps = emu.steps
+            emu.run(engine=engine, max_steps=0)
+            self.assertEqual(emu.stop_reason, StopReason.MAX_STEPS)
+            self.assertEqual(emu.steps, steps)
+
+        # Fused pairs don't run past the limit
+        inss = self.forever_inss([
+            Ins.from_cmp(Cond.UN, CmpType.RA_IB, Cm.EQ, 1, 0),
+        ])
+        inss[-1] = Ins.from_values(Op.JUP, Cond.FA, 0, 3, 0)
+        inss.append(Ins.halt())
+        for engine in ['ref', 'decoded']:
+            for max_steps in range(12):
+                emu = self.make(inss)
+                emu.run(engine=engine, max_steps=max_steps)
+                self.assertEqual(emu.steps, max_steps)
+
+        emu = self.make(self.loop_inss())
+        emu.run(max_steps=10 ** 6)
+        self.assertEqual(emu.stop_reason, StopReason.HALTED)
+        self.assertTrue(emu.halted)
+
+    def test_halt_at_max_steps(self):
+        inss = [Ins.from_values(Op.ADDI, Cond.UN, 1, 1, 1)] * 4 + [
+            Ins.halt(),
+            Ins.from_values(Op.ADDI, Cond.UN, 2, 0, 3),
+        ]
+        for engine in self.engines:
+            emu = self.make(inss)
+            emu.run(engine=engine, max_steps=5)
+            self.assertEqual(emu.stop_reason, StopReason.HALTED)
+            self.assertTrue(emu.halted)
+
+            # Stays halted
+            emu.run(engine=engine, max_steps=5)
+            self.assertEqual(emu.regs[2], 0)
+
+    def test_max_time(self):
+        for engine in self.engines:
+            emu = self.make(self.forever_inss())
+            t = time.time()
+            emu.run(engine=engine, max_time=0.05)
+            self.assertEqual(emu.stop_reason, StopReason.MAX_TIME)
+            self.assertLess(time.time() - t, 1)
+
+    def test_cycles(self):
+        for engine in ['ref', 'decoded']:
+            emu = self.make(self.forever_inss())
+            emu.run(engine=engine, detect_cycles=True)
+            self.assertEqual(emu.stop_reason, StopReason.CYCLE)
+            self.assertEqual(emu.steps, 3 + 64 * 3)
+
+            # Output in the loop doesn't repeat a state
+            body = [Ins.from_io(Cond.UN, 0, IoDevice.SERIAL_WRITE, 1)]
+            emu = self.make(self.forever_inss(body))
+            emu.run(engine=engine, detect_cycles=True, max_steps=1000)
+            self.assertEqual(emu.stop_reason, StopReason.MAX_STEPS)
+
+        with self.assertRaises(ValueError):
+            self.make(self.forever_inss()).run(
+                engine='block', detect_cycles=True)
+
+
+class TestProfiler(EngineTestCase):
+    def test_counts(self):
+        emu = Emu()
+        emu.tape = Tape.from_inss(self.loop_inss())
+        log = emu.run(log_inss=True)
+
+        emu = Emu()
+        emu.tape = Tape.from_inss(self.loop_inss())
+        profile = profiler.Profile(emu.tape)
+        emu.run(engine='decoded', profile=profile)
+        self.assertEqual(profile.hits, [log.count(i) for i in range(20)])
+        self.assertEqual(profile.total(), emu.steps)
+
+        # The loop runs 7 times, and the LD after CMPUL r1, 4 runs in the
+        # last 3
+        self.assertEqual(profile.branches()[11], (3, 4))
+        self.assertEqual(profile.by_op()[Op.JUP], 6)
+        self.assertEqual(profile.by_io_device(), {IoDevice.MEM_WRITE: 7})
+
+        out = io.StringIO()
+        Disasm.disasm_tape(emu.tape, out, profile=profile)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 20)
+        self.assertIn('43% ex', lines[11])
+
+        with self.assertRaises(ValueError):
+            Emu().run(profile=profile)
+
+
+class TestTraceFile(EngineTestCase):
+    def test_round_trip(self):
+        emu = Emu()
+        emu.tape = Tape.from_inss(self.loop_inss())
+        log = emu.run(log_inss=True)
+
+        emu = Emu()
+        emu.tape = Tape.from_inss(self.loop_inss())
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, 'loop.trace')
+            with tracefile.TraceWriter(filename, emu.tape, regs=True,
+                                       io=True, chunk_size=16) as writer:
+                emu.run(engine='decoded', trace=writer)
+
+            reader = tracefile.TraceReader(filename)
+            entries = list(reader)
+            self.assertEqual([pc for (steps, pc, events) in entries], log)
+            self.assertEqual([steps for (steps, pc, events) in entries],
+                             list(range(len(log))))
+
+            # Replaying the events gives the same registers
+            regs = [0] * 64
+            writes = 0
+            for (steps, pc, events) in entries:
+                for event in events:
+                    if event[0] == 'reg':
+                        regs[event[1]] = event[2]
+                    elif event[0] == 'io':
+                        self.assertEqual(event[1], IoDevice.MEM_WRITE)
+                        writes += 1
+            self.assertEqual(regs, list(emu.regs.data))
+            self.assertEqual(writes, 7)
+
+            lines = list(reader.disasm(emu.tape))
+            self.assertEqual(len(lines), len(log))
+            self.assertIn('MEM_WRITE', lines[13])
+
+            with open(filename, 'r+b') as f:
+                f.write(b'XXXX')
+            with self.assertRaises(ValueError):
+                tracefile.TraceReader(filename)
+
+    def test_clock(self):
+        inss = [
+            Ins.from_values(Op.ADDI, Cond.UN, 1, 0, 5),
+            Ins.from_io(Cond.UN, 2, IoDevice.CLOCK_LO_CS, 1),  # Reset
+            Ins.from_io(Cond.UN, 3, IoDevice.CLOCK_LO_CS, 0),  # Read
+            Ins.halt(),
+        ]
+        emu = Emu(clock=VirtualClock(1000))
+        emu.tape = Tape.from_inss(inss)
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, 'clock.trace')
+            with tracefile.TraceWriter(filename, emu.tape, io=True) as writer:
+                emu.run(engine='decoded', trace=writer)
+
+            events = [event for (steps, pc, events)
+                      in tracefile.TraceReader(filename) for event in events]
+            self.assertEqual(events, [('io', IoDevice.CLOCK_LO_CS, 5),
+                                      ('io', IoDevice.CLOCK_LO_CS, 0)])
+
+
+class TestTimeline(EngineTestCase):
+    def test_frames(self):
+        inss = [
+            Ins.from_values(Op.ADDI, Cond.UN, 1, 0, 1),
+            Ins.from_io(Cond.UN, 0, IoDevice.MEM_WRITE, 1),
+            Ins.from_io(Cond.UN, 0, IoDevice.CLOCK_LO_CS, 1),
+            Ins.from_io(Cond.UN, 0, IoDevice.MEM_WRITE, 1),
+            Ins.from_io(Cond.UN, 0, IoDevice.SERIAL_WRITE, 1),
+            Ins.halt(),
+        ]
+        emu = Emu()
+        emu.tape = Tape.from_inss(inss)
+        emu.out = io.StringIO()
+        t = timeline.Timeline()
+        emu.run(engine='decoded', timeline=t)
+
+        events = [e for e in t.to_json()['traceEvents'] if e['ph'] == 'X']
+        self.assertEqual([e['name'] for e in events],
+                         ['frame 0', 'reset_clock', 'SERIAL_WRITE', 'frame 1'])
+        self.assertEqual(events[0]['args'], {'steps': 2, 'MEM_WRITE': 1})
+        self.assertEqual(events[3]['args'], {'steps': 4, 'MEM_WRITE': 1})
+        self.assertEqual(emu.out.getvalue(), '1')
+
+
+class TestStats(EngineTestCase):
+    def inss(self):
+        return [
+            Ins.from_values(Op.ADDI, Cond.UN, 1, 0, 33),
+            Ins.from_io(Cond.UN, 0, IoDevice.SERIAL_WRITE, 1),
+            Ins.from_io(Cond.UN, 2, IoDevice.SERIAL_READ, 0),
+        ] + self.loop_inss()
+
+    def run_engine(self, engine, d):
+        emu = Emu()
+        emu.tape = Tape.from_inss(self.inss())
+        emu.out = io.StringIO()
+        emu.buffer = 'X'
+        if engine == 'aot':
+            emu.filename = os.path.join(d, 'stats.rom')
+            transpile.transpile_to_file(emu.tape, emu.filename + '.py')
+        emu.run(engine=engine)
+        return emu
+
+    def test_counts(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            ref = self.run_engine('ref', tmp)
+            jumps = ref.stats.jumps
+            self.assertGreater(jumps, 0)
+            self.assertGreater(ref.stats.label_search_steps, 0)
+
+            for engine in ['ref', 'decoded', 'block', 'trace', 'aot']:
+                emu = self.run_engine(engine, tmp)
+
+                d = emu.stats.to_dict(emu)
+                self.assertEqual(d['instructions'], emu.steps)
+                self.assertEqual(d['jumps'], jumps)
+                self.assertEqual((d['serial_in'], d['serial_out']), (1, 1))
+                self.assertEqual((d['mem_reads'], d['mem_writes']), (0, 7))
+                self.assertEqual((d['gpu_draws'], d['gpu_presents']), (0, 0))
+                self.assertEqual(d['io']['SERIAL_WRITE'], 1)
+                self.assertEqual(d['io']['SERIAL_READ'], 1)
+                self.assertEqual(d['io']['MEM_WRITE'], 7)
+                self.assertEqual(d['io']['GPU_DRAW'], 0)
+
+                # The only sample is at the end and carries the whole run,
+                # which blocks share out between their ops
+                ops = d['estimates']['ops']
+                self.assertAlmostEqual(sum(ops.values()), emu.steps,
+                                       delta=len(ops))
+
+                text = emu.stats.to_prometheus(emu)
+                self.assertIn('emu_instructions_total {}\n'.format(
+                    emu.steps), text)
+                self.assertIn('emu_jumps_total {}\n'.format(jumps), text)
+                self.assertIn('emu_serial_out_total 1\n', text)
+                self.assertIn('emu_mem_writes_total 7\n', text)
+                self.assertIn(
+                    'emu_io_instructions_total{device="MEM_WRITE"} 7\n', text)
+                self.assertIn('# TYPE emu_estimated_op_instructions gauge\n',
+                              text)
+
+            # Sampling doesn't build what the engine didn't
+            emu = self.run_engine('aot', tmp)
+            self.assertIsNone(emu.tape._blocks)
+            self.assertIsNone(emu.tape._traces)
+            emu = self.run_engine('block', tmp)
+            self.assertIsNone(emu.tape._traces)
+
+    def test_export(self):
+        emu = Emu()
+        emu.tape = Tape.from_inss(self.loop_inss())
+        emu.run()
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, 'stats.json')
+            emu.stats.export_every(emu, filename, period=0.01)
+            time.sleep(0.1)
+            emu.stats.stop_export()
+            with open(filename) as f:
+                self.assertEqual(json.load(f)['instructions'], emu.steps)
+
+
+class TestHooks(EngineTestCase):
+    def make(self):
+        emu = Emu()
+        emu.tape = Tape.from_inss(self.loop_inss())
+        return emu
+
+    def test_hooks(self):
+        ref = self.make()
+        log = ref.run(log_inss=True)
+
+        emu = self.make()
+        calls = []
+        emu.add_hook(lambda emu, pc: calls.append(('pre', pc)))
+        emu.add_hook(lambda emu, pc: calls.append(('add', pc, emu.regs[2])),
+                     op=Op.ADD, after=True)
+        emu.add_hook(lambda emu, pc: calls.append(('write', emu.regs[5])),
+                     device=IoDevice.MEM_WRITE)
+        emu.add_hook(lambda emu, pc: calls.append(('label', pc)),
+                     label_key=(1, 0))
+        emu.run(engine='decoded')
+        self.assert_same_state(emu, ref)
+
+        # Only instructions that execute
+        executed = []
+        emu = self.make()
+        while not emu.halted:
+            if emu.should_execute(emu.tape[emu.pc]):
+                executed.append(emu.pc)
+            emu.step()
+        self.assertLess(len(executed), len(log))
+        self.assertEqual([c[1] for c in calls if c[0] == 'pre'], executed)
+
+        self.assertEqual([c[1] for c in calls if c[0] == 'label'], [2] * 7)
+        self.assertEqual([c[2] for c in calls if c[0] == 'add' and c[1] == 3],
+                         [7, 13, 18, 22, 25, 27, 28])
+        self.assertEqual(len([c for c in calls if c[0] == 'write']), 7)
+
+    def test_stop(self):
+        ref = self.make()
+        ref.run()
+
+        emu = self.make()
+
+        def stop(emu, pc):
+            emu.stop(StopReason.HOOK)
+
+        hook = emu.add_hook(stop, device=IoDevice.MEM_WRITE)
+        emu.run(engine='decoded')
+        self.assertEqual(emu.stop_reason, StopReason.HOOK)
+        self.assertEqual(emu.pc, 13)
+        self.assertFalse(emu.halted)
+
+        emu.remove_hook(hook)
+        emu.run(engine='decoded')
+        self.assert_same_state(emu, ref)
+
+        emu.add_hook(stop)
+        with self.assertRaises(ValueError):
+            emu.run(engine='block')
+
+
+class TestBench(unittest.TestCase):
+    def result(self, engine, ips, stop_reason='MAX_STEPS'):
+        return {'python': 'cpython', 'rom': 'nyan.rom', 'engine': engine,
+                'ips': ips, 'peak_rss_kb': 1000, 'stop_reason': stop_reason}
+
+    def test_compare(self):
+        baseline = [self.result('ref', 100), self.result('block', 1000),
+                    self.result('trace', 10, 'HALTED')]
+        results = [self.result('ref', 95), self.result('block', 800),
+                   self.result('trace', 1, 'HALTED')]
+        regressions = bench.compare(results, baseline, 0.1)
+        self.assertEqual(len(regressions), 1)
+        self.assertIn('block', regressions[0])
+
+        # Runs that failed are missing from the results
+        regressions = bench.compare(results[1:], baseline, 0.1)
+        self.assertEqual(len(regressions), 2)
+        self.assertIn('cpython nyan.rom ref: missing', regressions)
+
+    def test_input_ends(self):
+        # Reads serial input until there's none left
+        tape = Tape.from_inss([
+            Ins.from_values(Op.LBL, Cond.UN, 0, 1, 0),
+            Ins.from_io(Cond.UN, 1, IoDevice.SERIAL_READ, 0),
+            Ins.from_values(Op.JUP, Cond.UN, 0, 1, 0),
+        ])
+        (roms_dir, benchmarks) = (bench.roms_dir, bench.benchmarks)
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, 'read.rom'), 'wb') as f:
+                f.write(base64.b64encode(tape.to_bytes()))
+            bench.roms_dir = d
+            bench.benchmarks = {'read.rom': ('AB', False)}
+            try:
+                result = bench.run_one('read.rom', 'decoded', 10 ** 6)
+            finally:
+                (bench.roms_dir, bench.benchmarks) = (roms_dir, benchmarks)
+        self.assertEqual(result['stop_reason'], 'INPUT')
+        self.assertEqual(result['steps'], 7)
+
+
+class TestDiffCheck(EngineTestCase):
+    def test_agree(self):
+        for engine in ['decoded', 'block', 'trace', 'aot']:
+            tape = Tape.from_inss(self.loop_inss())
+            self.assertIsNone(diffcheck.check(tape, ('ref', engine), sync=7))
+
+    def test_mismatch(self):
+        tape = Tape.from_inss(self.loop_inss())
+        # Break the ADD at 3 for the decoded engine only
+        code = tape.fused()
+        code[3] = (Emu.dop_sub,) + code[3][1:]
+
+        mismatch = diffcheck.check(tape, ('ref', 'decoded'), sync=50)
+        self.assertTrue(mismatch.good <= 3 < mismatch.bad <= 5)
+        self.assertIn(('r2', 7, 57), mismatch.diffs)
+        self.assertIn((3, 3), mismatch.window)
+        self.assertIn('ADD    r2, r2, r1', mismatch.report(tape))
+
+
+class TestHeadlessGpu(unittest.TestCase):
+    def test_draw(self):
+        inss = [
+            Ins.from_values(Op.ADDI, Cond.UN, 1, 0, 5),
+            Ins.from_io(Cond.UN, 0, IoDevice.GPU_X, 1),
+            Ins.from_values(Op.ADDI, Cond.UN, 1, 0, 7),
+            Ins.from_io(Cond.UN, 0, IoDevice.GPU_Y, 1),
+            Ins.from_values(Op.ADDI, Cond.UN, 1, 0, 0b110110),
+            Ins.from_io(Cond.UN, 0, IoDevice.GPU_DRAW, 1),
+            Ins.from_io(Cond.UN, 0, IoDevice.CLOCK_LO_CS, 1),  # Present
+            Ins.from_values(Op.ADDI, Cond.UN, 1, 0, 0b000011),
+            Ins.from_io(Cond.UN, 0, IoDevice.GPU_DRAW, 1),
+            Ins.halt(),
+        ]
+        for engine in ['ref', 'decoded', 'block']:
+            emu = Emu(gpu_backend=gpu.HeadlessGpu())
+            emu.tape = Tape.from_inss(inss)
+            emu.run(engine=engine)
+            self.assertTrue(emu.use_gpu)
+            self.assertEqual(emu.gpu.frames, 1)
+
+            # The frame presented, then what was drawn after it
+            frame = emu.gpu.frame()
+            self.assertEqual(frame.shape, (64, 64, 3))
+            self.assertEqual(list(frame[7, 5]), [0xff, 0x55, 0xaa])
+            self.assertEqual(int(frame.sum()), 0xff + 0x55 + 0xaa)
+            self.assertEqual(list(emu.gpu.frame(presented=False)[7, 5]),
+                             [0, 0, 0xff])
+
+    def test_snapshot(self):
+        a = gpu.HeadlessGpu()
+        a.start()
+        for (x, y, color) in [(0, 0, 0o77), (63, 1, 0b100100), (2, 63, 1)]:
+            a.set_x(x)
+            a.set_y(y)
+            a.draw(color)
+
+        b = gpu.HeadlessGpu()
+        b.start()
+        b.restore(a.snapshot())
+        self.assertEqual((b.x, b.y), (2, 63))
+        self.assertEqual(b.buf.tobytes(), a.buf.tobytes())
+        self.assertEqual(b.snapshot(), a.snapshot())
+        self.assertEqual(b.frame().tobytes(), a.frame(False).tobytes())
+
+
+class TestAlu(unittest.TestCase):
+    def setUp(self):
+        self.ref = Emu()
+        self.dec = Emu()
+
+    def assert_decoded_matches(self, ins, a, b):
+        ref, dec = self.ref, self.dec
+        for emu in [ref, dec]:
+            emu.regs.data[:] = [0] * 64
+            emu.regs[1], emu.regs[2] = a, b
+            emu.cf = False
+
+        ref.execute(ins)
+        handler, cond_, x, y, z = Emu.decode(ins)
+        handler(dec, x, y, z)
+
+        self.assertEqual((dec.regs.data, dec.cf), (ref.regs.data, ref.cf))
+
+    def test_rrr(self):
+        for op in [Op.ADD, Op.SUB, Op.OR, Op.XOR, Op.AND, Op.SHL, Op.SHR]:
+            ins = Ins.from_values(op, Cond.UN, 3, 1, 2)
+            for a in range(64):
+                for b in range(64):
+                    self.assert_decoded_matches(ins, a, b)
+
+    def test_imm(self):
+        for a in range(64):
+            for ib in range(0, 64, 5):
+                for op in [Op.ADDI, Op.ORI, Op.XORI, Op.ANDI]:
+                    ins = Ins.from_values(op, Cond.UN, 3, 1, ib)
+                    self.assert_decoded_matches(ins, a, 0)
+            for ib in range(8):
+                for shi_type in ShiType:
+                    ins = Ins.from_shi(Cond.UN, 3, 1, shi_type, ib)
+                    self.assert_decoded_matches(ins, a, 0)
+
+    def test_cmp(self):
+        for cmp_type in CmpType:
+            for cm in Cm:
+                ins = Ins.from_cmp(Cond.UN, cmp_type, cm, 1, 2)
+                for a in range(0, 64, 3):
+                    for b in range(64):
+                        self.assert_decoded_matches(ins, a, b)
+
+    def test_fm(self):
+        for fm_type in FmType:
+            for pr in range(16):
+                ins = Ins.from_fm(Cond.UN, 1, 2, fm_type, pr)
+                for a in range(0, 64, 7):
+                    for b in range(64):
+                        self.assert_decoded_matches(ins, a, b)
+
+
 if __name__ == '__main__':
     unittest.main()
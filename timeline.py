@@ -0,0 +1,133 @@
+'''
+Timeline of IO, clock and frame events, in the Chrome trace event format
+that chrome://tracing and Perfetto open.
+
+Serial IO is recorded event by event, with how long each took on the host,
+which shows time spent waiting for input. Devices used too often for that
+(clock reads, memory and GPU) are counted instead, and the counts are
+attached to one span per frame. A frame ends whenever the clock is reset,
+which is also when the GPU presents.
+
+Like `breakpoints`, this works by wrapping the decoded records of the IO
+instructions, so a run without a timeline doesn't change at all.
+'''
+
+import json
+import time
+
+from emu import *
+from history import io_device
+
+# Devices that are counted per frame rather than recorded one by one
+counted_io_devices = {
+    IoDevice.CLOCK_LO_CS,
+    IoDevice.CLOCK_HI_CS,
+    IoDevice.MEM_ADDR_HI,
+    IoDevice.MEM_ADDR_MID,
+    IoDevice.MEM_ADDR_LO,
+    IoDevice.MEM_READ,
+    IoDevice.MEM_WRITE,
+    IoDevice.GPU_X,
+    IoDevice.GPU_Y,
+    IoDevice.GPU_DRAW,
+}
+
+# Thread IDs in the output
+FRAMES_TID = 1
+IO_TID = 2
+
+
+class Timeline:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.events = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': FRAMES_TID,
+             'args': {'name': 'Frames'}},
+            {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': IO_TID,
+             'args': {'name': 'IO'}},
+        ]
+
+        self.frames = 0
+        self.frame_ts = None  # Start of the current frame
+        self.frame_steps = 0
+        self.counts = {}  # Device name -> uses in the current frame
+
+    def ts(self):
+        '''Microseconds since the timeline was created'''
+        return (time.perf_counter() - self.start) * 1e6
+
+    def complete(self, name, cat, tid, ts, args):
+        self.events.append({
+            'name': name, 'cat': cat, 'ph': 'X', 'pid': 1, 'tid': tid,
+            'ts': ts, 'dur': self.ts() - ts, 'args': args,
+        })
+
+    def begin_frame(self, emu):
+        if self.frame_ts is None:
+            self.frame_ts = self.ts()
+            self.frame_steps = emu.steps
+            self.counts = {}
+
+    def end_frame(self, emu):
+        if self.frame_ts is None:
+            return
+
+        args = {'steps': emu.steps - self.frame_steps}
+        args.update(self.counts)
+        self.complete('frame {}'.format(self.frames), 'frame', FRAMES_TID,
+                      self.frame_ts, args)
+        self.frames += 1
+        self.frame_ts = None
+
+    # Wrapped records for `wrap`. Like the originals they only run if their
+    # condition passes.
+
+    def io_handler(self, emu, rec, name, c_):
+        handler, cond, a, b, c = rec
+        ts = self.ts()
+        handler(emu, a, b, c)
+        self.complete(name, 'io', IO_TID, ts,
+                      {'steps': emu.steps, 'pc': emu.pc})
+
+    def count_handler(self, emu, rec, name, c_):
+        handler, cond, a, b, c = rec
+        handler(emu, a, b, c)
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def reset_handler(self, emu, rec, b_, c_):
+        handler, cond, a, b, c = rec
+        self.end_frame(emu)
+        ts = self.ts()
+        handler(emu, a, b, c)
+        self.complete('present' if emu.use_gpu else 'reset_clock', 'clock',
+                      IO_TID, ts, {'steps': emu.steps, 'pc': emu.pc})
+        self.begin_frame(emu)
+
+    def wrap(self, tape, code=None):
+        '''
+        Decoded records of `tape` that report to this timeline, or `code`
+        with the IO ones wrapped
+        '''
+        code = list(tape.decoded() if code is None else code)
+        for i, ins in enumerate(tape.data):
+            if ins.op != Op.IO:
+                continue
+
+            cond = code[i][1]
+            ix = io_device(ins)
+            if ix in {IoDevice.CLOCK_LO_CS, IoDevice.CLOCK_HI_CS} and \
+                    ins.c != 0:
+                code[i] = (self.reset_handler, cond, code[i], None, None)
+            elif ix in counted_io_devices:
+                code[i] = (self.count_handler, cond, code[i], ix.name, None)
+            else:
+                name = 'UNKNOWN' if ix is None else ix.name
+                code[i] = (self.io_handler, cond, code[i], name, None)
+        return code
+
+    def to_json(self):
+        return {'traceEvents': self.events, 'displayTimeUnit': 'ms'}
+
+    def to_file(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_json(), f)
@@ -0,0 +1,302 @@
+'''
+Streaming binary execution trace.
+
+A trace file is a header followed by records. Executed PCs are stored as runs
+of consecutive positions, so straight-line code costs one record per jump
+rather than one per instruction:
+
+- `RUN`: Start of the run relative to where the previous one ended, zigzag
+  varint, then its length, varint
+- `REG`: Register and its new value, after the last instruction of the run
+- `CF`: New carry flag, likewise
+- `IO`: Device and the value read or written, likewise
+
+`REG` and `CF` are only written with `regs`, and `IO` only with `io`.
+Records go into chunks which a background thread writes out, and at most
+`max_chunks` of them are held at once, so memory stays bounded however long
+the run is. `TraceReader` reads a trace back lazily.
+'''
+
+import queue
+import struct
+import sys
+import threading
+
+from emu import *
+from history import rd_io_devices, io_device
+
+magic = b'EMUT'
+version = 1
+
+# Magic, version, flags, `Emu.steps` at the start, tape SHA-256
+header_format = '<4sBBQ32s'
+
+# Flags
+FLAG_REGS = 1
+FLAG_IO = 2
+
+# Record tags
+RUN = 0
+REG = 1
+CF = 2
+IO = 3
+
+
+def put_varint(buf, n):
+    while n >= 0x80:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+class TraceWriter:
+    def __init__(self, filename, tape, regs=False, io=False,
+                 chunk_size=2 ** 16, max_chunks=64):
+        self.regs = regs
+        self.io = io
+        self.chunk_size = chunk_size
+
+        self.f = open(filename, 'wb')
+        self.flags = (FLAG_REGS if regs else 0) | (FLAG_IO if io else 0)
+        self.tape_sha256 = bytes.fromhex(tape.sha256())
+        self.header_written = False
+
+        self.buf = bytearray()
+        self.end = 0  # Where the last run ended
+
+        # Full chunks waiting to be written, None to stop
+        self.chunks = queue.Queue(max_chunks)
+        self.error = None
+        self.thread = threading.Thread(target=self.write_chunks, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write_chunks(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            try:
+                self.f.write(chunk)
+            except OSError as e:
+                self.error = e
+
+    def start(self, emu):
+        '''Write the header, before the first record'''
+        if not self.header_written:
+            self.buf += struct.pack(header_format, magic, version, self.flags,
+                                    emu.steps, self.tape_sha256)
+            self.header_written = True
+
+    def flush(self):
+        '''Hand the current chunk to the background thread'''
+        if self.buf:
+            self.chunks.put(bytes(self.buf))
+            self.buf.clear()
+
+    def run(self, start, length):
+        delta = start - self.end
+        put_varint(self.buf, RUN)
+        put_varint(self.buf, (delta << 1) ^ (delta >> 63))  # Zigzag
+        put_varint(self.buf, length)
+        self.end = start + length
+        if len(self.buf) >= self.chunk_size:
+            self.flush()
+
+    def reg(self, i, value):
+        self.buf += bytes([REG, i, value])
+
+    def cf(self, value):
+        self.buf += bytes([CF, int(value)])
+
+    def io_event(self, ix, value):
+        self.buf += bytes([IO, ix.value, value])
+
+    def close(self):
+        self.flush()
+        self.chunks.put(None)
+        self.thread.join()
+        self.f.close()
+        if self.error is not None:
+            raise self.error
+
+
+def run(emu, writer, code=None):
+    '''
+    Run `emu` like `Emu.run_decoded` on the decoded records, or `code` if
+    given, writing what it does to `writer`
+    '''
+    if code is None:
+        code = emu.tape.decoded()
+    n = len(code)
+    r = emu.regs.data
+
+    # Device at each position and whether it reads into `rd`, for IO. The
+    # clock is only read with `rs` = 0, and reset otherwise.
+    devices = [None] * n
+    if writer.io:
+        clocks = {IoDevice.CLOCK_LO_CS, IoDevice.CLOCK_HI_CS}
+        for i, ins in enumerate(emu.tape.data):
+            ix = io_device(ins)
+            if ix is not None:
+                reads = ix in rd_io_devices and (ix not in clocks or
+                                                 ins.c == 0)
+                devices[i] = (ix, reads)
+
+    track_regs = writer.regs
+
+    writer.start(emu)
+    start = emu.pc
+    length = 0
+    limit = emu.check_at
+    while not emu.halted:
+        pc = emu.pc
+        handler, cond, a, b, c = code[pc]
+        events = False
+        if cond == 0 or (cond == 1) == emu.cf:
+            if track_regs:
+                regs = bytes(r)
+                cf = emu.cf
+            handler(emu, a, b, c)
+
+            if track_regs and (r != regs or emu.cf != cf):
+                writer.run(start, length + 1)
+                events = True
+                for i in range(64):
+                    if r[i] != regs[i]:
+                        writer.reg(i, r[i])
+                if emu.cf != cf:
+                    writer.cf(emu.cf)
+            if devices[pc] is not None:
+                if not events:
+                    writer.run(start, length + 1)
+                    events = True
+                (ix, reads) = devices[pc]
+                ins = emu.tape[pc]
+                writer.io_event(ix, r[ins.a] if reads else r[ins.c])
+
+        emu.pc = (emu.pc + 1) % n  # Tape is looped
+        emu.steps += 1
+        length += 1
+
+        if events:
+            start = emu.pc
+            length = 0
+        elif emu.pc != pc + 1:
+            writer.run(start, length)
+            start = emu.pc
+            length = 0
+
+        if emu.steps >= limit:
+            emu.check_in()
+            limit = emu.check_at
+
+    if length:
+        writer.run(start, length)
+    writer.flush()
+
+
+class TraceReader:
+    '''Reads a file from `TraceWriter` without loading all of it'''
+
+    def __init__(self, filename, chunk_size=2 ** 16):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        with open(filename, 'rb') as f:
+            header = f.read(struct.calcsize(header_format))
+        if len(header) != struct.calcsize(header_format):
+            raise ValueError('Not a trace')
+        (m, v, self.flags, self.steps, sha) = struct.unpack(
+            header_format, header)
+        if m != magic:
+            raise ValueError('Not a trace')
+        if v != version:
+            raise ValueError('Unsupported trace version: {}'.format(v))
+        self.tape_sha256 = sha.hex()
+
+    def read_bytes(self):
+        with open(self.filename, 'rb') as f:
+            f.seek(struct.calcsize(header_format))
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                yield from chunk
+
+    def runs(self):
+        '''
+        Yields `(steps, start, length, events)` for each run, where `steps`
+        is `Emu.steps` at its start and `events` happened after its last
+        instruction. Events are `('reg', i, value)`, `('cf', value)` and
+        `('io', IoDevice, value)`.
+        '''
+        it = self.read_bytes()
+
+        def varint():
+            ans = 0
+            shift = 0
+            for byte in it:
+                ans |= (byte & 0x7f) << shift
+                if byte < 0x80:
+                    return ans
+                shift += 7
+            raise ValueError('Truncated trace')
+
+        steps = self.steps
+        end = 0
+        run = None
+        for tag in it:
+            if tag == RUN:
+                if run is not None:
+                    yield run
+                    steps += run[2]
+                z = varint()
+                start = end + ((z >> 1) ^ -(z & 1))
+                length = varint()
+                end = start + length
+                run = (steps, start, length, [])
+            elif tag in {REG, CF, IO}:
+                if run is None:
+                    raise ValueError('Event before the first run')
+                if tag == REG:
+                    run[3].append(('reg', next(it), next(it)))
+                elif tag == CF:
+                    run[3].append(('cf', bool(next(it))))
+                else:
+                    run[3].append(('io', IoDevice(next(it)), next(it)))
+            else:
+                raise ValueError('Bad record tag: {}'.format(tag))
+
+        if run is not None:
+            yield run
+
+    def __iter__(self):
+        '''Yields `(steps, pc, events)` for each instruction'''
+        for (steps, start, length, events) in self.runs():
+            for i in range(length):
+                yield (steps + i, start + i,
+                       events if i == length - 1 else [])
+
+    def disasm(self, tape):
+        '''Yields a line of disassembly for each instruction'''
+        if tape.sha256() != self.tape_sha256:
+            raise ValueError('Trace is for a different tape')
+
+        for (steps, pc, events) in self:
+            line = '{:>10} {:0>4}: {}'.format(
+                steps, pc, Disasm.disasm(tape[pc]))
+            for event in events:
+                line += '  ; {}'.format(' '.join(
+                    e.name if isinstance(e, IoDevice) else str(e)
+                    for e in event))
+            yield line
+
+
+if __name__ == '__main__':
+    assert len(sys.argv) >= 3
+    rom, filename = sys.argv[1], sys.argv[2]
+    emu = Emu.from_filename(rom)
+    for line in TraceReader(filename).disasm(emu.tape):
+        print(line)
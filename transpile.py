@@ -0,0 +1,111 @@
+'''
+Ahead-of-time ROM to Python transpiler.
+
+Writes a standalone module implementing the whole program, with one function
+per basic block from `compiler.BlockGen` and jump targets resolved into
+tables. The module only needs an `Emu`-compatible object to run on: `regs`,
+`pc`, `cf`, `steps`, `halted`, the `io_*` device handlers and `execute` for
+anything that isn't compiled.
+'''
+
+import importlib.util
+import os
+import py_compile
+import sys
+
+from emu import *
+from compiler import Blocks, BlockGen
+
+
+def transpile(tape, name='<tape>'):
+    '''Python source of a module implementing `tape`'''
+    blocks = Blocks(tape)
+    consts = {}
+    funcs = []
+    starts = sorted(blocks.leaders)
+    for start in starts:
+        body = BlockGen(tape, start, blocks.end(start), consts).gen()
+        funcs.append('')
+        funcs.append('')
+        funcs.append('def block_{}(emu, r):'.format(start))
+        funcs += body
+
+    lines = [
+        "'''Generated by transpile.py from {}. Do not edit.'''".format(name),
+        '',
+        'from emu import *',
+        'from compiler import no_label',
+        '',
+        "ROM_SHA256 = '{}'".format(tape.sha256()),
+        'TAPE_LEN = {}'.format(len(tape)),
+        '',
+    ]
+    lines += ['{} = {}'.format(k, expr) for expr, k in consts.items()]
+    lines += funcs
+    lines += [
+        '',
+        '',
+        '# Block at each PC, or None in the middle of a block',
+        'blocks = [None] * TAPE_LEN',
+    ]
+    lines += ['blocks[{0}] = block_{0}'.format(start) for start in starts]
+    lines += [
+        '',
+        '',
+        'def run(emu):',
+        '    r = emu.regs.data',
+        '    while not emu.halted:',
+        '        block = blocks[emu.pc]',
+        '        if block is None:',
+        '            # In the middle of a block, e.g. after a snapshot or',
+        '            # another engine, so step to the next one',
+        '            emu.step()',
+        '        else:',
+        '            emu.pc = block(emu, r)',
+        '        if emu.steps >= emu.check_at:',
+        '            emu.check_in()',
+        '',
+    ]
+    return '\n'.join(lines)
+
+
+def transpile_to_file(tape, filename, name='<tape>'):
+    '''Write the module for `tape` to `filename` and byte-compile it'''
+    with open(filename, 'w') as f:
+        f.write(transpile(tape, name))
+    py_compile.compile(filename)
+
+
+def load(filename):
+    '''Import a module written by `transpile_to_file`'''
+    name = os.path.basename(filename).replace('.', '_')
+    spec = importlib.util.spec_from_file_location(name, filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run(emu, module=None):
+    '''
+    Run `emu` until halted on its prebuilt module. Without `module`, this is
+    `<rom>.py` next to the ROM `emu` was loaded from.
+    '''
+    if module is None:
+        if emu.filename is None:
+            raise ValueError(
+                'No prebuilt module for a tape not loaded from a file')
+        module = load(emu.filename + '.py')
+
+    if module.ROM_SHA256 != emu.tape.sha256():
+        raise ValueError('Prebuilt module is for a different ROM')
+
+    # So sampling can tell where its blocks end
+    emu.stats.aot_blocks = module.blocks
+    module.run(emu)
+
+
+if __name__ == '__main__':
+    assert len(sys.argv) >= 2
+    filename = sys.argv[1]
+    emu = Emu.from_filename(filename)
+    transpile_to_file(emu.tape, filename + '.py', os.path.basename(filename))